@@ -2,6 +2,46 @@ CREATE TABLE IF NOT EXISTS entities(
     id serial PRIMARY KEY,
     ldap_uuid UUID NOT NULL UNIQUE,
     type VARCHAR,
-    content JSON,
-    last_modified_timestamp timestamp
-);
\ No newline at end of file
+    content JSONB,
+    content_hash CHAR(32),
+    last_modified_timestamp timestamp,
+    deleted_timestamp timestamp
+);
+
+-- Highest synced modifyTimestamp per type, from which the next sync resumes.
+-- The row of type 'syncrepl' holds the cookie from which watching resumes (RFC 4533).
+CREATE TABLE IF NOT EXISTS sync_state(
+    type VARCHAR PRIMARY KEY,
+    last_modified_timestamp timestamp,
+    cookie BYTEA,
+    updated_timestamp timestamp DEFAULT now()
+);
+
+-- Migrate tables created before the content_hash column existed
+ALTER TABLE entities ADD COLUMN IF NOT EXISTS content_hash CHAR(32);
+-- Migrate tables created before the deleted_timestamp column existed
+ALTER TABLE entities ADD COLUMN IF NOT EXISTS deleted_timestamp timestamp;
+
+-- Migrate tables created with a JSON content column to JSONB
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'entities' AND column_name = 'content') = 'json' THEN
+        ALTER TABLE entities ALTER COLUMN content TYPE JSONB USING content::jsonb;
+    END IF;
+END
+$$;
+
+-- Containment queries on the attributes e.g.
+-- content->'attributes' @> '{"memberOf": ["cn=admin,ou=groups,dc=hetarchief,dc=be"]}'
+CREATE INDEX IF NOT EXISTS entities_attributes_idx
+    ON entities USING GIN ((content->'attributes') jsonb_path_ops);
+-- Lookups on the (first) value of commonly queried attributes e.g.
+-- content #>> '{attributes,mail,0}' = 'test@meemoo.be'
+CREATE INDEX IF NOT EXISTS entities_mail_idx
+    ON entities ((content #>> '{attributes,mail,0}'));
+CREATE INDEX IF NOT EXISTS entities_o_idx
+    ON entities ((content #>> '{attributes,o,0}'));
+-- Counting per type and the highest last_modified_timestamp
+CREATE INDEX IF NOT EXISTS entities_type_last_modified_timestamp_idx
+    ON entities (type, last_modified_timestamp);
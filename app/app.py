@@ -1,70 +1,619 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
+import argparse
+import asyncio
+import time
+from functools import partial
 from ldap3.core.exceptions import LDAPExceptionError
 from psycopg2 import OperationalError as PSQLError
 
 from viaa.configuration import ConfigParser
 from viaa.observability import logging
 
-from app.comm.ldap import LdapClient
-from app.comm.deewee import DeeweeClient
+from app.comm.ldap import (
+    LdapClient, AsyncLdapClient, LdapSyncRefreshRequired, CHANGE_TYPE_DELETE,
+    DEFAULT_MAX_QUEUED_PAGES, ENTITY_TYPES
+)
+from app.comm.deewee import DeeweeClient, AsyncDeeweeClient, DELETE_STRATEGY_NONE
+from app.metrics import metrics, METRICS_PREFIX
+from app.plan import SyncPlan
+from app.snapshot import Snapshot, anti_merge_join
+from app.sources import parse_sources, run_sources
+
+try:
+    from asyncpg import PostgresError as AsyncPSQLError
+except ImportError:  # asyncpg is only needed by AsyncApp
+    AsyncPSQLError = PSQLError
 
 
 # Initialize the logger and the configuration
 config = ConfigParser()
 logger = logging.get_logger(__name__, config=config)
 
+DEFAULT_WATCH_BATCH_SIZE = 100
+DEFAULT_WATCH_FLUSH_INTERVAL = 1.0
+
 
 class App:
 
+    ldap_client_class = LdapClient
+    deewee_client_class = DeeweeClient
+
     def __init__(self):
         # Initialize ldap and deewee clients
-        self.ldap_client = LdapClient(config.config["ldap"])
-        self.deewee_client = DeeweeClient(config.config["postgresql"])
+        self.ldap_client = self.ldap_client_class(config.config["ldap"])
+        self.deewee_client = self.deewee_client_class(config.config["postgresql"])
+        watch_params = config.config.get("watch") or {}
+        self.watch_batch_size = watch_params.get("batch_size", DEFAULT_WATCH_BATCH_SIZE)
+        self.watch_flush_interval = watch_params.get(
+            "flush_interval", DEFAULT_WATCH_FLUSH_INTERVAL
+        )
+        self.metrics_params = config.config.get("metrics") or {}
+        snapshot_path = (config.config.get("snapshot") or {}).get("path")
+        self.snapshot = Snapshot(snapshot_path) if snapshot_path else None
+        # A slow database throttles the LDAP searches once this many pages are queued
+        self.max_queued_pages = (
+            self.deewee_client.max_queued_pages or DEFAULT_MAX_QUEUED_PAGES
+        )
+
+    def _searches(self, modified_since: dict, last_modified: dict = None) -> list:
+        """Returns the searches of the orgs and people as (type, search) tuples.
+
+        A full sync of a type is split into shards, which are searched in parallel.
+        The searches yield compact EntityRecords instead of ldap3 Entry objects.
 
-    def _sync(self, modified_since: datetime = None):
+        Arguments:
+            last_modified -- the stored modify timestamp per entryUUID per type,
+                             to skip the unchanged entries
+        """
+        last_modified = last_modified or {}
+        searches = []
+        for type, search in (
+            ("org", self.ldap_client.search_orgs),
+            ("person", self.ldap_client.search_people)
+        ):
+            search = partial(
+                search, records=True, last_modified=last_modified.get(type)
+            )
+            if modified_since.get(type) is None:
+                searches.extend(self.ldap_client.sharded_searches(type, search))
+            else:
+                searches.append((type, search))
+        return searches
+
+    def _sync(self, modified_since: dict = None):
         """"Will sync the information in LDAP to the PostgreSQL DB.
 
-        Executes an LDAP search per type.
-        Those results will be send through in one transaction.
+        Executes an LDAP search per type, concurrently. A full sync of a type
+        is split into shards, which are also searched concurrently.
+        The results are streamed page by page, as soon as any search returns
+        them, and upserted in batches, all in one transaction.
         If the transaction fails, rollback so that the DB will not be in an incomplete state.
 
         Arguments:
-            modified_since -- Searches the LDAP results based on this parameter.
-                              If None, it will retrieve all LDAP entries.
+            modified_since -- Searches the LDAP results per type based on this
+                              parameter: dict of type to datetime.
+                              If None (or None for a type), it will retrieve all
+                              LDAP entries (of the type).
         """
 
-        # Orgs
-        logger.info("Searching for orgs")
-        ldap_orgs = self.ldap_client.search_orgs(modified_since)
-        logger.info(f"Found {len(ldap_orgs)} org(s) to sync")
+        modified_since = modified_since or {}
+        self._seed_snapshot()
+        searches = self._searches(modified_since, self._last_modified(modified_since))
 
-        # People
-        logger.info("Searching for people")
-        ldap_people = self.ldap_client.search_people(modified_since)
-        logger.info(f"Found {len(ldap_people)} people to sync")
+        # The searches are lazy: LDAP is queried while the results are upserted
+        logger.info(f"Searching for orgs and people in {len(searches)} search(es)")
+        ldap_results = self.ldap_client.search_concurrently(
+            searches, modified_since, self.max_queued_pages
+        )
 
-        self.deewee_client.upsert_ldap_results_many(
-            [(ldap_orgs, "org"), (ldap_people, "person")]
+        snapshot_rows = []
+        if self.snapshot is not None:
+            ldap_results = self._diff_snapshot(ldap_results, snapshot_rows)
+        stats = self.deewee_client.upsert_ldap_results_many(ldap_results)
+        logger.info(
+            f"Synced {stats.total} org(s) and people: {stats.inserted} inserted, "
+            f"{stats.updated} updated, {stats.unchanged} unchanged"
         )
+        if self.snapshot is not None:
+            self.snapshot.save(snapshot_rows)
 
-    def main(self):
+        if self.deewee_client.delete_strategy != DELETE_STRATEGY_NONE:
+            self._reconcile()
+
+    def _seed_snapshot(self):
+        """Seeds the snapshot from the database if it is new or cleared."""
+        if self.snapshot is None or self.snapshot.seeded:
+            return
+        logger.info(f"Seeding the snapshot {self.snapshot.path} from the database")
+        self.snapshot.seed(self.deewee_client.snapshot_rows())
+
+    def _diff_snapshot(self, ldap_results, snapshot_rows: list):
+        """Leaves the entries that did not change since the snapshot out.
+
+        Arguments:
+            ldap_results -- iterable of Tuple[list[EntityRecord], str]
+            snapshot_rows -- list to which the snapshot rows of the changed
+                             entries are added, to save them once synced
+        """
+        for records, type in ldap_results:
+            yield self.snapshot.changed(records, type, snapshot_rows), type
+
+    def _last_modified(self, modified_since: dict) -> dict:
+        """Loads the stored modify timestamps if the dirty check is enabled.
+
+        Returns:
+            dict -- the modify timestamp per entryUUID per type, empty if the
+                    dirty check is disabled
+        """
+        if not self.deewee_client.dirty_check:
+            return {}
+        index = self.deewee_client.last_modified_index(
+            {type: modified_since.get(type) for type in ENTITY_TYPES}
+        )
+        logger.info(
+            f"Loaded the modify timestamps of {sum(map(len, index.values()))} "
+            "row(s) to skip the unchanged entries"
+        )
+        return index
+
+    def _reconcile(self):
+        """Removes the orgs and people that are no longer in LDAP from the DB.
+
+        Only the entryUUIDs of all LDAP entries are retrieved, so this is cheap
+        compared to a full sync.
+        """
+        logger.info("Reconciling deleted orgs and people")
+        ldap_uuids = self._search_ldap_uuids()
+        if self.snapshot is None:
+            removed = self.deewee_client.reconcile_ldap_uuids(
+                ldap_uuids, ENTITY_TYPES
+            )
+        else:
+            removed = self._reconcile_snapshot(ldap_uuids)
+        logger.info(
+            f"Removed ({self.deewee_client.delete_strategy}) {removed.get('org', 0)} "
+            f"org(s) and {removed.get('person', 0)} people no longer in LDAP"
+        )
+
+    def _search_ldap_uuids(self):
+        """Searches the entryUUIDs of all orgs and people, concurrently."""
+        return self.ldap_client.search_concurrently(
+            {
+                "org": self.ldap_client.search_orgs_uuids,
+                "person": self.ldap_client.search_people_uuids
+            },
+            max_queued_pages=self.max_queued_pages
+        )
+
+    @staticmethod
+    def _collect_ldap_uuids(ldap_uuids) -> dict:
+        """Returns the entryUUIDs (str) of the searched entries per type."""
+        uuids = {type: [] for type in ENTITY_TYPES}
+        for entries, type in ldap_uuids:
+            uuids[type].extend(str(entry.entryUUID) for entry in entries)
+        return uuids
+
+    def _reconcile_snapshot(self, ldap_uuids) -> dict:
+        """Determines the deleted LDAP entries by diffing with the snapshot.
+
+        Only the rows of the deleted entries are sent to the database.
+
+        Returns:
+            dict -- the amount of deleted or tombstoned rows per type
+        """
+        removed = {}
+        for type, type_uuids in self._collect_ldap_uuids(ldap_uuids).items():
+            deleted = self.snapshot.deleted(type, type_uuids)
+            if deleted:
+                removed[type] = self.deewee_client.remove_ldap_uuids(deleted)
+                self.snapshot.remove(deleted)
+        return removed
+
+    def _micro_batches(self, changes):
+        """Groups the changes into micro-batches.
+
+        A batch is yielded when it contains watch_batch_size changes or when
+        watch_flush_interval seconds passed since its first change.
+
+        Arguments:
+            changes -- iterable of changes, or None if no change arrived
+                       within the poll interval
+        """
+        batch = []
+        deadline = None
+        for change in changes:
+            if change is not None:
+                batch.append(change)
+                if deadline is None:
+                    deadline = time.monotonic() + self.watch_flush_interval
+            if batch and (
+                len(batch) >= self.watch_batch_size or time.monotonic() >= deadline
+            ):
+                yield batch
+                batch = []
+                deadline = None
+        if batch:
+            yield batch
+
+    def _apply_changes(self, changes: list):
+        """Upserts the added and modified entries and removes the deleted ones.
+
+        Arguments:
+            changes -- list of Tuple[LdapChange, str]. The type of a deletion
+                       that is only reported by entryUUID is None.
+        """
+        upserts = {"org": [], "person": []}
+        deleted = []
+        for change, type in changes:
+            if change.change_type == CHANGE_TYPE_DELETE:
+                deleted.append(change.entryUUID)
+            else:
+                upserts[type].append(change)
+        stats = self.deewee_client.upsert_ldap_results_many(
+            [(entries, type) for type, entries in upserts.items() if entries]
+        )
+        removed = 0
+        if deleted and self.deewee_client.delete_strategy != DELETE_STRATEGY_NONE:
+            removed = self.deewee_client.remove_ldap_uuids(deleted)
+            if self.snapshot is not None:
+                self.snapshot.remove(deleted)
+        if self.snapshot is not None:
+            self.snapshot.save([
+                (vars[0], vars[1], vars[3], vars[4])
+                for vars in (
+                    self.deewee_client._prepare_vars_upsert(change, type)
+                    for type, entries in upserts.items() for change in entries
+                )
+            ])
+        logger.info(
+            f"Applied {len(changes)} change(s): {stats.inserted} inserted, "
+            f"{stats.updated} updated, {stats.unchanged} unchanged, {removed} removed"
+        )
+
+    def watch(self):
+        """Continuously syncs the changes in LDAP to the PostgreSQL DB.
+
+        Subscribes to the changes via a sync search (syncrepl), then catches
+        up with the changes since the last sync. The changes are upserted in
+        micro-batches as they arrive. Runs until interrupted or until the
+        subscription ends. If the server cannot resume the subscription from
+        its cookie, it is started over.
+        """
+        try:
+            while True:
+                try:
+                    self._watch()
+                except LdapSyncRefreshRequired as e:
+                    logger.warning(f"{e}, subscribing again without cookie")
+                    self.deewee_client.save_cookie(None)
+        except (PSQLError, LDAPExceptionError) as e:
+            logger.error(e)
+            raise e
+        except KeyboardInterrupt:
+            logger.info("Stopped watching for changes")
+        finally:
+            self._close()
+
+    def _watch(self):
+        """Subscribes to the changes and applies them until the subscription ends.
+
+        The cookie of the subscription is saved after every micro-batch, so a
+        new subscription resumes after the applied changes.
+        """
+        cookie = self.deewee_client.cookie()
+        # Subscribe first, so the changes during the catch-up are not missed
+        subscription = self.ldap_client.watch(self.watch_flush_interval, cookie)
+        try:
+            modified_since = self.deewee_client.watermarks(ENTITY_TYPES)
+            logger.info("Catch up with the changes since the last sync")
+            self._sync(modified_since)
+            logger.info("Watching for changes")
+            for batch in self._micro_batches(subscription):
+                self._apply_changes(batch)
+                if subscription.cookie != cookie:
+                    cookie = subscription.cookie
+                    self.deewee_client.save_cookie(cookie)
+        finally:
+            subscription.close()
+
+    def rebuild(self):
+        """Rebuilds the PostgreSQL DB table from all LDAP entries.
+
+        The entries are loaded into a new table, which replaces the current
+        table at once. Deleted LDAP entries are not kept, also not as tombstones.
+        """
+        metrics.reset()
+        try:
+            logger.info("Start full rebuild")
+            with metrics.span("rebuild"):
+                ldap_results = self.ldap_client.search_concurrently(
+                    self._searches({}), max_queued_pages=self.max_queued_pages
+                )
+                count = self.deewee_client.rebuild_ldap_results(ldap_results)
+            if self.snapshot is not None:
+                self.snapshot.seed(self.deewee_client.snapshot_rows())
+        except (PSQLError, LDAPExceptionError) as e:
+            logger.error(e)
+            raise e
+        finally:
+            self._close()
+            self._export_metrics()
+        logger.info(f"Rebuild successful: {count} org(s) and people")
+
+    def plan(self) -> SyncPlan:
+        """Prints what a sync would change, without writing to the database.
+
+        Runs the same LDAP searches as a sync and compares the entries to the
+        snapshot, if it is seeded, or else to the database with read-only
+        queries. Counts the new, changed, unchanged and, if a delete_strategy
+        is configured, deleted entries per type and estimates the bytes
+        that would be written.
+        """
+        plan = SyncPlan()
+        try:
+            modified_since = self.deewee_client.watermarks(ENTITY_TYPES)
+            self._log_sync_start(modified_since)
+            use_snapshot = self.snapshot is not None and self.snapshot.seeded
+            if use_snapshot:
+                hashes = self.snapshot.hashes
+            else:
+                hashes = self.deewee_client.content_hashes
+            ldap_results = self.ldap_client.search_concurrently(
+                self._searches(modified_since), modified_since, self.max_queued_pages
+            )
+            for records, type in ldap_results:
+                records = list(records)
+                plan.add(
+                    records, type, hashes([record.ldap_uuid for record in records])
+                )
+            if self.deewee_client.delete_strategy != DELETE_STRATEGY_NONE:
+                uuids = self._collect_ldap_uuids(self._search_ldap_uuids())
+                for type, type_uuids in uuids.items():
+                    if use_snapshot:
+                        deleted = self.snapshot.deleted(type, type_uuids)
+                    else:
+                        deleted = anti_merge_join(
+                            self.deewee_client.live_ldap_uuids(type), sorted(type_uuids)
+                        )
+                    plan.counts(type).deleted = len(deleted)
+        except (PSQLError, LDAPExceptionError) as e:
+            logger.error(e)
+            raise e
+        finally:
+            self._close()
+        logger.info("Sync plan", plan=plan.as_dict())
+        print(plan.format())
+        return plan
+
+    def sync_sources(self):
+        """Syncs the sources of the sync section, in a pool of worker processes.
+
+        Every subtree of a source is synced by a worker process to its own
+        table, since its own watermark. The metrics of the workers are
+        merged, labeled with the source and the table. A failing subtree
+        does not stop the others, the first failure is raised at the end.
+        """
+        sync_params = config.config.get("sync") or {}
+        sources = parse_sources(sync_params, config.config["ldap"])
+        metrics.reset()
+        errors = []
+        try:
+            logger.info(
+                f"Start sync of {sum(len(source.subtrees) for source in sources)}"
+                f" subtree(s) of {len(sources)} source(s)"
+            )
+            with metrics.span("sync_sources"):
+                for source, subtree, future in run_sources(
+                    sources, config.config["postgresql"], sync_params.get("processes")
+                ):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(
+                            f"Sync of {subtree} of '{source.name}' failed: {e}"
+                        )
+                        errors.append(e)
+                        continue
+                    metrics.merge(
+                        result.spans, result.counters,
+                        source=source.name, table=subtree.table
+                    )
+                    logger.info(
+                        f"Synced {result.stats.total} {subtree} of '{source.name}': "
+                        f"{result.stats.inserted} inserted, {result.stats.updated} "
+                        f"updated, {result.stats.unchanged} unchanged"
+                        + (
+                            "" if result.removed is None
+                            else f", {result.removed} removed"
+                        )
+                    )
+            if errors:
+                raise errors[0]
+        finally:
+            self._close()
+            self._export_metrics()
+        logger.info("sync successful")
+
+    def _close(self):
+        self.deewee_client.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
+
+    def _export_metrics(self):
+        """Logs the metrics of the run and exports them if configured.
+
+        The metrics are written to a Prometheus textfile and/or pushed to a
+        Pushgateway. Failing to export them does not fail the sync.
+        """
+        logger.info("Sync metrics", metrics=metrics.as_dict())
+        textfile = self.metrics_params.get("textfile")
+        pushgateway = self.metrics_params.get("pushgateway")
         try:
-            modified_since = self.deewee_client.max_last_modified_timestamp()
-            if modified_since is None:
-                logger.info("Start full sync")
+            if textfile:
+                metrics.write_textfile(textfile)
+            if pushgateway:
+                job = self.metrics_params.get("job", METRICS_PREFIX)
+                metrics.push(pushgateway, job)
+        except OSError as e:
+            logger.warning(f"Could not export the metrics: {e}")
+
+    @staticmethod
+    def _log_sync_start(modified_since: dict):
+        for type, watermark in modified_since.items():
+            if watermark is None:
+                logger.info(f"Start full sync of type '{type}'")
             else:
                 logger.info(
-                    f"Start sync of difference since last sync - {modified_since.isoformat()}"
+                    f"Start sync of type '{type}' of difference since last sync"
+                    f" - {watermark.isoformat()}"
                 )
-            self._sync(modified_since)
+
+    def main(self):
+        metrics.reset()
+        try:
+            # Every type resumes from its own watermark
+            modified_since = self.deewee_client.watermarks(ENTITY_TYPES)
+            self._log_sync_start(modified_since)
+            with metrics.span("sync"):
+                self._sync(modified_since)
         except (PSQLError, LDAPExceptionError) as e:
             logger.error(e)
             raise e
+        finally:
+            self._close()
+            self._export_metrics()
+        logger.info("sync successful")
+
+
+class AsyncApp(App):
+    """Variant of the App which syncs on an asyncio event loop.
+
+    The LDAP page fetches, the transformation and the database writes
+    overlap: the searches run on their own threads, the pages are transformed
+    in the default executor and the batches are COPYed via asyncpg while the
+    next page is transformed. Requires asyncpg.
+    The watch and rebuild modes are the same as those of the App.
+    """
+
+    ldap_client_class = AsyncLdapClient
+    deewee_client_class = AsyncDeeweeClient
+
+    async def _sync_async(self, modified_since: dict = None):
+        """Same as App._sync, but upserts on the event loop.
+
+        The reconciliation of the deletes is run in the default executor.
+        """
+        modified_since = modified_since or {}
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._seed_snapshot)
+        last_modified = await loop.run_in_executor(
+            None, self._last_modified, modified_since
+        )
+        searches = self._searches(modified_since, last_modified)
+
+        logger.info(f"Searching for orgs and people in {len(searches)} search(es)")
+        ldap_results = self.ldap_client.search_concurrently_async(
+            searches, modified_since, self.max_queued_pages
+        )
+
+        snapshot_rows = []
+        upserted_results = ldap_results
+        if self.snapshot is not None:
+            upserted_results = self._diff_snapshot_async(ldap_results, snapshot_rows)
+        try:
+            stats = await self.deewee_client.upsert_ldap_results_many_async(
+                upserted_results
+            )
+        finally:
+            # Stop the searches right away if the upsert failed
+            await ldap_results.aclose()
+        logger.info(
+            f"Synced {stats.total} org(s) and people: {stats.inserted} inserted, "
+            f"{stats.updated} updated, {stats.unchanged} unchanged"
+        )
+        if self.snapshot is not None:
+            await loop.run_in_executor(None, self.snapshot.save, snapshot_rows)
+
+        if self.deewee_client.delete_strategy != DELETE_STRATEGY_NONE:
+            await loop.run_in_executor(None, self._reconcile)
+
+    async def _diff_snapshot_async(self, ldap_results, snapshot_rows: list):
+        """Same as App._diff_snapshot, looking up the pages in the executor."""
+        loop = asyncio.get_event_loop()
+        async for records, type in ldap_results:
+            yield await loop.run_in_executor(
+                None, self.snapshot.changed, records, type, snapshot_rows
+            ), type
+
+    async def main_async(self):
+        metrics.reset()
+        loop = asyncio.get_event_loop()
+        try:
+            modified_since = await loop.run_in_executor(
+                None, self.deewee_client.watermarks, ENTITY_TYPES
+            )
+            self._log_sync_start(modified_since)
+            with metrics.span("sync"):
+                await self._sync_async(modified_since)
+        except (PSQLError, AsyncPSQLError, LDAPExceptionError) as e:
+            logger.error(e)
+            raise e
+        finally:
+            await self.deewee_client.close_async()
+            if self.snapshot is not None:
+                self.snapshot.close()
+            self._export_metrics()
         logger.info("sync successful")
 
+    def main(self):
+        asyncio.run(self.main_async())
+
 
 if __name__ == "__main__":
-    App().main()
+    parser = argparse.ArgumentParser(description="Syncs LDAP to the PostgreSQL DB.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and sync the changes in LDAP as they happen"
+    )
+    mode.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="replace the table by a new table loaded with all LDAP entries"
+    )
+    mode.add_argument(
+        "--dry-run",
+        "--plan",
+        dest="dry_run",
+        action="store_true",
+        help="print the changes a sync would make, with an estimate of the bytes"
+             " to write, without writing to the database"
+    )
+    mode.add_argument(
+        "--sources",
+        action="store_true",
+        help="sync the subtrees of the sources of the sync section, in a pool"
+             " of worker processes"
+    )
+    mode.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="sync on an asyncio event loop, overlapping the LDAP searches,"
+             " the transformation and the database writes (requires asyncpg)"
+    )
+    args = parser.parse_args()
+    if args.dry_run:
+        App().plan()
+    elif args.sources:
+        App().sync_sources()
+    elif args.asyncio:
+        AsyncApp().main()
+    elif args.watch:
+        App().watch()
+    elif args.rebuild:
+        App().rebuild()
+    else:
+        App().main()
@@ -1,42 +1,440 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import csv
+import hashlib
+import io
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+import re
+import threading
+import time
 import uuid
+from dataclasses import dataclass
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
+from ldap3.protocol.formatters.formatters import format_time
+from psycopg2.sql import SQL, Identifier
+
+from app.metrics import metrics
+from app.serialization import EntityRecord, serialize_entry
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg is only needed by the asyncio engine
+    asyncpg = None
 
 
 TABLE_NAME = 'entities'
-UPSERT_ENTITIES_SQL = f'''INSERT INTO {TABLE_NAME} (ldap_uuid,
+STAGING_TABLE_NAME = f'{TABLE_NAME}_staging'
+INSERT_ENTITIES_SQL = f'''INSERT INTO {TABLE_NAME} (ldap_uuid,
                           type,
                           content,
-                          last_modified_timestamp)
-VALUES (%s, %s, %s, %s) ON CONFLICT (ldap_uuid) DO
+                          content_hash,
+                          last_modified_timestamp)'''
+# Rows of which the content did not change are not written at all,
+# unless they were tombstoned and reappeared in LDAP
+ON_CONFLICT_ENTITIES_SQL = f'''ON CONFLICT (ldap_uuid) DO
 UPDATE
 SET content = EXCLUDED.content,
-    last_modified_timestamp = EXCLUDED.last_modified_timestamp;'''
-TRUNCATE_ENTITIES_SQL = f'TRUNCATE TABLE {TABLE_NAME};'
+    content_hash = EXCLUDED.content_hash,
+    last_modified_timestamp = EXCLUDED.last_modified_timestamp,
+    deleted_timestamp = NULL
+WHERE {TABLE_NAME}.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+    OR {TABLE_NAME}.deleted_timestamp IS NOT NULL'''
+UPSERT_ENTITIES_SQL = f'''{INSERT_ENTITIES_SQL}
+VALUES (%s, %s, %s, %s, %s) {ON_CONFLICT_ENTITIES_SQL};'''
+
+
+def _count_upserted_sql(upsert_sql: str) -> str:
+    """Wraps the upsert statement to count the inserted and updated rows.
+
+    Returns rows of (inserted: bool, count: int). xmax is 0 for inserted rows.
+    Rows that were left unchanged are not returned.
+    """
+    return f'''WITH upserted AS (
+{upsert_sql}
+RETURNING (xmax = 0) AS inserted
+)
+SELECT inserted, count(*) FROM upserted GROUP BY inserted;'''
+
+
+# The single %s placeholder is expanded by psycopg2.extras.execute_values
+UPSERT_ENTITIES_VALUES_SQL = _count_upserted_sql(
+    f'''{INSERT_ENTITIES_SQL}
+VALUES %s {ON_CONFLICT_ENTITIES_SQL}'''
+)
+# The timestamp is staged with its time zone, so it is converted to the
+# target column exactly like the parameters of the 'values' strategy.
+# The serial column records the load order to deduplicate on.
+CREATE_STAGING_TABLE_SQL = f'''CREATE TEMPORARY TABLE {STAGING_TABLE_NAME} (
+    staging_id bigserial,
+    ldap_uuid UUID,
+    type VARCHAR,
+    content JSONB,
+    content_hash CHAR(32),
+    last_modified_timestamp timestamptz
+) ON COMMIT DROP;'''
+STAGING_COLUMNS = (
+    'ldap_uuid', 'type', 'content', 'content_hash', 'last_modified_timestamp'
+)
+COPY_STAGING_SQL = f'''COPY {STAGING_TABLE_NAME} (ldap_uuid,
+                          type,
+                          content,
+                          content_hash,
+                          last_modified_timestamp)
+FROM STDIN WITH (FORMAT csv);'''
+# An upsert statement cannot affect the same row twice: only the last loaded
+# version of an LDAP entry is merged
+MERGE_STAGING_SQL = _count_upserted_sql(
+    f'''{INSERT_ENTITIES_SQL}
+SELECT DISTINCT ON (ldap_uuid) ldap_uuid, type, content, content_hash,
+                               last_modified_timestamp
+FROM {STAGING_TABLE_NAME}
+ORDER BY ldap_uuid, staging_id DESC {ON_CONFLICT_ENTITIES_SQL}'''
+)
+LDAP_UUIDS_TABLE_NAME = f'{TABLE_NAME}_ldap_uuids'
+CREATE_LDAP_UUIDS_TABLE_SQL = f'''CREATE TEMPORARY TABLE {LDAP_UUIDS_TABLE_NAME} (
+    ldap_uuid UUID,
+    type VARCHAR
+) ON COMMIT DROP;'''
+COPY_LDAP_UUIDS_SQL = f'''COPY {LDAP_UUIDS_TABLE_NAME} (ldap_uuid, type)
+FROM STDIN WITH (FORMAT csv);'''
+# Rows of the reconciled types of which the UUID is no longer in LDAP.
+# The single %s placeholder is the list of reconciled types.
+ORPHANS_WHERE_SQL = f'''{TABLE_NAME}.type = ANY(%s)
+AND NOT EXISTS (
+    SELECT 1 FROM {LDAP_UUIDS_TABLE_NAME}
+    WHERE {LDAP_UUIDS_TABLE_NAME}.ldap_uuid = {TABLE_NAME}.ldap_uuid
+)'''
+DELETE_ORPHANS_SQL = f'''WITH deleted AS (
+DELETE FROM {TABLE_NAME}
+WHERE {ORPHANS_WHERE_SQL}
+RETURNING type
+)
+SELECT type, count(*) FROM deleted GROUP BY type;'''
+TOMBSTONE_ORPHANS_SQL = f'''WITH tombstoned AS (
+UPDATE {TABLE_NAME}
+SET deleted_timestamp = now()
+WHERE {TABLE_NAME}.deleted_timestamp IS NULL
+AND {ORPHANS_WHERE_SQL}
+RETURNING type
+)
+SELECT type, count(*) FROM tombstoned GROUP BY type;'''
+DELETE_ENTITIES_SQL = f'''DELETE FROM {TABLE_NAME}
+WHERE ldap_uuid = ANY(%s::uuid[])
+RETURNING type;'''
+TOMBSTONE_ENTITIES_SQL = f'''UPDATE {TABLE_NAME}
+SET deleted_timestamp = now()
+WHERE ldap_uuid = ANY(%s::uuid[]) AND deleted_timestamp IS NULL
+RETURNING type;'''
+# The modify timestamps of the live rows, to skip unchanged LDAP entries.
+# The column holds the local time of the session time zone in which it was
+# written, so it is read back as timestamptz to compare it to LDAP timestamps.
+SELECT_LAST_MODIFIED_SQL = f'''SELECT ldap_uuid::text,
+    last_modified_timestamp::timestamptz
+FROM {TABLE_NAME}
+WHERE type = %s AND deleted_timestamp IS NULL'''
+SELECT_LAST_MODIFIED_TYPE_SQL = f'{SELECT_LAST_MODIFIED_SQL};'
+SELECT_LAST_MODIFIED_SINCE_SQL = f'''{SELECT_LAST_MODIFIED_SQL}
+    AND last_modified_timestamp > %s;'''
+# The hash of a tombstoned row is NULL, as its LDAP entry would restore it
+SELECT_CONTENT_HASHES_SQL = f'''SELECT ldap_uuid::text,
+    CASE WHEN deleted_timestamp IS NULL THEN content_hash END
+FROM {TABLE_NAME}
+WHERE ldap_uuid = ANY(%s::uuid[]);'''
+# Ordered by code point, like the sorted entryUUIDs in Python
+SELECT_LIVE_UUIDS_TYPE_SQL = f'''SELECT ldap_uuid::text
+FROM {TABLE_NAME}
+WHERE type = %s AND deleted_timestamp IS NULL
+ORDER BY ldap_uuid::text COLLATE "C";'''
+SELECT_SNAPSHOT_SQL = f'''SELECT ldap_uuid::text, type, content_hash,
+    last_modified_timestamp
+FROM {TABLE_NAME}
+WHERE deleted_timestamp IS NULL;'''
+SYNC_STATE_TABLE_NAME = 'sync_state'
+# The watermark only moves forward, also if an older entry is synced later
+INSERT_SYNC_STATE_SQL = f'''INSERT INTO {SYNC_STATE_TABLE_NAME} (type,
+                          last_modified_timestamp)'''
+ON_CONFLICT_SYNC_STATE_SQL = f'''ON CONFLICT (type) DO
+UPDATE
+SET last_modified_timestamp = GREATEST(
+        {SYNC_STATE_TABLE_NAME}.last_modified_timestamp,
+        EXCLUDED.last_modified_timestamp
+    ),
+    updated_timestamp = now();'''
+UPSERT_SYNC_STATE_SQL = f'''{INSERT_SYNC_STATE_SQL}
+VALUES %s
+{ON_CONFLICT_SYNC_STATE_SQL}'''
+# asyncpg uses numbered placeholders, the rows are passed via executemany.
+# asyncpg only binds time zone aware datetimes to timestamptz, which is then
+# converted to the column in the session time zone, like psycopg2 does.
+UPSERT_SYNC_STATE_ASYNC_SQL = f'''{INSERT_SYNC_STATE_SQL}
+VALUES ($1, $2::timestamptz)
+{ON_CONFLICT_SYNC_STATE_SQL}'''
+SELECT_SYNC_STATE_SQL = f'''SELECT type, last_modified_timestamp
+FROM {SYNC_STATE_TABLE_NAME} WHERE type = ANY(%s);'''
+MAX_LAST_MODIFIED_TIMESTAMP_TYPE_SQL = f'''SELECT max(last_modified_timestamp)
+FROM {TABLE_NAME} WHERE type = %s;'''
+DELETE_SYNC_STATE_SQL = f'DELETE FROM {SYNC_STATE_TABLE_NAME} WHERE type = ANY(%s);'
+# The cookie of the subscription to the LDAP changes (RFC 4533) is kept in
+# the sync_state row of this type
+SYNC_STATE_COOKIE_TYPE = 'syncrepl'
+SELECT_COOKIE_SQL = f'SELECT cookie FROM {SYNC_STATE_TABLE_NAME} WHERE type = %s;'
+UPSERT_COOKIE_SQL = f'''INSERT INTO {SYNC_STATE_TABLE_NAME} (type, cookie)
+VALUES (%s, %s)
+ON CONFLICT (type) DO
+UPDATE
+SET cookie = EXCLUDED.cookie,
+    updated_timestamp = now();'''
+# A full rebuild loads into a new, unlogged table which replaces the table
+# The names in the statements that are replaced for another target table.
+# The sync state of another table is kept in the table {table}_sync_state.
+TABLE_NAMES_PATTERN = re.compile(rf'\b({TABLE_NAME}|{SYNC_STATE_TABLE_NAME})')
+TABLE_NAME_PATTERN = re.compile(r'[a-z_][a-z0-9_]*')
+REBUILD_TABLE_NAME = f'{TABLE_NAME}_rebuild'
+# Suffix of the indexes and constraints of the new table until the swap
+REBUILD_SUFFIX = '_rebuild'
+CREATE_REBUILD_TABLE_SQL = f'''DROP TABLE IF EXISTS {REBUILD_TABLE_NAME};
+CREATE UNLOGGED TABLE {REBUILD_TABLE_NAME} (
+    LIKE {TABLE_NAME} INCLUDING DEFAULTS INCLUDING COMMENTS
+);
+{CREATE_STAGING_TABLE_SQL}'''
+INSERT_REBUILD_SQL = f'''WITH inserted AS (
+INSERT INTO {REBUILD_TABLE_NAME} (ldap_uuid,
+                          type,
+                          content,
+                          content_hash,
+                          last_modified_timestamp)
+SELECT DISTINCT ON (ldap_uuid) ldap_uuid, type, content, content_hash,
+                               last_modified_timestamp
+FROM {STAGING_TABLE_NAME}
+ORDER BY ldap_uuid, staging_id DESC
+RETURNING 1
+)
+SELECT count(*) FROM inserted;'''
+SET_LOGGED_REBUILD_SQL = f'ALTER TABLE {REBUILD_TABLE_NAME} SET LOGGED;'
+# Constraints (e.g. the primary key) and the other indexes of the table
+SELECT_CONSTRAINTS_SQL = f'''SELECT conname, pg_get_constraintdef(oid)
+FROM pg_constraint
+WHERE conrelid = '{TABLE_NAME}'::regclass AND contype IN ('p', 'u', 'x', 'c', 'f');'''
+SELECT_INDEXES_SQL = f'''SELECT index.relname, pg_get_indexdef(index.oid)
+FROM pg_index
+JOIN pg_class index ON index.oid = pg_index.indexrelid
+WHERE pg_index.indrelid = '{TABLE_NAME}'::regclass
+AND NOT EXISTS (
+    SELECT 1 FROM pg_constraint WHERE pg_constraint.conindid = pg_index.indexrelid
+);'''
+SELECT_SERIAL_SEQUENCE_SQL = f"SELECT pg_get_serial_sequence('{TABLE_NAME}', 'id');"
+# The triggers, the privileges granted to other roles (PUBLIC as NULL grantee),
+# the owner and the comment of the table, which a new table does not inherit
+SELECT_TRIGGERS_SQL = f'''SELECT tgname, pg_get_triggerdef(oid)
+FROM pg_trigger
+WHERE tgrelid = '{TABLE_NAME}'::regclass AND NOT tgisinternal;'''
+SELECT_GRANTS_SQL = f'''SELECT
+    CASE WHEN acl.grantee <> 0 THEN pg_get_userbyid(acl.grantee) END,
+    acl.privilege_type,
+    acl.is_grantable
+FROM pg_class, aclexplode(pg_class.relacl) AS acl
+WHERE pg_class.oid = '{TABLE_NAME}'::regclass AND acl.grantee <> pg_class.relowner;'''
+SELECT_OWNER_COMMENT_SQL = f'''SELECT pg_get_userbyid(relowner),
+    obj_description(oid, 'pg_class')
+FROM pg_class WHERE oid = '{TABLE_NAME}'::regclass;'''
+TRUNCATE_ENTITIES_SQL = f'TRUNCATE TABLE {TABLE_NAME}, {SYNC_STATE_TABLE_NAME};'
 COUNT_ENTITIES_SQL = f'SELECT COUNT(*) FROM {TABLE_NAME}'
-MAX_LAST_MODIFIED_TIMESTAMP_SQL = f'SELECT max(last_modified_timestamp) FROM {TABLE_NAME}'
+# Walks the distinct types via the (type, last_modified_timestamp) index and
+# looks up the highest timestamp per type, instead of scanning the whole table
+MAX_LAST_MODIFIED_TIMESTAMP_SQL = f'''WITH RECURSIVE types AS (
+    (SELECT type FROM {TABLE_NAME} WHERE type IS NOT NULL ORDER BY type LIMIT 1)
+    UNION ALL
+    SELECT (SELECT type FROM {TABLE_NAME} WHERE type > types.type ORDER BY type LIMIT 1)
+    FROM types
+    WHERE types.type IS NOT NULL
+)
+SELECT max(last_modified_timestamp) FROM (
+    SELECT (SELECT max(last_modified_timestamp) FROM {TABLE_NAME}
+            WHERE {TABLE_NAME}.type = types.type) AS last_modified_timestamp
+    FROM types
+    WHERE types.type IS NOT NULL
+) AS max_per_type;'''
+HEALTH_CHECK_SQL = 'SELECT 1;'
+DEFAULT_POOL_MIN_SIZE = 1
+DEFAULT_POOL_SIZE = 4
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PAGE_SIZE = 1000
+# Batches taking longer than this are halved when the batch size is adaptive
+DEFAULT_TARGET_BATCH_SECONDS = 1.0
+DEFAULT_MAX_BATCH_BYTES = 16 * 1024 * 1024
+UPSERT_STRATEGY_VALUES = 'values'
+UPSERT_STRATEGY_COPY = 'copy'
+UPSERT_STRATEGIES = (UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY)
+DELETE_STRATEGY_NONE = 'none'
+DELETE_STRATEGY_DELETE = 'delete'
+DELETE_STRATEGY_TOMBSTONE = 'tombstone'
+DELETE_STRATEGIES = (
+    DELETE_STRATEGY_NONE, DELETE_STRATEGY_DELETE, DELETE_STRATEGY_TOMBSTONE
+)
+COMMIT_MODE_TRANSACTION = 'transaction'
+COMMIT_MODE_BATCH = 'batch'
+COMMIT_MODES = (COMMIT_MODE_TRANSACTION, COMMIT_MODE_BATCH)
+DEFAULT_RETRIES = 3
+# Seconds to wait before the first retry, doubled for every next retry
+DEFAULT_RETRY_BACKOFF = 1.0
+# Errors of which the statement can succeed on a new connection (e.g. a failover)
+RETRYABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+@dataclass
+class UpsertStats:
+    """The amount of inserted, updated and unchanged rows of an upsert"""
+
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.inserted + self.updated + self.unchanged
+
+
+@dataclass
+class BatchSizer:
+    """Adapts the batch size to the measured duration of the batches.
+
+    The size is increased additively (by min_size) as long as the batches
+    take at most target_seconds and is halved when a batch takes longer
+    (AIMD), within min_size and max_size. Both default to the initial size,
+    which fixes the size. Regardless of the size, a batch is cut once its content
+    reaches max_bytes, so large entries cannot blow up the memory usage.
+    """
+
+    size: int = DEFAULT_BATCH_SIZE
+    min_size: int = None
+    max_size: int = None
+    target_seconds: float = DEFAULT_TARGET_BATCH_SECONDS
+    max_bytes: int = DEFAULT_MAX_BATCH_BYTES
+
+    def __post_init__(self):
+        if self.min_size is None:
+            self.min_size = self.size
+        if self.max_size is None:
+            self.max_size = self.size
+        if not 0 < self.min_size <= self.max_size:
+            raise ValueError(
+                f"Invalid batch size range [{self.min_size}, {self.max_size}]"
+            )
+        self.size = min(max(self.size, self.min_size), self.max_size)
+
+    def update(self, seconds: float):
+        """Adapts the size to the duration of the last batch."""
+        if seconds > self.target_seconds:
+            self.size = max(self.size // 2, self.min_size)
+        else:
+            self.size = min(self.size + self.min_size, self.max_size)
+
+
+def content_hash(content: str) -> str:
+    """Returns the digest of the content, to detect unchanged content cheaply"""
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
 
 
 class PostgresqlWrapper:
-    """Allows for executing SQL statements to a postgresql database"""
+    """Allows for executing SQL statements to a postgresql database.
 
-    def __init__(self, params: dict):
+    Holds a pool of persistent connections which are lent to the statements.
+    The pool is only created when the first statement is executed.
+    """
+
+    def __init__(self, params: dict, pool_min_size: int = DEFAULT_POOL_MIN_SIZE,
+                 pool_size: int = DEFAULT_POOL_SIZE):
         self.params_postgresql = params
+        self.pool_min_size = pool_min_size
+        self.pool_size = pool_size
+        self.pool = None
+        self._pool_lock = threading.Lock()
+        # IDs of the connections that went back to the pool and thus
+        # need to be checked before being lent again
+        self._returned_connections = set()
+
+    def _get_pool(self) -> psycopg2.pool.ThreadedConnectionPool:
+        with self._pool_lock:
+            if self.pool is None:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.pool_min_size, self.pool_size, **self.params_postgresql
+                )
+            return self.pool
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        """Checks if the connection is still usable, e.g. after a server restart."""
+        if conn.closed:
+            return False
+        try:
+            # Autocommit, so the check does not leave a transaction open
+            conn.autocommit = True
+            with conn.cursor() as curs:
+                curs.execute(HEALTH_CHECK_SQL)
+            conn.autocommit = False
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _getconn(self):
+        """Lends a connection from the pool.
+
+        Connections that have been in the pool before are health checked.
+        Broken connections are discarded and replaced by the next idle
+        connection or a new connection.
+        """
+        pool = self._get_pool()
+        conn = pool.getconn()
+        # After a server restart all idle connections can be broken, so keep
+        # checking until a healthy or a new connection is obtained
+        while id(conn) in self._returned_connections:
+            self._returned_connections.discard(id(conn))
+            if self._is_healthy(conn):
+                break
+            pool.putconn(conn, close=True)
+            metrics.increment('db_reconnects')
+            conn = pool.getconn()
+        return conn
+
+    def _putconn(self, conn):
+        """Returns the connection to the pool. Closed connections are discarded."""
+        close = bool(conn.closed)
+        if not close:
+            self._returned_connections.add(id(conn))
+        self._get_pool().putconn(conn, close=close)
+
+    def close(self):
+        """Closes all the connections of the pool."""
+        with self._pool_lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+            self._returned_connections.clear()
 
     def _connect_curs_postgresql(function):
-        """Wrapper function that connects and authenticates to the PostgreSQL DB.
+        """Wrapper function that lends a connection from the pool.
 
-        The passed function will receive the open cursor.
+        The passed function will receive the open cursor. The statements of
+        the function are executed in one transaction.
         """
         @wraps(function)
         def wrapper_connect(self, *args, **kwargs):
-            with psycopg2.connect(**self.params_postgresql) as conn:
-                with conn.cursor() as curs:
-                    val = function(self, cursor=curs, *args, **kwargs)
+            conn = self._getconn()
+            try:
+                with conn:
+                    with conn.cursor() as curs:
+                        val = function(self, cursor=curs, *args, **kwargs)
+                    # Commit explicitly, to time it. Leaving the block commits
+                    # the then empty transaction again, which is a no-op.
+                    with metrics.span('db_commit'):
+                        conn.commit()
+            finally:
+                self._putconn(conn)
             return val
         return wrapper_connect
 
@@ -55,58 +453,697 @@ class PostgresqlWrapper:
         """Connects to the postgresql DB and executes the many statement"""
         cursor.executemany(query, vars_list)
 
+    @_connect_curs_postgresql
+    def execute_values_batches(self, query: str, vars_batches, page_size: int = 100,
+                               fetch: bool = False, finalize=None, observe=None,
+                               cursor=None) -> tuple:
+        """Connects to the postgresql DB and executes the statement per batch.
+
+        Uses psycopg2.extras.execute_values, which sends the parameters as one
+        multi-row VALUES list per page instead of one statement per row.
+        All batches are executed in one transaction. The batches are consumed
+        lazily, so only one batch needs to be held in memory at a time.
+
+        Arguments:
+            query -- statement containing a single '%s' placeholder for the VALUES
+            vars_batches -- iterable of lists of parameters
+            page_size -- the maximum amount of rows per statement
+            fetch -- whether to fetch the rows returned by the statements
+            finalize -- function that is called with the cursor after the
+                        batches, to execute statements in the same transaction
+            observe -- function that is called with the duration in seconds
+                       of every batch, e.g. BatchSizer.update
+
+        Returns:
+            Tuple[int, list] -- the amount of parameters that have been executed
+                                and the fetched rows
+        """
+        count = 0
+        rows = []
+        for vars_list in vars_batches:
+            start = time.perf_counter()
+            with metrics.span('db_upsert'):
+                rows.extend(
+                    psycopg2.extras.execute_values(
+                        cursor, query, vars_list, page_size=page_size, fetch=fetch
+                    ) or []
+                )
+            if observe is not None:
+                observe(time.perf_counter() - start)
+            count += len(vars_list)
+            metrics.increment('batches')
+        if finalize is not None:
+            with metrics.span('db_finalize'):
+                finalize(cursor)
+        return count, rows
+
+    @_connect_curs_postgresql
+    def copy_merge_batches(self, create_sql: str, copy_sql: str, merge_sql: str,
+                           vars_batches, merge_vars=None, finalize=None,
+                           observe=None, cursor=None) -> tuple:
+        """Connects to the postgresql DB and bulk loads the batches via a staging table.
+
+        Creates the staging table, COPYs every batch as CSV into it and
+        finally executes the merge statement. Everything is executed in
+        one transaction.
+
+        Arguments:
+            create_sql -- statement that creates the (temporary) staging table
+            copy_sql -- 'COPY ... FROM STDIN WITH (FORMAT csv)' statement
+            merge_sql -- statement that merges the staging table into the target
+            vars_batches -- iterable of lists of parameters
+            merge_vars -- the parameters of the merge statement, if any
+            finalize -- function that is called with the cursor after the
+                        merge, to execute statements in the same transaction
+            observe -- function that is called with the duration in seconds
+                       of every batch, e.g. BatchSizer.update
+
+        Returns:
+            Tuple[int, list] -- the amount of parameters that have been loaded
+                                and the rows returned by the merge statement
+        """
+        cursor.execute(create_sql)
+        count = 0
+        for vars_list in vars_batches:
+            start = time.perf_counter()
+            with metrics.span('db_copy'):
+                buffer = io.StringIO()
+                csv.writer(buffer, lineterminator='\n').writerows(vars_list)
+                buffer.seek(0)
+                cursor.copy_expert(copy_sql, buffer)
+            if observe is not None:
+                observe(time.perf_counter() - start)
+            count += len(vars_list)
+            metrics.increment('batches')
+        with metrics.span('db_merge'):
+            cursor.execute(merge_sql, merge_vars)
+            rows = cursor.fetchall() if cursor.description is not None else []
+        if finalize is not None:
+            with metrics.span('db_finalize'):
+                finalize(cursor)
+        return count, rows
+
+    @staticmethod
+    def _retry(function, retries: int, backoff: float):
+        """Calls the function, retrying it with exponential backoff.
+
+        Only connection errors (RETRYABLE_ERRORS) are retried.
+
+        Broken connections are discarded by the pool, so a retry gets a new one.
+        """
+        attempt = 0
+        while True:
+            try:
+                return function()
+            except RETRYABLE_ERRORS:
+                if attempt >= retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+                attempt += 1
+                metrics.increment('db_retries')
+
+    def commit_batches(self, execute, vars_batches, retries: int = DEFAULT_RETRIES,
+                       backoff: float = DEFAULT_RETRY_BACKOFF) -> tuple:
+        """Executes every batch in its own transaction, retrying failed batches.
+
+        A batch that fails on a connection error is retried up to retries
+        times, waiting backoff seconds before the first retry and twice as
+        long before every next one. The batches that have been committed
+        stay committed and the batches are only consumed once, so the sync
+        resumes from the failed batch instead of starting over.
+
+        Arguments:
+            execute -- function that executes a list of batches in one
+                       transaction and returns Tuple[int, list], e.g. a
+                       partial of execute_values_batches
+            vars_batches -- iterable of lists of parameters
+
+        Returns:
+            Tuple[int, list] -- the amount of parameters that have been
+                                committed and the rows returned by execute
+        """
+        count = 0
+        rows = []
+        for vars_list in vars_batches:
+            batch_count, batch_rows = self._retry(
+                partial(execute, [vars_list]), retries, backoff
+            )
+            count += batch_count
+            rows.extend(batch_rows)
+            metrics.increment('batches_committed')
+        return count, rows
+
 
 class DeeweeClient:
     """Acts as a client to query and modify information from and to DEEWEE"""
 
     def __init__(self, params: dict):
-        self.postgresql_wrapper = PostgresqlWrapper(params)
+        # Separate the sync options from the connection parameters
+        params = dict(params)
+        self.batch_size = params.pop('batch_size', DEFAULT_BATCH_SIZE)
+        # The batch size adapts within the range, if configured
+        self.batch_sizer = BatchSizer(
+            self.batch_size,
+            params.pop('min_batch_size', None),
+            params.pop('max_batch_size', None),
+            params.pop('target_batch_seconds', DEFAULT_TARGET_BATCH_SECONDS),
+            params.pop('max_batch_bytes', DEFAULT_MAX_BATCH_BYTES)
+        )
+        # Maximum amount of LDAP pages that are buffered for the upserts
+        self.max_queued_pages = params.pop('max_queued_pages', None)
+        self.page_size = params.pop('page_size', DEFAULT_PAGE_SIZE)
+        self.upsert_strategy = params.pop('upsert_strategy', UPSERT_STRATEGY_VALUES)
+        pool_min_size = params.pop('pool_min_size', DEFAULT_POOL_MIN_SIZE)
+        pool_size = params.pop('pool_size', DEFAULT_POOL_SIZE)
+        self.delete_strategy = params.pop('delete_strategy', DELETE_STRATEGY_NONE)
+        self.commit_mode = params.pop('commit_mode', COMMIT_MODE_TRANSACTION)
+        self.retries = params.pop('retries', DEFAULT_RETRIES)
+        self.retry_backoff = params.pop('retry_backoff', DEFAULT_RETRY_BACKOFF)
+        # Skip the LDAP entries of which the stored modify timestamp is equal
+        self.dirty_check = params.pop('dirty_check', False)
+        self.table = params.pop('table', TABLE_NAME)
+        if not TABLE_NAME_PATTERN.fullmatch(self.table):
+            raise ValueError(f"Invalid table '{self.table}'")
+        if self.upsert_strategy not in UPSERT_STRATEGIES:
+            raise ValueError(
+                f"Unknown upsert_strategy '{self.upsert_strategy}', "
+                f"expected one of {UPSERT_STRATEGIES}"
+            )
+        if self.delete_strategy not in DELETE_STRATEGIES:
+            raise ValueError(
+                f"Unknown delete_strategy '{self.delete_strategy}', "
+                f"expected one of {DELETE_STRATEGIES}"
+            )
+        if self.commit_mode not in COMMIT_MODES:
+            raise ValueError(
+                f"Unknown commit_mode '{self.commit_mode}', "
+                f"expected one of {COMMIT_MODES}"
+            )
+        self.postgresql_wrapper = PostgresqlWrapper(params, pool_min_size, pool_size)
+
+    def _sql(self, sql: str) -> str:
+        """Returns the statement for the target table of the client.
+
+        The tables derived from the table (e.g. the staging table) are
+        renamed along.
+        """
+        if self.table == TABLE_NAME:
+            return sql
+        return TABLE_NAMES_PATTERN.sub(
+            lambda match: (
+                self.table if match.group(1) == TABLE_NAME
+                else f'{self.table}_{SYNC_STATE_TABLE_NAME}'
+            ),
+            sql
+        )
 
     def _prepare_vars_upsert(self, ldap_result, type: str) -> tuple:
         """Transforms an LDAP entry to pass to the psycopg2 execute function.
 
         Transform it to a tuple containing the parameters to be able to upsert.
+        An EntityRecord is already serialized, so only its hash is computed.
         """
+        if isinstance(ldap_result, EntityRecord):
+            return (
+                ldap_result.ldap_uuid,
+                type,
+                ldap_result.content,
+                content_hash(ldap_result.content),
+                ldap_result.last_modified_timestamp
+            )
+        modify_timestamp = ldap_result.modifyTimestamp.value
+        # Without the LDAP schema the timestamp is not converted to a datetime
+        if isinstance(modify_timestamp, str):
+            modify_timestamp = format_time(modify_timestamp.encode())
+        content = serialize_entry(
+            ldap_result.entry_dn, ldap_result.entry_attributes_as_dict
+        )
         return (
             str(ldap_result.entryUUID),
             type,
-            ldap_result.entry_to_json(),
-            ldap_result.modifyTimestamp.value
+            content,
+            content_hash(content),
+            modify_timestamp
         )
 
-    def upsert_ldap_results_many(self, ldap_results: list):
+    def _transform_entry(self, ldap_result, type: str, watermarks: dict = None):
+        """Transforms an LDAP entry and records the metrics and watermark.
+
+        Returns:
+            Tuple[tuple, int] -- the parameters and the size of the content
+        """
+        with metrics.span('transform'):
+            vars = self._prepare_vars_upsert(ldap_result, type)
+        content_bytes = len(vars[2].encode('utf-8'))
+        metrics.increment('entries', type=type)
+        metrics.increment('content_bytes', content_bytes)
+        if watermarks is not None and vars[4] is not None:
+            if type not in watermarks or vars[4] > watermarks[type]:
+                watermarks[type] = vars[4]
+        return vars, content_bytes
+
+    def _batch_vars_upsert(self, ldap_results, watermarks: dict = None):
+        """Transforms the LDAP entries and groups them into batches.
+
+        The LDAP entries are consumed lazily. Yields lists containing at most
+        as many parameter tuples as the current size of the batch sizer, or
+        fewer if their content reaches its max_bytes.
+
+        A batch is upserted in one statement, which cannot affect the same row
+        twice. Therefore a batch contains every LDAP entry (UUID) only once,
+        the last occurrence wins.
+
+        Arguments:
+            ldap_results -- iterable of Tuple[iterable[LDAP_Entry], str].
+                            The tuple contains the LDAP entries and a type (str)
+            watermarks -- if passed, the highest modify timestamp per type is
+                          recorded into it
+        """
+        sizer = self.batch_sizer
+        batch = {}
+        batch_bytes = 0
+        for ldap_entries, type in ldap_results:
+            for ldap_result in ldap_entries:
+                vars, content_bytes = self._transform_entry(
+                    ldap_result, type, watermarks
+                )
+                # Remove first, so the last occurrence also keeps the last position
+                batch.pop(vars[0], None)
+                batch[vars[0]] = vars
+                batch_bytes += content_bytes
+                # The size is read per entry, as it adapts while batches are upserted
+                if len(batch) >= sizer.size or batch_bytes >= sizer.max_bytes:
+                    yield list(batch.values())
+                    batch = {}
+                    batch_bytes = 0
+        if batch:
+            yield list(batch.values())
+
+    def upsert_ldap_results_many(self, ldap_results: list) -> UpsertStats:
         """Upsert the LDAP entries into PostgreSQL.
 
-       Transforms and flattens the LDAP entries to one list,
-       in order to execute in one transaction.
+        Streams the LDAP entries in batches to PostgreSQL, in order to keep
+        memory usage bounded. All batches are executed in one transaction,
+        unless the commit_mode is 'batch': then every batch is committed on
+        its own and retried on connection errors, see commit_batches.
+        The batch size adapts to the duration of the batches, see BatchSizer.
+
+        Depending on the upsert_strategy, the batches are either upserted via
+        multi-row VALUES statements ('values') or COPYed into a temporary
+        staging table which is merged into the table at the end ('copy').
+        Rows of which the content hash did not change are left untouched.
+
+        The highest modify timestamp per type is saved as the watermark of
+        the type in the sync_state table, in the same transaction or, if
+        committed per batch, once all batches are committed.
+
+        Arguments:
+            ldap_results -- list of Tuple[iterable[LDAP_Entry], str].
+                            The tuple contains the LDAP entries and a type (str).
+                            The LDAP entries can be a generator.
+
+        Returns:
+            UpsertStats -- the amount of inserted, updated and unchanged rows
+        """
+        # Filled while the batches are consumed, before finalize is called
+        watermarks = {}
+        vars_batches = self._batch_vars_upsert(ldap_results, watermarks)
+        finalize = partial(self._save_watermarks, watermarks)
+        if self.commit_mode == COMMIT_MODE_BATCH:
+            count, rows = self._upsert_committed_batches(vars_batches, watermarks)
+        elif self.upsert_strategy == UPSERT_STRATEGY_COPY:
+            count, rows = self.postgresql_wrapper.copy_merge_batches(
+                self._sql(CREATE_STAGING_TABLE_SQL), self._sql(COPY_STAGING_SQL),
+                self._sql(MERGE_STAGING_SQL), vars_batches, finalize=finalize,
+                observe=self.batch_sizer.update
+            )
+        else:
+            count, rows = self.postgresql_wrapper.execute_values_batches(
+                self._sql(UPSERT_ENTITIES_VALUES_SQL), vars_batches, self.page_size,
+                True,
+                finalize=finalize, observe=self.batch_sizer.update
+            )
+        return self._upsert_stats(count, rows)
+
+    def _upsert_committed_batches(self, vars_batches, watermarks: dict) -> tuple:
+        """Upserts and commits the batches one by one (commit_mode 'batch').
+
+        The watermarks are only saved once all batches are committed: the
+        LDAP entries are not ordered by modify timestamp, so a watermark of
+        the committed batches could skip entries that are not committed yet.
+        """
+        wrapper = self.postgresql_wrapper
+        if self.upsert_strategy == UPSERT_STRATEGY_COPY:
+            execute = partial(
+                wrapper.copy_merge_batches,
+                self._sql(CREATE_STAGING_TABLE_SQL), self._sql(COPY_STAGING_SQL),
+                self._sql(MERGE_STAGING_SQL),
+                observe=self.batch_sizer.update
+            )
+        else:
+            execute = partial(
+                wrapper.execute_values_batches, self._sql(UPSERT_ENTITIES_VALUES_SQL),
+                page_size=self.page_size, fetch=True, observe=self.batch_sizer.update
+            )
+        count, rows = wrapper.commit_batches(
+            execute, vars_batches, self.retries, self.retry_backoff
+        )
+        if watermarks:
+            wrapper.commit_batches(
+                partial(
+                    wrapper.execute_values_batches, self._sql(UPSERT_SYNC_STATE_SQL)
+                ),
+                [list(watermarks.items())], self.retries, self.retry_backoff
+            )
+        return count, rows
+
+    @staticmethod
+    def _upsert_stats(count: int, rows: list) -> UpsertStats:
+        """Returns the stats of the upsert of count rows.
+
+        Arguments:
+            rows -- the (inserted: bool, count: int) rows returned by the upsert
+        """
+        stats = UpsertStats()
+        for inserted, amount in rows:
+            if inserted:
+                stats.inserted += amount
+            else:
+                stats.updated += amount
+        stats.unchanged = count - stats.inserted - stats.updated
+        return stats
+
+    def _save_watermarks(self, watermarks: dict, cursor):
+        """Saves the watermark per type to the sync_state table."""
+        if watermarks:
+            psycopg2.extras.execute_values(
+                cursor, self._sql(UPSERT_SYNC_STATE_SQL), list(watermarks.items())
+            )
+
+    def _swap_rebuild_table(self, cursor):
+        """Replaces the table by the rebuilt table.
+
+        Makes the rebuilt table durable, creates the constraints, indexes and
+        triggers of the table on it, copies its privileges, owner and comment
+        and swaps it in place of the table. Changing the owner fails the
+        rebuild if the user is not allowed to, rather than leaving the table
+        to another owner.
+        """
+        cursor.execute(self._sql(SET_LOGGED_REBUILD_SQL))
+        # Index and constraint names are unique per schema, so they get a
+        # suffix until the table they belong to has been dropped
+        cursor.execute(self._sql(SELECT_CONSTRAINTS_SQL))
+        constraints = cursor.fetchall()
+        cursor.execute(self._sql(SELECT_INDEXES_SQL))
+        indexes = cursor.fetchall()
+        cursor.execute(self._sql(SELECT_TRIGGERS_SQL))
+        triggers = cursor.fetchall()
+        cursor.execute(self._sql(SELECT_GRANTS_SQL))
+        grants = cursor.fetchall()
+        cursor.execute(self._sql(SELECT_OWNER_COMMENT_SQL))
+        owner, comment = cursor.fetchone()
+        table = Identifier(self.table)
+        rebuild_table = Identifier(self._sql(REBUILD_TABLE_NAME))
+        for name, definition in constraints:
+            cursor.execute(
+                SQL('ALTER TABLE {} ADD CONSTRAINT {} ').format(
+                    rebuild_table, Identifier(f'{name}{REBUILD_SUFFIX}')
+                ) + SQL(definition)
+            )
+        for name, definition in indexes:
+            # e.g. CREATE INDEX name ON public.entities USING btree (...)
+            prefix, _, using = definition.partition(' USING ')
+            unique = 'UNIQUE ' if prefix.startswith('CREATE UNIQUE ') else ''
+            cursor.execute(
+                SQL(f'CREATE {unique}INDEX {{}} ON {{}} USING ').format(
+                    Identifier(f'{name}{REBUILD_SUFFIX}'), rebuild_table
+                ) + SQL(using)
+            )
+        for name, definition in triggers:
+            # e.g. CREATE TRIGGER name BEFORE UPDATE ON public.entities FOR ...
+            prefix, _, rest = definition.partition(' ON ')
+            _, _, rest = rest.partition(' ')
+            cursor.execute(
+                SQL(prefix) + SQL(' ON {} ').format(rebuild_table) + SQL(rest)
+            )
+        for grantee, privilege, grantable in grants:
+            cursor.execute(
+                SQL('GRANT {} ON {} TO {}{}').format(
+                    SQL(privilege), rebuild_table,
+                    Identifier(grantee) if grantee is not None else SQL('PUBLIC'),
+                    SQL(' WITH GRANT OPTION' if grantable else '')
+                )
+            )
+        if comment is not None:
+            cursor.execute(
+                SQL('COMMENT ON TABLE {} IS %s').format(rebuild_table), (comment,)
+            )
+        # Before the sequence, which needs to have the owner of its table
+        cursor.execute(
+            SQL('ALTER TABLE {} OWNER TO {}').format(rebuild_table, Identifier(owner))
+        )
+
+        # The serial sequence would be dropped together with the table
+        cursor.execute(self._sql(SELECT_SERIAL_SEQUENCE_SQL))
+        sequence = cursor.fetchone()[0]
+        if sequence is not None:
+            cursor.execute(
+                SQL('ALTER SEQUENCE {} OWNED BY {}.id').format(
+                    SQL(sequence), rebuild_table
+                )
+            )
+        cursor.execute(SQL('DROP TABLE {}').format(table))
+        cursor.execute(SQL('ALTER TABLE {} RENAME TO {}').format(rebuild_table, table))
+        for name, _ in constraints:
+            cursor.execute(
+                SQL('ALTER TABLE {} RENAME CONSTRAINT {} TO {}').format(
+                    table, Identifier(f'{name}{REBUILD_SUFFIX}'), Identifier(name)
+                )
+            )
+        for name, _ in indexes:
+            cursor.execute(
+                SQL('ALTER INDEX {} RENAME TO {}').format(
+                    Identifier(f'{name}{REBUILD_SUFFIX}'), Identifier(name)
+                )
+            )
+
+    def _finalize_rebuild(self, watermarks: dict, cursor):
+        """Swaps the rebuilt table in place and resets the watermarks."""
+        self._swap_rebuild_table(cursor)
+        cursor.execute(self._sql(DELETE_SYNC_STATE_SQL), (list(watermarks),))
+        self._save_watermarks(watermarks, cursor)
+
+    def rebuild_ldap_results(self, ldap_results) -> int:
+        """Replaces all rows by the LDAP entries (blue/green full rebuild).
+
+        The LDAP entries are COPYed into a new unlogged table, which is made
+        durable and indexed once it is loaded. It then replaces the table in
+        the same transaction: readers see either the old or the new rows.
+        The LDAP results need to contain all LDAP entries of all types, as
+        rows of missing entries or types are gone after the rebuild.
+
+        Arguments:
+            ldap_results -- iterable of Tuple[iterable[LDAP_Entry], str].
+
+        Returns:
+            int -- the amount of rows in the rebuilt table
+        """
+        # Filled while the batches are consumed, before finalize is called
+        watermarks = {}
+        _, rows = self.postgresql_wrapper.copy_merge_batches(
+            self._sql(CREATE_REBUILD_TABLE_SQL), self._sql(COPY_STAGING_SQL),
+            self._sql(INSERT_REBUILD_SQL),
+            self._batch_vars_upsert(ldap_results, watermarks),
+            finalize=partial(self._finalize_rebuild, watermarks),
+            observe=self.batch_sizer.update
+        )
+        return rows[0][0]
+
+    def _batch_vars_ldap_uuids(self, ldap_results):
+        """Transforms the LDAP entries to (UUID, type) tuples in batches."""
+        batch = []
+        for ldap_entries, type in ldap_results:
+            for ldap_result in ldap_entries:
+                batch.append((str(ldap_result.entryUUID), type))
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def reconcile_ldap_uuids(self, ldap_results, types: tuple) -> dict:
+        """Removes the rows of which the LDAP entry no longer exists.
+
+        The UUIDs of all LDAP entries are COPYed into a temporary table, which
+        is compared in bulk to the table. Only the rows of the given types are
+        reconciled, also those of a type without any LDAP entries, as the
+        searches yield no pages for it. Depending on the delete_strategy, the
+        orphaned rows are deleted ('delete') or marked by setting their
+        deleted_timestamp ('tombstone'). Everything is executed in one
+        transaction.
 
         Arguments:
-            ldap_results -- list of Tuple[list[LDAP_Entry], str].
-                            The tuple contains a list of LDAP entries and a type (str)
-        """
-        vars_list = []
-        for ldap_result_tuple in ldap_results:
-            type = ldap_result_tuple[1]
-            # Parse and flatten the SQL values from the ldap_results as a passable list
-            vars_list.extend(
-                [
-                    self._prepare_vars_upsert(ldap_result, type)
-                    for ldap_result
-                    in ldap_result_tuple[0]
-                ]
-            )
-        self.postgresql_wrapper.executemany(UPSERT_ENTITIES_SQL, vars_list)
+            ldap_results -- iterable of Tuple[iterable[LDAP_Entry], str].
+                            The LDAP entries of a type need to be complete,
+                            only the entryUUID attribute is used.
+            types -- the types of which the LDAP results are complete
+
+        Returns:
+            dict -- the amount of deleted or tombstoned rows per type
+        """
+        if self.delete_strategy == DELETE_STRATEGY_TOMBSTONE:
+            orphans_sql = self._sql(TOMBSTONE_ORPHANS_SQL)
+        else:
+            orphans_sql = self._sql(DELETE_ORPHANS_SQL)
+        _, rows = self.postgresql_wrapper.copy_merge_batches(
+            self._sql(CREATE_LDAP_UUIDS_TABLE_SQL), self._sql(COPY_LDAP_UUIDS_SQL),
+            orphans_sql,
+            self._batch_vars_ldap_uuids(ldap_results), (list(types),)
+        )
+        return dict(rows)
+
+    def remove_ldap_uuids(self, ldap_uuids: list) -> int:
+        """Removes the rows of the deleted LDAP entries.
+
+        Depending on the delete_strategy, the rows are deleted ('delete') or
+        marked by setting their deleted_timestamp ('tombstone').
+
+        Arguments:
+            ldap_uuids -- list of the entryUUIDs (str) of the deleted LDAP entries
+
+        Returns:
+            int -- the amount of deleted or tombstoned rows
+        """
+        if self.delete_strategy == DELETE_STRATEGY_TOMBSTONE:
+            remove_sql = self._sql(TOMBSTONE_ENTITIES_SQL)
+        else:
+            remove_sql = self._sql(DELETE_ENTITIES_SQL)
+        return len(self.postgresql_wrapper.execute(remove_sql, (list(ldap_uuids),)))
+
+    def close(self):
+        """Closes the connections to PostgreSQL."""
+        self.postgresql_wrapper.close()
 
     def max_last_modified_timestamp(self) -> datetime:
-        """Returns the highest last_modified_timestamp"""
-        return self.postgresql_wrapper.execute(MAX_LAST_MODIFIED_TIMESTAMP_SQL)[0][0]
+        """Returns the highest last_modified_timestamp.
+
+        Only rows with a type are taken into account.
+        """
+        return self.postgresql_wrapper.execute(
+            self._sql(MAX_LAST_MODIFIED_TIMESTAMP_SQL)
+        )[0][0]
+
+    def watermarks(self, types: tuple) -> dict:
+        """Returns the watermark per type, from which to resume the sync.
+
+        The watermark is the highest modify timestamp that has been synced.
+        For types without sync state (e.g. synced before the sync_state table
+        existed), the highest last_modified_timestamp of the type is used.
+
+        Returns:
+            dict -- the watermark (datetime) per type, None if the type has
+                    never been synced
+        """
+        watermarks = dict(
+            self.postgresql_wrapper.execute(
+                self._sql(SELECT_SYNC_STATE_SQL), (list(types),)
+            )
+        )
+        for type in types:
+            if watermarks.get(type) is None:
+                watermarks[type] = self.postgresql_wrapper.execute(
+                    self._sql(MAX_LAST_MODIFIED_TIMESTAMP_TYPE_SQL), (type,)
+                )[0][0]
+        return {type: watermarks[type] for type in types}
+
+    def cookie(self) -> bytes:
+        """Returns the cookie from which the subscription to the changes resumes.
+
+        Returns:
+            bytes -- the cookie, None if no subscription has been saved
+        """
+        rows = self.postgresql_wrapper.execute(
+            self._sql(SELECT_COOKIE_SQL), (SYNC_STATE_COOKIE_TYPE,)
+        )
+        if not rows or rows[0][0] is None:
+            return None
+        return bytes(rows[0][0])
+
+    def save_cookie(self, cookie: bytes):
+        """Saves the cookie of the subscription, once its changes are synced.
+
+        A cookie of None makes the next subscription start over.
+        """
+        self.postgresql_wrapper.execute(
+            self._sql(UPSERT_COOKIE_SQL), (SYNC_STATE_COOKIE_TYPE, cookie)
+        )
+
+    def last_modified_index(self, modified_since: dict) -> dict:
+        """Returns the stored modify timestamp per entryUUID, per type.
+
+        Only the rows that a sync since the given watermarks can return are
+        loaded: the rows of which the last_modified_timestamp is after the
+        watermark of the type, or all rows of the type if it has no watermark.
+        Tombstoned rows are left out, so they are restored if they reappear.
+
+        Arguments:
+            modified_since -- dict of type to watermark (datetime or None)
+
+        Returns:
+            dict -- dict of entryUUID (str) to last_modified_timestamp (time
+                    zone aware datetime) per type
+        """
+        index = {}
+        with metrics.span('db_last_modified_index'):
+            for type, watermark in modified_since.items():
+                if watermark is None:
+                    rows = self.postgresql_wrapper.execute(
+                        self._sql(SELECT_LAST_MODIFIED_TYPE_SQL), (type,)
+                    )
+                else:
+                    rows = self.postgresql_wrapper.execute(
+                        self._sql(SELECT_LAST_MODIFIED_SINCE_SQL), (type, watermark)
+                    )
+                index[type] = dict(rows)
+        return index
+
+    def content_hashes(self, ldap_uuids: list) -> dict:
+        """Returns the stored content hash per entryUUID, for a dry run.
+
+        The entryUUIDs without row are left out. The hash of a tombstoned row
+        is None.
+        """
+        return dict(
+            self.postgresql_wrapper.execute(
+                self._sql(SELECT_CONTENT_HASHES_SQL), (ldap_uuids,)
+            )
+        )
+
+    def live_ldap_uuids(self, type: str) -> list:
+        """Returns the sorted entryUUIDs of the live rows of the type."""
+        return [
+            row[0]
+            for row in self.postgresql_wrapper.execute(
+                self._sql(SELECT_LIVE_UUIDS_TYPE_SQL), (type,)
+            )
+        ]
+
+    def snapshot_rows(self) -> list:
+        """Returns the state of the live rows, to seed a local snapshot.
+
+        Returns:
+            list -- (ldap_uuid, type, content_hash, last_modified_timestamp)
+                    tuples
+        """
+        return self.postgresql_wrapper.execute(self._sql(SELECT_SNAPSHOT_SQL))
 
     def insert_entity(self, date_time: datetime = datetime.now()):
-        vars = (str(uuid.uuid4()), 'person', '{"key": "value"}', date_time)
-        self.postgresql_wrapper.execute(UPSERT_ENTITIES_SQL, vars)
+        content = '{"key": "value"}'
+        vars = (str(uuid.uuid4()), 'person', content, content_hash(content), date_time)
+        self.postgresql_wrapper.execute(self._sql(UPSERT_ENTITIES_SQL), vars)
 
     def count(self) -> int:
-        return self.postgresql_wrapper.execute(COUNT_ENTITIES_SQL)[0][0]
+        return self.postgresql_wrapper.execute(self._sql(COUNT_ENTITIES_SQL))[0][0]
 
     def count_where(self, where_clause: str, vars: tuple = None) -> int:
         """Constructs and executes a 'select count(*) where' statement.
@@ -124,11 +1161,154 @@ class DeeweeClient:
         Returns:
             int -- the amount of records
         """
-        select_sql = f'{COUNT_ENTITIES_SQL} where {where_clause};'
+        select_sql = f'{self._sql(COUNT_ENTITIES_SQL)} where {where_clause};'
         return self.postgresql_wrapper.execute(select_sql, vars)[0][0]
 
     def count_type(self, type: str) -> int:
         return self.count_where('type = %s', (type,))
 
     def truncate_table(self):
-        self.postgresql_wrapper.execute(TRUNCATE_ENTITIES_SQL)
+        self.postgresql_wrapper.execute(self._sql(TRUNCATE_ENTITIES_SQL))
+
+
+class AsyncDeeweeClient(DeeweeClient):
+    """Variant of the DeeweeClient which upserts on an asyncio event loop.
+
+    The upsert is executed via asyncpg: while a batch is being COPYed, the
+    next LDAP page is transformed. The other statements (e.g. the watermarks
+    and the reconciliation) are still executed by the synchronous client.
+    """
+
+    def __init__(self, params: dict):
+        if asyncpg is None:
+            raise ImportError("The asyncio engine requires asyncpg to be installed")
+        super().__init__(params)
+        self.async_pool = None
+
+    async def _get_async_pool(self):
+        if self.async_pool is None:
+            wrapper = self.postgresql_wrapper
+            self.async_pool = await asyncpg.create_pool(
+                min_size=wrapper.pool_min_size,
+                max_size=wrapper.pool_size,
+                **wrapper.params_postgresql
+            )
+        return self.async_pool
+
+    def _transform_page(self, ldap_entries, type: str, watermarks: dict) -> list:
+        return [
+            self._transform_entry(ldap_result, type, watermarks)
+            for ldap_result in ldap_entries
+        ]
+
+    async def _batch_vars_upsert_async(self, ldap_results, watermarks: dict):
+        """Transforms the LDAP pages and groups them into batches.
+
+        Same as _batch_vars_upsert, but for an async iterable of LDAP pages.
+        Every page is transformed in the default executor, so that the event
+        loop keeps writing the previous batch meanwhile.
+        """
+        loop = asyncio.get_event_loop()
+        sizer = self.batch_sizer
+        batch = {}
+        batch_bytes = 0
+        async for ldap_entries, type in ldap_results:
+            transformed = await loop.run_in_executor(
+                None, self._transform_page, ldap_entries, type, watermarks
+            )
+            for vars, content_bytes in transformed:
+                # Remove first, so the last occurrence also keeps the last position
+                batch.pop(vars[0], None)
+                batch[vars[0]] = vars
+                batch_bytes += content_bytes
+                if len(batch) >= sizer.size or batch_bytes >= sizer.max_bytes:
+                    yield list(batch.values())
+                    batch = {}
+                    batch_bytes = 0
+        if batch:
+            yield list(batch.values())
+
+    async def _copy_batch(self, conn, vars_list: list):
+        start = time.perf_counter()
+        with metrics.span('db_copy'):
+            await conn.copy_records_to_table(
+                self._sql(STAGING_TABLE_NAME), records=vars_list,
+                columns=STAGING_COLUMNS
+            )
+        self.batch_sizer.update(time.perf_counter() - start)
+        metrics.increment('batches')
+
+    async def _copy_batches(self, conn, vars_batches) -> int:
+        """COPYs the batches into the staging table, one at a time.
+
+        The next batch is prepared while the previous one is being COPYed.
+
+        Returns:
+            int -- the amount of parameters that have been loaded
+        """
+        count = 0
+        copying = None
+        try:
+            async for vars_list in vars_batches:
+                # The connection executes one statement at a time
+                if copying is not None:
+                    await copying
+                copying = asyncio.ensure_future(self._copy_batch(conn, vars_list))
+                count += len(vars_list)
+            if copying is not None:
+                await copying
+        except BaseException:
+            # Do not leave the COPY running on the connection
+            if copying is not None and not copying.done():
+                copying.cancel()
+                await asyncio.wait([copying])
+            raise
+        return count
+
+    async def upsert_ldap_results_many_async(self, ldap_results) -> UpsertStats:
+        """Upsert the LDAP entries into PostgreSQL, on the event loop.
+
+        Works like upsert_ldap_results_many with the 'copy' upsert_strategy:
+        the batches are COPYed into a temporary staging table which is merged
+        into the table at the end. The watermarks are saved in the same
+        transaction.
+
+        Arguments:
+            ldap_results -- async iterable of Tuple[list[LDAP_Entry], str],
+                            e.g. AsyncLdapClient.search_concurrently_async
+
+        Returns:
+            UpsertStats -- the amount of inserted, updated and unchanged rows
+        """
+        # Filled while the batches are consumed, before they are saved
+        watermarks = {}
+        pool = await self._get_async_pool()
+        async with pool.acquire() as conn:
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                await conn.execute(self._sql(CREATE_STAGING_TABLE_SQL))
+                count = await self._copy_batches(
+                    conn, self._batch_vars_upsert_async(ldap_results, watermarks)
+                )
+                with metrics.span('db_merge'):
+                    rows = await conn.fetch(self._sql(MERGE_STAGING_SQL))
+                if watermarks:
+                    with metrics.span('db_finalize'):
+                        await conn.executemany(
+                            self._sql(UPSERT_SYNC_STATE_ASYNC_SQL),
+                            list(watermarks.items())
+                        )
+            except BaseException:
+                await transaction.rollback()
+                raise
+            with metrics.span('db_commit'):
+                await transaction.commit()
+        return self._upsert_stats(count, rows)
+
+    async def close_async(self):
+        """Closes the asyncpg pool and the connections of the synchronous client."""
+        if self.async_pool is not None:
+            await self.async_pool.close()
+            self.async_pool = None
+        self.close()
@@ -1,42 +1,454 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import ldap3
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
+from itertools import islice
+from types import SimpleNamespace
+from uuid import UUID
+from ldap3.core.exceptions import LDAPExceptionError
+from ldap3.protocol.controls import build_control
+from ldap3.utils.ciDict import CaseInsensitiveDict
+from pyasn1.codec.ber import decoder
+from pyasn1.type import namedtype, namedval, tag, univ
+
+from app.metrics import metrics
+from app.serialization import EntityRecord
 
 
 LDAP_SUFFIX = 'dc=hetarchief,dc=be'
 LDAP_PEOPLE_PREFIX = 'ou=people'
 LDAP_ORGS_PREFIX = 'ou=orgs'
 SEARCH_ATTRIBUTES = [ldap3.ALL_ATTRIBUTES, 'modifyTimestamp', 'entryUUID']
+# Attributes that are always requested as the sync depends on them
+REQUIRED_ATTRIBUTES = ['modifyTimestamp', 'entryUUID']
+# Attributes needed to reconcile the deleted LDAP entries
+UUID_ATTRIBUTES = ['entryUUID']
+ENTITY_TYPES = ('org', 'person')
+DEFAULT_PAGE_SIZE = 500
+PAGED_RESULTS_CONTROL = '1.2.840.113556.1.4.319'
+DEFAULT_MAX_QUEUED_PAGES = 4
+# Type of the search responses which are entries
+SEARCH_RESULT_ENTRY = 'searchResEntry'
+# Seconds between checks whether a blocked concurrent search should stop
+QUEUE_POLL_INTERVAL = 0.5
+# Change type of a watched entry that got deleted
+CHANGE_TYPE_DELETE = 'delete'
+# Content synchronization (syncrepl) as per RFC 4533, offered by the syncprov
+# overlay of OpenLDAP
+SYNC_REQUEST_CONTROL = '1.3.6.1.4.1.4203.1.9.1.1'
+SYNC_STATE_CONTROL = '1.3.6.1.4.1.4203.1.9.1.2'
+SYNC_DONE_CONTROL = '1.3.6.1.4.1.4203.1.9.1.3'
+SYNC_INFO_MESSAGE = '1.3.6.1.4.1.4203.1.9.1.4'
+# Result code of a sync search that cannot be resumed from its cookie
+SYNC_REFRESH_REQUIRED = 4096
+# Attribute per type of which the leading character partitions a full sync
+SHARD_ATTRIBUTES = {'org': 'o', 'person': 'mail'}
+SHARD_CHARACTERS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+
+class SyncRequestValue(univ.Sequence):
+    # syncRequestValue ::= SEQUENCE {
+    #     mode ENUMERATED {
+    #         refreshOnly       (1),
+    #         refreshAndPersist (3)
+    #     },
+    #     cookie     syncCookie OPTIONAL,
+    #     reloadHint BOOLEAN DEFAULT FALSE
+    # }
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('mode', univ.Enumerated(
+            namedValues=namedval.NamedValues(
+                ('refreshOnly', 1), ('refreshAndPersist', 3)
+            )
+        )),
+        namedtype.OptionalNamedType('cookie', univ.OctetString()),
+        namedtype.DefaultedNamedType('reloadHint', univ.Boolean(False))
+    )
+
+
+class SyncStateValue(univ.Sequence):
+    # syncStateValue ::= SEQUENCE {
+    #     state ENUMERATED {
+    #         present (0),
+    #         add     (1),
+    #         modify  (2),
+    #         delete  (3)
+    #     },
+    #     entryUUID syncUUID,
+    #     cookie    syncCookie OPTIONAL
+    # }
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('state', univ.Enumerated(
+            namedValues=namedval.NamedValues(
+                ('present', 0), ('add', 1), ('modify', 2), ('delete', 3)
+            )
+        )),
+        namedtype.NamedType('entryUUID', univ.OctetString()),
+        namedtype.OptionalNamedType('cookie', univ.OctetString())
+    )
+
+
+class SyncDoneValue(univ.Sequence):
+    # syncDoneValue ::= SEQUENCE {
+    #     cookie          syncCookie OPTIONAL,
+    #     refreshDeletes  BOOLEAN DEFAULT FALSE
+    # }
+    componentType = namedtype.NamedTypes(
+        namedtype.OptionalNamedType('cookie', univ.OctetString()),
+        namedtype.DefaultedNamedType('refreshDeletes', univ.Boolean(False))
+    )
+
+
+class SyncRefreshDone(univ.Sequence):
+    # SEQUENCE {
+    #     cookie         syncCookie OPTIONAL,
+    #     refreshDone    BOOLEAN DEFAULT TRUE
+    # }
+    componentType = namedtype.NamedTypes(
+        namedtype.OptionalNamedType('cookie', univ.OctetString()),
+        namedtype.DefaultedNamedType('refreshDone', univ.Boolean(True))
+    )
+
+
+class SyncIdSet(univ.Sequence):
+    # SEQUENCE {
+    #     cookie         syncCookie OPTIONAL,
+    #     refreshDeletes BOOLEAN DEFAULT FALSE,
+    #     syncUUIDs      SET OF syncUUID
+    # }
+    componentType = namedtype.NamedTypes(
+        namedtype.OptionalNamedType('cookie', univ.OctetString()),
+        namedtype.DefaultedNamedType('refreshDeletes', univ.Boolean(False)),
+        namedtype.NamedType('syncUUIDs', univ.SetOf(componentType=univ.OctetString()))
+    )
+
+
+def _context_tag(number: int, format=tag.tagFormatConstructed):
+    return tag.Tag(tag.tagClassContext, format, number)
+
+
+class SyncInfoValue(univ.Choice):
+    # syncInfoValue ::= CHOICE {
+    #     newcookie      [0] syncCookie,
+    #     refreshDelete  [1] SEQUENCE {...},
+    #     refreshPresent [2] SEQUENCE {...},
+    #     syncIdSet      [3] SEQUENCE {...}
+    # }
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('newcookie', univ.OctetString().subtype(
+            implicitTag=_context_tag(0, tag.tagFormatSimple)
+        )),
+        namedtype.NamedType('refreshDelete', SyncRefreshDone().subtype(
+            implicitTag=_context_tag(1)
+        )),
+        namedtype.NamedType('refreshPresent', SyncRefreshDone().subtype(
+            implicitTag=_context_tag(2)
+        )),
+        namedtype.NamedType('syncIdSet', SyncIdSet().subtype(
+            implicitTag=_context_tag(3)
+        ))
+    )
+
+
+def sync_request_control(cookie: bytes = None):
+    """Returns the critical control of a refreshAndPersist sync search.
+
+    A server without syncrepl rejects the search, instead of ignoring the control.
+    """
+    value = SyncRequestValue()
+    value['mode'] = 'refreshAndPersist'
+    if cookie:
+        value['cookie'] = cookie
+    return build_control(SYNC_REQUEST_CONTROL, True, value)
+
+
+def _decode(value: bytes, spec):
+    decoded, _ = decoder.decode(value, asn1Spec=spec)
+    return decoded
+
+
+def _sync_cookie(value) -> bytes:
+    """Returns the optional cookie of a decoded sync value, or None."""
+    cookie = value['cookie']
+    return bytes(cookie) if cookie.isValue else None
+
+
+class LdapWatchError(LDAPExceptionError):
+    """The subscription to the changes ended.
+
+    E.g. because the server ended the sync search or closed the connection.
+    """
+
+
+class LdapSyncRefreshRequired(LdapWatchError):
+    """The server cannot resume the subscription from its cookie."""
+
+
+class SyncReplSearch:
+    """A content synchronization search (syncrepl) in refreshAndPersist mode.
+
+    The server first sends the entries that changed since the cookie, or all
+    entries without cookie (the refresh phase), and then the changes as they
+    happen. Iterating yields the entries as events (dict) with their
+    'changeType' (add, modify or delete), or None if no event arrived within
+    timeout seconds. Entries of which only the presence is confirmed are
+    skipped. The entries that got deleted during the refresh phase can be
+    reported by entryUUID only: their event has no DN.
+
+    The cookie is that of the last event that has been yielded: once the
+    events up to it are applied, a new search resumes after them. Raises a
+    LdapWatchError once the server ends the search or the connection is lost.
+    """
+
+    def __init__(self, connection, search, timeout: float, cookie: bytes = None):
+        self.connection = connection
+        self.search = search
+        self.timeout = timeout
+        self.cookie = cookie
+
+    def __iter__(self):
+        while True:
+            event = self.search.next(block=True, timeout=self.timeout)
+            if event is None:
+                # The receiver thread stops when the server drops the connection
+                if self.connection.closed or not self.connection.listening:
+                    raise LdapWatchError(
+                        "The connection of the subscription to the changes was lost"
+                    )
+                yield None
+            elif event['type'] == SEARCH_RESULT_ENTRY:
+                yield from self._entry_events(event)
+            elif event['type'] == 'intermediateResponse':
+                yield from self._info_events(event)
+            elif event['type'] == 'searchResDone':
+                self._done(event)
+
+    def _entry_events(self, event: dict):
+        controls = event.get('controls') or {}
+        if SYNC_STATE_CONTROL not in controls:
+            return
+        state = _decode(controls[SYNC_STATE_CONTROL]['value'], SyncStateValue())
+        change_type = state['state'].prettyPrint()
+        cookie = _sync_cookie(state)
+        if cookie is not None:
+            self.cookie = cookie
+        if change_type != 'present':
+            attributes = event.setdefault('attributes', {})
+            if not attributes.get('entryUUID'):
+                attributes['entryUUID'] = str(UUID(bytes=bytes(state['entryUUID'])))
+            event['changeType'] = change_type
+            yield event
+
+    def _info_events(self, event: dict):
+        if event.get('responseName') != SYNC_INFO_MESSAGE:
+            return
+        info = _decode(event['responseValue'], SyncInfoValue())
+        name = info.getName()
+        value = info.getComponent()
+        if name == 'newcookie':
+            self.cookie = bytes(value)
+            return
+        events = []
+        if name == 'syncIdSet' and value['refreshDeletes']:
+            events = [
+                {
+                    'type': SEARCH_RESULT_ENTRY,
+                    'dn': None,
+                    'changeType': CHANGE_TYPE_DELETE,
+                    'attributes': {'entryUUID': str(UUID(bytes=bytes(ldap_uuid)))},
+                }
+                for ldap_uuid in value['syncUUIDs']
+            ]
+        # The cookie covers all deletions, so it is set with the last one
+        yield from events[:-1]
+        cookie = _sync_cookie(value)
+        if cookie is not None:
+            self.cookie = cookie
+        yield from events[-1:]
+
+    def _done(self, event: dict):
+        controls = event.get('controls') or {}
+        if SYNC_DONE_CONTROL in controls:
+            cookie = _sync_cookie(
+                _decode(controls[SYNC_DONE_CONTROL]['value'], SyncDoneValue())
+            )
+            if cookie is not None:
+                self.cookie = cookie
+        message = (
+            f"The server ended the subscription to the changes: "
+            f"{event.get('description')} {event.get('message') or ''}".rstrip()
+        )
+        if event.get('result') == SYNC_REFRESH_REQUIRED:
+            raise LdapSyncRefreshRequired(message)
+        raise LdapWatchError(message)
+
+    def close(self):
+        """Stops the search, also if it has not been iterated yet."""
+        if self.search is not None:
+            self.search.stop()
+            self.search = None
 
 
 class LdapWrapper:
-    """Allows for communicating with an LDAP server"""
+    """Allows for communicating with an LDAP server.
+
+    Every thread gets its own connection to the server, so searches can be
+    executed concurrently.
+    """
 
     def __init__(self, params: dict, search_attributes=ldap3.ALL_ATTRIBUTES,
-                 get_info=ldap3.SCHEMA, client_strategy=ldap3.SYNC):
+                 get_info=None, client_strategy=ldap3.SYNC):
+        """Initializes the wrapper, without connecting to the server yet.
+
+        Arguments:
+            get_info -- which server info to read (ldap3.SCHEMA, ldap3.NONE, ...).
+                        If None, the 'get_info' parameter is used, default SCHEMA.
+                        The info is read on the first bind only. Without schema,
+                        attribute values are not converted (e.g. timestamps stay
+                        strings).
+        """
         self.search_attributes = search_attributes
+        self.page_size = params.get('page_size', DEFAULT_PAGE_SIZE)
+        # Path prefix of the files in which the server info and schema are cached
+        self.schema_cache = params.get('schema_cache')
 
         # These can potentially be absent so that anonymous access is allowed
         user = params.get('bind')
         password = params.get('password')
 
-        server = ldap3.Server(params['URI'], get_info=get_info)
-        self.connection = ldap3.Connection(
-            server, user, password, client_strategy=client_strategy
+        if get_info is None:
+            get_info = params.get('get_info', ldap3.SCHEMA)
+        if self.schema_cache and os.path.exists(self._schema_cache_file('schema')):
+            server = ldap3.Server.from_definition(
+                params['URI'],
+                self._schema_cache_file('info'),
+                self._schema_cache_file('schema')
+            )
+        else:
+            # Caching requires both the DSA info and the schema
+            server = ldap3.Server(
+                params['URI'], get_info=ldap3.ALL if self.schema_cache else get_info
+            )
+        self._connection_args = (server, user, password)
+        self._client_strategy = client_strategy
+        self._local = threading.local()
+        # Create the connection of the current thread right away
+        self.connection
+
+    @property
+    def connection(self) -> ldap3.Connection:
+        """The connection of the current thread."""
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = ldap3.Connection(
+                *self._connection_args, client_strategy=self._client_strategy
+            )
+        return self._local.connection
+
+    @property
+    def _session_depth(self) -> int:
+        """Amount of nested sessions of the current thread.
+
+        The connection stays bound while > 0.
+        """
+        return getattr(self._local, 'session_depth', 0)
+
+    @_session_depth.setter
+    def _session_depth(self, value: int):
+        self._local.session_depth = value
+
+    def _schema_cache_file(self, kind: str) -> str:
+        return f'{self.schema_cache}.{kind}.json'
+
+    def _bind(self):
+        """Binds the connection of the current thread.
+
+        The server info is shared by all connections and only read on the
+        first bind, or never if it has been loaded from the cache.
+        """
+        server = self.connection.server
+        read_server_info = (
+            server.get_info != ldap3.NONE
+            and server.schema is None
+            and server.info is None
         )
+        with metrics.span('ldap_bind'):
+            self.connection.bind(read_server_info=read_server_info)
+        if read_server_info and self.schema_cache and server.schema is not None:
+            try:
+                server.info.to_file(self._schema_cache_file('info'))
+                server.schema.to_file(self._schema_cache_file('schema'))
+            except OSError:
+                # Not being able to cache only costs reading it again next time
+                pass
+
+    def _ensure_bound(self):
+        """Binds the connection if it is not bound (anymore)."""
+        if self.connection.closed or not self.connection.bound:
+            self._bind()
+
+    def _rebind(self):
+        """Drops the (broken) connection and binds again."""
+        try:
+            self.connection.unbind()
+        except ldap3.core.exceptions.LDAPException:
+            pass
+        self._bind()
+
+    @contextmanager
+    def session(self):
+        """Binds once for all the operations executed within the context.
+
+        The operations reuse the bound connection instead of binding and
+        unbinding per call. If the connection drops, it is bound again.
+        Sessions can be nested, the connection is unbound when the outermost
+        session ends.
+        """
+        if self._session_depth == 0:
+            self._bind()
+        self._session_depth += 1
+        try:
+            yield self
+        finally:
+            self._session_depth -= 1
+            if self._session_depth == 0:
+                self.connection.unbind()
+
+    def _idempotent(function):
+        """Marks the function as safe to retry after the connection dropped."""
+        function.idempotent = True
+        return function
 
     def _connect_auth_ldap(function):
         """Wrapper function that connects and authenticates to the LDAP server.
 
         The passed function will receive the open connection.
+        Within a session, idempotent functions are retried once on a new bind
+        if the connection dropped. Other functions (e.g. add and delete) are not
+        retried, as the request might already have been executed by the server.
         """
         @wraps(function)
         def wrapper_connect(self, *args, **kwargs):
+            if self._session_depth:
+                self._ensure_bound()
+                try:
+                    return function(self, *args, **kwargs)
+                except ldap3.core.exceptions.LDAPCommunicationError:
+                    # The connection dropped, bind again and retry once if safe
+                    self._rebind()
+                    if not getattr(function, 'idempotent', False):
+                        raise
+                    metrics.increment('ldap_retries')
+                    return function(self, *args, **kwargs)
             try:
-                self.connection.bind()
+                self._bind()
                 val = function(self, *args, **kwargs)
             except ldap3.core.exceptions.LDAPException as exception:
                 raise exception
@@ -45,13 +457,115 @@ class LdapWrapper:
             return val
         return wrapper_connect
 
+    def _connect_auth_ldap_generator(function):
+        """Wrapper function that connects and authenticates to the LDAP server.
+
+        Same as _connect_auth_ldap, but for generator functions. The connection
+        stays bound until the generator is exhausted or closed. Within a session
+        the connection is bound if needed, but not retried halfway, as the
+        already yielded results cannot be taken back.
+        """
+        @wraps(function)
+        def wrapper_connect(self, *args, **kwargs):
+            if self._session_depth:
+                self._ensure_bound()
+                yield from function(self, *args, **kwargs)
+                return
+            try:
+                self._bind()
+                yield from function(self, *args, **kwargs)
+            except ldap3.core.exceptions.LDAPException as exception:
+                raise exception
+            finally:
+                self.connection.unbind()
+        return wrapper_connect
+
     @_connect_auth_ldap
+    @_idempotent
     def search(self, search_base: str, filter: str = '(objectClass=*)'):
         self.connection.search(
             search_base, filter, attributes=self.search_attributes
         )
         return self.connection.entries
 
+    @_connect_auth_ldap_generator
+    def search_paged(self, search_base: str, filter: str = '(objectClass=*)',
+                     page_size: int = None, attributes: list = None,
+                     raw: bool = False):
+        """Executes a paged search (RFC 2696) and yields the entries page by page.
+
+        Only one page of entries is held in memory at a time.
+
+        Arguments:
+            page_size -- the amount of entries per page.
+                         If None, the configured page size will be used.
+            attributes -- the attributes to retrieve.
+                          If None, the search attributes of the wrapper will be used.
+            raw -- if True, yields the search responses (dicts) of the entries
+                   instead of ldap3 Entry objects, which are not built then.
+        """
+        cookie = None
+        while True:
+            with metrics.span('ldap_search', base=search_base):
+                self.connection.search(
+                    search_base,
+                    filter,
+                    attributes=attributes or self.search_attributes,
+                    paged_size=page_size or self.page_size,
+                    paged_cookie=cookie
+                )
+            responses = [
+                response for response in self.connection.response
+                if response['type'] == SEARCH_RESULT_ENTRY
+            ]
+            metrics.increment('ldap_pages', base=search_base)
+            metrics.increment('ldap_entries', len(responses), base=search_base)
+            yield from responses if raw else self.connection.entries
+            try:
+                controls = self.connection.result['controls']
+                cookie = controls[PAGED_RESULTS_CONTROL]['value']['cookie']
+            except (KeyError, TypeError):
+                cookie = None
+            # Stop on a missing or malformed cookie, so a bad response cannot loop
+            if not cookie or not isinstance(cookie, bytes):
+                break
+
+    def sync_search(self, search_base: str, filter: str = '(objectClass=*)',
+                    attributes: list = None, cookie: bytes = None,
+                    timeout: float = QUEUE_POLL_INTERVAL) -> SyncReplSearch:
+        """Subscribes to the changes of the entries via a syncrepl search.
+
+        The search runs in refreshAndPersist mode on a dedicated asynchronous
+        connection and is started right away. It is stopped by closing the
+        returned SyncReplSearch.
+
+        Arguments:
+            attributes -- the attributes to retrieve.
+                          If None, the search attributes of the wrapper will be used.
+            cookie -- resumes from the cookie of a previous search
+        """
+        server, user, password = self._connection_args
+        if server.get_info != ldap3.NONE and server.schema is None:
+            # Read the server info, which is shared with the other connections
+            self._bind()
+            self.connection.unbind()
+        connection = ldap3.Connection(
+            server, user, password, client_strategy=ldap3.ASYNC_STREAM
+        )
+        connection.bind()
+        # ldap3 only runs a search of which the responses are queued as events
+        # as a persistent search. Without changes_only, no psearch control is
+        # added.
+        search = connection.extend.standard.persistent_search(
+            search_base,
+            filter,
+            attributes=attributes or self.search_attributes,
+            controls=[sync_request_control(cookie)],
+            changes_only=False,
+            streaming=False
+        )
+        return SyncReplSearch(connection, search, timeout, cookie)
+
     @_connect_auth_ldap
     def add(self, dn: str, object_class=None, attributes=None):
         return self.connection.add(dn, object_class, attributes)
@@ -61,13 +575,196 @@ class LdapWrapper:
         return self.connection.delete(dn)
 
 
+class LdapChange:
+    """The entry of a sync search event.
+
+    Offers the part of the interface of an ldap3 Entry that the sync uses.
+    """
+
+    def __init__(self, event: dict):
+        self.change_type = event.get('changeType')
+        self.entry_dn = event['dn']
+        # Single valued attributes are not returned as a list
+        self.entry_attributes_as_dict = {
+            name: value if isinstance(value, list) else [value]
+            for name, value in event['attributes'].items()
+        }
+        attributes = CaseInsensitiveDict(self.entry_attributes_as_dict)
+        self.entryUUID = (attributes.get('entryUUID') or [None])[0]
+        self.modifyTimestamp = SimpleNamespace(
+            value=(attributes.get('modifyTimestamp') or [None])[0]
+        )
+
+
+class LdapSubscription:
+    """The changes of the orgs and people, as subscribed to via a sync search.
+
+    Iterating yields the changes as tuples (LdapChange, type) as they
+    arrive, or None if no change arrived within the timeout. Changes outside
+    of the orgs and people are skipped. A deletion that is only reported by
+    entryUUID has type None. The cookie resumes a subscription after the
+    changes that have been consumed.
+    """
+
+    def __init__(self, search: SyncReplSearch, prefixes: dict):
+        self.search = search
+        self.prefixes = prefixes
+
+    @property
+    def cookie(self) -> bytes:
+        return self.search.cookie
+
+    def __iter__(self):
+        for event in self.search:
+            if event is None:
+                yield None
+                continue
+            if event['dn'] is None:
+                yield LdapChange(event), None
+                continue
+            dn = event['dn'].lower()
+            for type, prefix in self.prefixes.items():
+                if dn.endswith(prefix):
+                    yield LdapChange(event), type
+                    break
+
+    def close(self):
+        """Stops the subscription, also if it has not been iterated yet."""
+        self.search.close()
+
 class LdapClient:
     """Acts as a client to query relevant information from LDAP"""
 
     def __init__(self, params: dict,):
         self.ldap_wrapper = LdapWrapper(params, SEARCH_ATTRIBUTES)
+        self.search_attributes = self._search_attributes(params)
+        # Base DN of the directory, under which the orgs and people are searched
+        self.suffix = params.get('suffix', LDAP_SUFFIX)
+        # Amount of shards a full sync of a type is split into
+        self.shards = params.get('shards', 1)
+        self.shard_attributes = {
+            **SHARD_ATTRIBUTES, **(params.get('shard_attributes') or {})
+        }
+
+    @staticmethod
+    def _search_attributes(params: dict) -> dict:
+        """Returns the attributes to retrieve per entity type.
+
+        Configured via the 'attributes' parameter, e.g. {'org': ['o', 'mail']}.
+        The attributes the sync depends on are always added. Defaults to
+        all user attributes.
+        """
+        attributes = params.get('attributes') or {}
+        search_attributes = {}
+        for type in ENTITY_TYPES:
+            configured = attributes.get(type)
+            if configured:
+                search_attributes[type] = list(configured) + [
+                    attribute for attribute in REQUIRED_ATTRIBUTES
+                    if attribute not in configured
+                ]
+            else:
+                search_attributes[type] = SEARCH_ATTRIBUTES
+        return search_attributes
+
+    def session(self):
+        """Returns a context manager which binds once for all searches within.
 
-    def _search(self, prefix: str, partial_filter: str, modified_at: datetime = None) -> list:
+        The session only applies to the current thread.
+        """
+        return self.ldap_wrapper.session()
+
+    def _search_into_queue(self, search, type: str, modified_at: datetime,
+                           results: queue.Queue, stop: threading.Event):
+        """Runs the search and puts the entries per page on the queue.
+
+        Blocks while the queue is full. Returns early when stop is set.
+        """
+        page_size = self.ldap_wrapper.page_size
+        with self.session():
+            entries = iter(search(modified_at))
+            page = list(islice(entries, page_size))
+            while page:
+                while True:
+                    if stop.is_set():
+                        return
+                    try:
+                        results.put((page, type), timeout=QUEUE_POLL_INTERVAL)
+                        break
+                    except queue.Full:
+                        continue
+                page = list(islice(entries, page_size))
+
+    def search_concurrently(self, searches: dict, modified_at: datetime = None,
+                            max_queued_pages: int = DEFAULT_MAX_QUEUED_PAGES):
+        """Executes the searches concurrently, each on its own connection.
+
+        Yields the results page by page as soon as any search returns them,
+        as tuples (list[LDAP_Entry], type). At most max_queued_pages pages are
+        held in memory: slow consumption throttles the searches.
+        An exception in a search is raised in the consumer.
+
+        Arguments:
+            searches -- dict of type (str) to a search function
+                        e.g. {'org': self.search_orgs}, or a list of tuples
+                        (type, search function) to run several searches per type
+            modified_at -- passed to every search function. Either a datetime
+                           or a dict of type (str) to a datetime, to search
+                           every type since its own modification time.
+        """
+        if isinstance(searches, dict):
+            searches = list(searches.items())
+        if not isinstance(modified_at, dict):
+            modified_at = {type: modified_at for type, _ in searches}
+        results = queue.Queue(maxsize=max_queued_pages)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=len(searches)) as executor:
+            futures = [
+                executor.submit(
+                    self._search_into_queue,
+                    search, type, modified_at.get(type), results, stop
+                )
+                for type, search in searches
+            ]
+            try:
+                while True:
+                    try:
+                        yield results.get(timeout=QUEUE_POLL_INTERVAL)
+                    except queue.Empty:
+                        # Raise the exception of a failed search right away
+                        for future in futures:
+                            if future.done() and future.exception() is not None:
+                                raise future.exception()
+                        # Pages could have been queued right before finishing
+                        if all(future.done() for future in futures) and results.empty():
+                            return
+            finally:
+                # Unblock the searches if the consumer stopped early or failed
+                stop.set()
+
+    def _search(self, prefix: str, partial_filter: str, modified_at: datetime = None,
+                attributes: list = None, record_type: str = None,
+                last_modified: dict = None):
+        """Searches the LDAP entries in the subtree of the prefix, e.g. 'ou=orgs'."""
+        return self._search_base(
+            f'{prefix},{self.suffix}', partial_filter, modified_at, attributes,
+            record_type, last_modified
+        )
+
+    def _search_base(self, base: str, partial_filter: str,
+                     modified_at: datetime = None, attributes: list = None,
+                     record_type: str = None, last_modified: dict = None):
+        """Searches the LDAP entries in the given subtree via a paged search.
+
+        Returns a generator which yields the LDAP entries page by page.
+        If a record type is given, it yields them as EntityRecords of the type,
+        built from the raw search responses.
+
+        Arguments:
+            last_modified -- the stored modify timestamp per entryUUID. The
+                             entries of which the modify timestamp did not
+                             change are skipped, before building a record.
+        """
         # Format modify timestamp to an LDAP filter string
         modify_filter_string = (
             ''
@@ -76,14 +773,173 @@ class LdapClient:
         )
         # Construct the LDAP filter string
         filter = f'(&(objectClass=*){partial_filter}{modify_filter_string})'
-        return self.ldap_wrapper.search(f'{prefix},{LDAP_SUFFIX}', filter)
+        if record_type is None:
+            return self.ldap_wrapper.search_paged(base, filter, attributes=attributes)
+        return self._records(
+            self.ldap_wrapper.search_paged(
+                base, filter, attributes=attributes, raw=True
+            ),
+            record_type,
+            last_modified
+        )
 
-    def search_orgs(self, modified_at: datetime = None) -> list:
+    @staticmethod
+    def _records(responses, type: str, last_modified: dict = None):
+        """Builds the EntityRecords of the search responses.
+
+        Skips the responses of which the modify timestamp equals the one in
+        last_modified. Both are time zone aware, so they are compared as
+        instants, whatever the time zone of the database session.
+        """
+        for response in responses:
+            if last_modified:
+                ldap_uuid, modify_timestamp = EntityRecord.identify(response)
+                if (
+                    modify_timestamp is not None
+                    and last_modified.get(ldap_uuid) == modify_timestamp
+                ):
+                    metrics.increment('entries_skipped', type=type)
+                    continue
+            with metrics.span('transform', type=type):
+                record = EntityRecord.from_response(response, type)
+            yield record
+
+    def search_orgs(self, modified_at: datetime = None, attributes: list = None,
+                    shard_filter: str = '', records: bool = False,
+                    last_modified: dict = None):
         return self._search(
-            LDAP_ORGS_PREFIX, f'(!({LDAP_ORGS_PREFIX}))', modified_at
+            LDAP_ORGS_PREFIX, f'(!({LDAP_ORGS_PREFIX})){shard_filter}', modified_at,
+            attributes or self.search_attributes['org'], 'org' if records else None,
+            last_modified
         )
 
-    def search_people(self, modified_at: datetime = None) -> list:
+    def search_people(self, modified_at: datetime = None, attributes: list = None,
+                      shard_filter: str = '', records: bool = False,
+                      last_modified: dict = None):
         return self._search(
-            LDAP_PEOPLE_PREFIX, f'(!({LDAP_PEOPLE_PREFIX}))', modified_at
+            LDAP_PEOPLE_PREFIX, f'(!({LDAP_PEOPLE_PREFIX})){shard_filter}', modified_at,
+            attributes or self.search_attributes['person'],
+            'person' if records else None, last_modified
+        )
+
+    def search_subtree(self, base: str, partial_filter: str, type: str,
+                       modified_at: datetime = None, attributes: list = None,
+                       shard_filter: str = '', records: bool = False,
+                       last_modified: dict = None):
+        """Searches the entries of the type in any subtree, e.g. of a sync source.
+
+        Arguments:
+            base -- the full DN of the subtree, e.g. 'ou=orgs,dc=example,dc=org'
+            partial_filter -- LDAP filter which the entries need to match,
+                              e.g. '(objectClass=organization)'
+        """
+        return self._search_base(
+            base, f'{partial_filter}{shard_filter}', modified_at,
+            attributes or self.search_attributes.get(type, SEARCH_ATTRIBUTES),
+            type if records else None, last_modified
+        )
+
+    def shard_filters(self, type: str) -> list:
+        """Returns the LDAP filters that partition the entries of the type.
+
+        The entries are split on the leading character of the shard attribute
+        of the type, in `shards` groups of characters. A last filter matches
+        the remaining entries, e.g. with another leading character or without
+        the attribute. Returns a single empty filter if sharding is disabled
+        or the type has no shard attribute.
+        """
+        shards = min(self.shards, len(SHARD_CHARACTERS))
+        attribute = self.shard_attributes.get(type)
+        if shards <= 1 or not attribute:
+            return ['']
+        size, rest = divmod(len(SHARD_CHARACTERS), shards)
+        filters = []
+        start = 0
+        for index in range(shards):
+            end = start + size + (1 if index < rest else 0)
+            filters.append('(|{})'.format(''.join(
+                f'({attribute}={character}*)'
+                for character in SHARD_CHARACTERS[start:end]
+            )))
+            start = end
+        remainder = ''.join(
+            f'(!({attribute}={character}*))' for character in SHARD_CHARACTERS
         )
+        return filters + [f'(&{remainder})']
+
+    def sharded_searches(self, type: str, search) -> list:
+        """Returns the search function per shard of the type.
+
+        Returns:
+            list -- tuples (type, search function) for search_concurrently
+        """
+        return [
+            (type, partial(search, shard_filter=shard_filter))
+            for shard_filter in self.shard_filters(type)
+        ]
+
+    def _watch_attributes(self) -> list:
+        """Returns the attributes to retrieve for the changes of all types."""
+        attributes = []
+        for type in ENTITY_TYPES:
+            attributes.extend(
+                attribute for attribute in self.search_attributes[type]
+                if attribute not in attributes
+            )
+        return attributes
+
+    def watch(self, timeout: float = QUEUE_POLL_INTERVAL, cookie: bytes = None):
+        """Subscribes to the changes of the orgs and people.
+
+        The subscription is started right away, resuming from the cookie if
+        given. Stop it by closing the returned LdapSubscription.
+        """
+        prefixes = {
+            'org': f',{LDAP_ORGS_PREFIX},{self.suffix}'.lower(),
+            'person': f',{LDAP_PEOPLE_PREFIX},{self.suffix}'.lower(),
+        }
+        search = self.ldap_wrapper.sync_search(
+            self.suffix, attributes=self._watch_attributes(), cookie=cookie,
+            timeout=timeout
+        )
+        return LdapSubscription(search, prefixes)
+
+    def search_orgs_uuids(self, modified_at: datetime = None):
+        """Searches the orgs, only retrieving their entryUUID."""
+        return self.search_orgs(modified_at, UUID_ATTRIBUTES)
+
+    def search_people_uuids(self, modified_at: datetime = None):
+        """Searches the people, only retrieving their entryUUID."""
+        return self.search_people(modified_at, UUID_ATTRIBUTES)
+
+
+class AsyncLdapClient(LdapClient):
+    """Variant of the LdapClient which yields the search results to an event loop.
+
+    ldap3 has no asyncio transport, so the searches still run concurrently on
+    their own threads and connections. The pages are handed over to the event
+    loop without blocking it.
+    """
+
+    async def search_concurrently_async(
+            self, searches, modified_at: datetime = None,
+            max_queued_pages: int = DEFAULT_MAX_QUEUED_PAGES):
+        """Same as search_concurrently, but as an async generator."""
+        loop = asyncio.get_event_loop()
+        pages = self.search_concurrently(searches, modified_at, max_queued_pages)
+        pending = None
+        try:
+            while True:
+                # Waits for the next page in the default executor
+                pending = loop.run_in_executor(None, next, pages, None)
+                page = await asyncio.shield(pending)
+                if page is None:
+                    return
+                yield page
+        finally:
+            # The generator cannot be closed while it is still executing,
+            # e.g. when the consumer got cancelled
+            if pending is not None and not pending.done():
+                await asyncio.wait([pending])
+            # Stops the searches, which can block until they notice
+            await loop.run_in_executor(None, pages.close)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+
+METRICS_PREFIX = 'ldap2deewee'
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    formatted = ','.join(
+        '{}="{}"'.format(
+            name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+        )
+        for name, value in labels
+    )
+    return f'{{{formatted}}}'
+
+
+class Metrics:
+    """Collects the timing spans and counters of a sync run.
+
+    Spans accumulate the time spent per phase (e.g. 'ldap_search'), counters
+    accumulate amounts (e.g. 'entries'). Both can have labels, e.g. the
+    subtree of a search. Metrics can be recorded from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all spans and counters, e.g. at the start of a run."""
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+
+    def add_span(self, name: str, seconds: float, **labels):
+        """Adds the duration of one occurrence of the span."""
+        key = _key(name, labels)
+        with self._lock:
+            total, count = self.spans.get(key, (0.0, 0))
+            self.spans[key] = (total + seconds, count + 1)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """Records the time spent within the context as a span."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, time.perf_counter() - start, **labels)
+
+    def increment(self, name: str, amount: int = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def merge(self, spans: dict, counters: dict, **labels):
+        """Adds the spans and counters recorded by another process.
+
+        Arguments:
+            spans, counters -- the spans and counters attributes of the
+                               Metrics of the other process
+            labels -- added to the labels of all of them, e.g. the source
+        """
+        with self._lock:
+            for (name, span_labels), (seconds, count) in spans.items():
+                key = _key(name, {**dict(span_labels), **labels})
+                total, total_count = self.spans.get(key, (0.0, 0))
+                self.spans[key] = (total + seconds, total_count + count)
+            for (name, counter_labels), amount in counters.items():
+                key = _key(name, {**dict(counter_labels), **labels})
+                self.counters[key] = self.counters.get(key, 0) + amount
+
+    def as_dict(self) -> dict:
+        """Returns the spans and counters, e.g. to log them as structured data.
+
+        The names contain the labels, e.g. 'ldap_search{base="ou=orgs"}'.
+        """
+        with self._lock:
+            return {
+                'spans': {
+                    f'{name}{_format_labels(labels)}': {
+                        'seconds': round(total, 6), 'count': count
+                    }
+                    for (name, labels), (total, count) in sorted(self.spans.items())
+                },
+                'counters': {
+                    f'{name}{_format_labels(labels)}': amount
+                    for (name, labels), amount in sorted(self.counters.items())
+                },
+            }
+
+    def to_prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            spans = sorted(self.spans.items())
+            counters = sorted(self.counters.items())
+        if spans:
+            lines.append(f'# TYPE {METRICS_PREFIX}_span_seconds_total counter')
+            lines.extend(
+                f'{METRICS_PREFIX}_span_seconds_total'
+                f'{_format_labels((("span", name),) + labels)} {total}'
+                for (name, labels), (total, _) in spans
+            )
+            lines.append(f'# TYPE {METRICS_PREFIX}_span_count_total counter')
+            lines.extend(
+                f'{METRICS_PREFIX}_span_count_total'
+                f'{_format_labels((("span", name),) + labels)} {count}'
+                for (name, labels), (_, count) in spans
+            )
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f'# TYPE {METRICS_PREFIX}_{name}_total counter')
+            lines.extend(
+                f'{METRICS_PREFIX}_{name}_total{_format_labels(labels)} {amount}'
+                for (counter_name, labels), amount in counters
+                if counter_name == name
+            )
+        return ''.join(f'{line}\n' for line in lines)
+
+    def write_textfile(self, path: str):
+        """Writes the metrics for the node exporter's textfile collector.
+
+        The file is replaced atomically, so a scrape never reads half a file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(
+            'w', dir=directory, suffix='.tmp', delete=False
+        ) as file:
+            file.write(self.to_prometheus())
+        os.replace(file.name, path)
+
+    def push(self, url: str, job: str = METRICS_PREFIX, timeout: float = 10):
+        """Pushes the metrics to a Prometheus Pushgateway.
+
+        The metrics replace the previously pushed metrics of the job.
+        """
+        request = urllib.request.Request(
+            f'{url.rstrip("/")}/metrics/job/{job}',
+            data=self.to_prometheus().encode('utf-8'),
+            method='PUT',
+            headers={'Content-Type': 'text/plain; version=0.0.4'}
+        )
+        with urllib.request.urlopen(request, timeout=timeout):
+            pass
+
+
+# The metrics of the process, recorded by the clients
+metrics = Metrics()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from dataclasses import asdict, dataclass, field
+
+from app.comm.deewee import content_hash
+
+
+# Rough size of a row besides its content: the tuple header, the other
+# columns and the entry in the ldap_uuid index
+ESTIMATED_ROW_OVERHEAD_BYTES = 100
+
+
+@dataclass
+class PlanCounts:
+    """What a sync would do with the entries of a type"""
+
+    new: int = 0
+    changed: int = 0
+    unchanged: int = 0
+    # None if the deletes are not reconciled (delete_strategy 'none')
+    deleted: int = None
+    estimated_bytes: int = 0
+
+
+@dataclass
+class SyncPlan:
+    """The changes that a sync would write, per type, without writing them."""
+
+    types: dict = field(default_factory=dict)
+
+    def counts(self, type: str) -> PlanCounts:
+        return self.types.setdefault(type, PlanCounts())
+
+    def add(self, records: list, type: str, hashes: dict):
+        """Classifies the records by comparing them to the stored hashes.
+
+        Arguments:
+            records -- list of EntityRecords
+            hashes -- the stored content hash per entryUUID of the records.
+                      An entryUUID without row is missing, a tombstoned row
+                      has a hash of None, as it would be restored.
+        """
+        counts = self.counts(type)
+        for record in records:
+            if record.ldap_uuid not in hashes:
+                counts.new += 1
+            elif hashes[record.ldap_uuid] != content_hash(record.content):
+                counts.changed += 1
+            else:
+                counts.unchanged += 1
+                continue
+            counts.estimated_bytes += (
+                len(record.content.encode('utf-8')) + ESTIMATED_ROW_OVERHEAD_BYTES
+            )
+
+    def total(self) -> PlanCounts:
+        total = PlanCounts()
+        for counts in self.types.values():
+            total.new += counts.new
+            total.changed += counts.changed
+            total.unchanged += counts.unchanged
+            total.estimated_bytes += counts.estimated_bytes
+            if counts.deleted is not None:
+                total.deleted = (total.deleted or 0) + counts.deleted
+        return total
+
+    def as_dict(self) -> dict:
+        return {type: asdict(counts) for type, counts in self.types.items()}
+
+    def format(self) -> str:
+        """Returns the plan as a table, with a row per type and a total."""
+        columns = ('new', 'changed', 'unchanged', 'deleted', 'estimated_bytes')
+        rows = [('type',) + columns]
+        for type, counts in list(self.types.items()) + [('total', self.total())]:
+            rows.append((type,) + tuple(
+                '-' if getattr(counts, column) is None else str(getattr(counts, column))
+                for column in columns
+            ))
+        widths = [max(len(row[index]) for row in rows) for index in range(len(rows[0]))]
+        return '\n'.join(
+            '  '.join(
+                value.ljust(width) if index == 0 else value.rjust(width)
+                for index, (value, width) in enumerate(zip(row, widths))
+            )
+            for row in rows
+        )
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from datetime import datetime
+from ldap3.protocol.formatters.formatters import format_time
+from ldap3.utils.ciDict import CaseInsensitiveDict
+from ldap3.utils.config import get_config_parameter
+from ldap3.utils.conv import format_json
+
+try:
+    import orjson
+except ImportError:  # orjson is an optional, faster backend
+    orjson = None
+
+# The attributes that ldap3 leaves out of its Entry objects (lower case), read
+# once from the ldap3 configuration at import
+EXCLUDED_ATTRIBUTES = frozenset(
+    name.lower() for name in get_config_parameter('ATTRIBUTES_EXCLUDED_FROM_OBJECT_DEF')
+)
+
+
+def _serialize_json(content: dict) -> str:
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(',', ':'),
+        default=format_json
+    )
+
+
+def _serialize_orjson(content: dict) -> str:
+    # Let format_json serialize datetimes, so the output equals the json backend
+    return orjson.dumps(
+        content,
+        default=format_json,
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    ).decode('utf-8')
+
+
+def serialize_entry(dn: str, attributes: dict, use_orjson: bool = True) -> str:
+    """Serializes an LDAP entry to compact JSON, for the content column.
+
+    The structure is the same as the one of ldap3's entry_to_json and values
+    are formatted the same way (e.g. datetimes as str), but the output is not
+    indented and the keys are sorted, so it is compact and stable.
+
+    Uses orjson if it is installed and use_orjson is True.
+
+    Arguments:
+        dn -- the DN of the LDAP entry
+        attributes -- dict of attribute name to a list of values
+    """
+    content = {'attributes': attributes, 'dn': dn}
+    if orjson is not None and use_orjson:
+        return _serialize_orjson(content)
+    return _serialize_json(content)
+
+
+def _first(values):
+    if isinstance(values, (list, tuple)):
+        return values[0] if values else None
+    return values
+
+
+class EntityRecord:
+    """A compact record of an LDAP entry, holding what is upserted.
+
+    Built directly from a raw search response, so that the pipeline does not
+    keep ldap3 Entry objects (with their cursor, definition and attribute
+    wrappers) alive and the entry is only serialized once.
+    """
+
+    __slots__ = ('ldap_uuid', 'type', 'content', 'last_modified_timestamp')
+
+    def __init__(self, ldap_uuid: str, type: str, content: str,
+                 last_modified_timestamp: datetime):
+        self.ldap_uuid = ldap_uuid
+        self.type = type
+        self.content = content
+        self.last_modified_timestamp = last_modified_timestamp
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, EntityRecord):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        return f'EntityRecord({self.ldap_uuid!r}, {self.type!r})'
+
+    @classmethod
+    def from_response(cls, response: dict, type: str) -> 'EntityRecord':
+        """Builds the record from an entry of ldap3's connection.response.
+
+        The content equals the serialization of the ldap3 Entry of the
+        response: the attributes that ldap3 excludes from its entries are
+        left out and all values are lists.
+        """
+        attributes = {
+            name: list(value) if isinstance(value, (list, tuple)) else [value]
+            for name, value in response['attributes'].items()
+            if name.lower() not in EXCLUDED_ATTRIBUTES
+        }
+        ldap_uuid, modify_timestamp = cls.identify(response)
+        return cls(
+            ldap_uuid, type, serialize_entry(response['dn'], attributes),
+            modify_timestamp
+        )
+
+    @staticmethod
+    def identify(response: dict) -> tuple:
+        """Returns the entryUUID and the modify timestamp of a search response.
+
+        This is cheap compared to building the record, so it allows to skip
+        entries before they are serialized.
+        """
+        lookup = CaseInsensitiveDict(response['attributes'])
+        ldap_uuid = _first(lookup.get('entryUUID'))
+        modify_timestamp = _first(lookup.get('modifyTimestamp'))
+        # Without the LDAP schema the timestamp is not converted to a datetime
+        if isinstance(modify_timestamp, str):
+            modify_timestamp = format_time(modify_timestamp.encode())
+        return None if ldap_uuid is None else str(ldap_uuid), modify_timestamp
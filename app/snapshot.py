@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import threading
+
+from app.comm.deewee import content_hash
+from app.metrics import metrics
+
+
+CREATE_SNAPSHOT_SQL = '''CREATE TABLE IF NOT EXISTS snapshot (
+    ldap_uuid TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    content_hash TEXT,
+    last_modified_timestamp TEXT
+) WITHOUT ROWID;'''
+CREATE_SNAPSHOT_TYPE_INDEX_SQL = '''CREATE INDEX IF NOT EXISTS snapshot_type_idx
+    ON snapshot (type, ldap_uuid);'''
+SAVE_SNAPSHOT_SQL = 'INSERT OR REPLACE INTO snapshot VALUES (?, ?, ?, ?);'
+DELETE_SNAPSHOT_SQL = 'DELETE FROM snapshot WHERE ldap_uuid = ?;'
+CLEAR_SNAPSHOT_SQL = 'DELETE FROM snapshot;'
+SELECT_HASHES_SQL = '''SELECT ldap_uuid, content_hash FROM snapshot
+WHERE ldap_uuid IN ({});'''
+SELECT_UUIDS_TYPE_SQL = '''SELECT ldap_uuid FROM snapshot
+WHERE type = ? ORDER BY ldap_uuid;'''
+# The user_version of the SQLite file marks a snapshot that has been seeded
+SEEDED_VERSION = 1
+# Stay below SQLite's default limit of 999 variables per statement
+MAX_VARIABLES = 900
+
+
+def _snapshot_row(ldap_uuid: str, type: str, hash: str, modify_timestamp):
+    return (
+        ldap_uuid,
+        type,
+        hash,
+        None if modify_timestamp is None else modify_timestamp.isoformat()
+    )
+
+
+def anti_merge_join(snapshot_uuids, ldap_uuids) -> list:
+    """Returns the UUIDs of the snapshot that are not in the LDAP UUIDs.
+
+    Both iterables need to be sorted, so they are compared in one pass.
+    """
+    deleted = []
+    ldap_uuids = iter(ldap_uuids)
+    ldap_uuid = next(ldap_uuids, None)
+    for snapshot_uuid in snapshot_uuids:
+        while ldap_uuid is not None and ldap_uuid < snapshot_uuid:
+            ldap_uuid = next(ldap_uuids, None)
+        if snapshot_uuid != ldap_uuid:
+            deleted.append(snapshot_uuid)
+    return deleted
+
+
+class Snapshot:
+    """Local copy of the synced state, to diff the LDAP entries without the DB.
+
+    Holds the entryUUID, type, content hash and modify timestamp of every
+    live row in a SQLite file. The snapshot is seeded from the database once
+    and then kept up to date by the syncs, so it assumes that the app is the
+    only writer of the table.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Used from the thread of the event loop and from the default executor
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(CREATE_SNAPSHOT_SQL)
+            self.connection.execute(CREATE_SNAPSHOT_TYPE_INDEX_SQL)
+
+    @property
+    def seeded(self) -> bool:
+        with self._lock:
+            version = self.connection.execute('PRAGMA user_version;').fetchone()[0]
+        return version == SEEDED_VERSION
+
+    def seed(self, rows):
+        """Replaces the snapshot by the rows of the database, at once.
+
+        Arguments:
+            rows -- iterable of (ldap_uuid, type, content_hash,
+                    last_modified_timestamp) tuples
+        """
+        with self._lock, self.connection:
+            self.connection.execute(CLEAR_SNAPSHOT_SQL)
+            self.connection.executemany(
+                SAVE_SNAPSHOT_SQL, (_snapshot_row(*row) for row in rows)
+            )
+            self.connection.execute(f'PRAGMA user_version = {SEEDED_VERSION};')
+
+    def hashes(self, ldap_uuids: list) -> dict:
+        """Returns the content hash per entryUUID of the snapshot."""
+        hashes = {}
+        with self._lock:
+            for start in range(0, len(ldap_uuids), MAX_VARIABLES):
+                chunk = ldap_uuids[start:start + MAX_VARIABLES]
+                hashes.update(self.connection.execute(
+                    SELECT_HASHES_SQL.format(', '.join('?' * len(chunk))), chunk
+                ))
+        return hashes
+
+    def changed(self, records: list, type: str, rows: list) -> list:
+        """Returns the records that are new or changed since the snapshot.
+
+        The records of a page are looked up in one query. The rows of the
+        changed records are appended to rows, to be saved once they are synced.
+
+        Arguments:
+            records -- list of EntityRecords
+            rows -- list to which the snapshot rows of the changed records
+                    are added
+        """
+        records = list(records)
+        hashes = self.hashes([record.ldap_uuid for record in records])
+        changed = []
+        for record in records:
+            hash = content_hash(record.content)
+            if hashes.get(record.ldap_uuid) != hash:
+                changed.append(record)
+                rows.append(
+                    (record.ldap_uuid, type, hash, record.last_modified_timestamp)
+                )
+        metrics.increment('entries_skipped', len(records) - len(changed), type=type)
+        return changed
+
+    def save(self, rows: list):
+        """Saves the rows of the synced entries, in one transaction.
+
+        Arguments:
+            rows -- list of (ldap_uuid, type, content_hash,
+                    last_modified_timestamp) tuples
+        """
+        with self._lock, self.connection:
+            self.connection.executemany(
+                SAVE_SNAPSHOT_SQL, (_snapshot_row(*row) for row in rows)
+            )
+
+    def deleted(self, type: str, ldap_uuids) -> list:
+        """Returns the entryUUIDs of the type that are no longer in LDAP.
+
+        The UUIDs of the snapshot are streamed in order and merge joined
+        with the sorted UUIDs of LDAP.
+
+        Arguments:
+            ldap_uuids -- the entryUUIDs (str) of all LDAP entries of the type
+        """
+        with self._lock:
+            snapshot_uuids = (
+                row[0]
+                for row in self.connection.execute(SELECT_UUIDS_TYPE_SQL, (type,))
+            )
+            return anti_merge_join(snapshot_uuids, sorted(ldap_uuids))
+
+    def remove(self, ldap_uuids: list):
+        with self._lock, self.connection:
+            self.connection.executemany(
+                DELETE_SNAPSHOT_SQL, ((ldap_uuid,) for ldap_uuid in ldap_uuids)
+            )
+
+    def close(self):
+        self.connection.close()
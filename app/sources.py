@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from functools import partial
+
+from app.comm.deewee import (
+    DeeweeClient, UpsertStats, DELETE_STRATEGY_NONE, TABLE_NAME
+)
+from app.comm.ldap import LdapClient, DEFAULT_MAX_QUEUED_PAGES, UUID_ATTRIBUTES
+from app.metrics import metrics
+
+
+# Subtrees of a source that are synced at the same time, by default
+DEFAULT_MAX_WORKERS = 1
+
+
+@dataclass
+class Subtree:
+    """A subtree of a directory, of which the entries are synced to a table.
+
+    Every entry in the subtree that matches the filter is synced as the type.
+    """
+
+    type: str
+    base: str
+    filter: str = ''
+    table: str = TABLE_NAME
+
+    def __str__(self) -> str:
+        return f'{self.type} in {self.base} to {self.table}'
+
+
+@dataclass
+class SyncSource:
+    """A directory with the subtrees to sync from it.
+
+    The ldap parameters are those of the ldap section, with the overrides of
+    the source, e.g. its URI and bind. The schema_cache of the ldap section is
+    not inherited, as it caches the schema of another server: a source only
+    caches its schema if it sets a schema_cache of its own. At most
+    max_workers subtrees of the source are synced at the same time, to limit
+    the load on the directory.
+    """
+
+    name: str
+    ldap_params: dict
+    max_workers: int = DEFAULT_MAX_WORKERS
+    subtrees: list = field(default_factory=list)
+
+
+@dataclass
+class SubtreeResult:
+    """The outcome of the sync of a subtree, as returned by its worker"""
+
+    stats: UpsertStats
+    # None if the deletes are not reconciled (delete_strategy 'none')
+    removed: int = None
+    # The spans and counters of the Metrics of the worker
+    spans: dict = field(default_factory=dict)
+    counters: dict = field(default_factory=dict)
+
+
+def parse_sources(sync_params: dict, ldap_params: dict) -> list:
+    """Returns the SyncSources configured in the sync section.
+
+    Raises a ValueError if the configuration is invalid. Every (table, type)
+    can only be synced from one subtree, as the watermark and the deletes
+    are kept per type of a table.
+    """
+    sources = []
+    names = set()
+    targets = set()
+    for source_params in sync_params.get('sources') or []:
+        name = source_params.get('name')
+        if not name or name in names:
+            raise ValueError(f"Every source needs a unique name, got '{name}'")
+        names.add(name)
+        max_workers = source_params.get('max_workers', DEFAULT_MAX_WORKERS)
+        if max_workers < 1:
+            raise ValueError(f"Invalid max_workers {max_workers} of source '{name}'")
+        inherited = {
+            key: value for key, value in ldap_params.items() if key != 'schema_cache'
+        }
+        source = SyncSource(
+            name, {**inherited, **(source_params.get('ldap') or {})}, max_workers
+        )
+        for subtree_params in source_params.get('subtrees') or []:
+            try:
+                subtree = Subtree(**subtree_params)
+            except TypeError as e:
+                raise ValueError(f"Invalid subtree of source '{name}': {e}")
+            if (subtree.table, subtree.type) in targets:
+                raise ValueError(
+                    f"The type '{subtree.type}' of table '{subtree.table}' "
+                    "is synced from more than one subtree"
+                )
+            targets.add((subtree.table, subtree.type))
+            source.subtrees.append(subtree)
+        sources.append(source)
+    return sources
+
+
+def sync_subtree(ldap_params: dict, postgresql_params: dict,
+                 subtree: Subtree) -> SubtreeResult:
+    """Syncs the entries of the subtree to its table, since its watermark.
+
+    Runs in a worker process, with clients of its own. A full sync is split
+    into shards like the sync of the App. The deletes are reconciled if a
+    delete_strategy is configured.
+    """
+    metrics.reset()
+    ldap_client = LdapClient(ldap_params)
+    # The client pops its parameters
+    deewee_client = DeeweeClient({**postgresql_params, 'table': subtree.table})
+    max_queued_pages = deewee_client.max_queued_pages or DEFAULT_MAX_QUEUED_PAGES
+    try:
+        with metrics.span('sync'):
+            modified_since = deewee_client.watermarks((subtree.type,))
+            search = partial(
+                ldap_client.search_subtree, subtree.base, subtree.filter,
+                subtree.type, records=True
+            )
+            if modified_since.get(subtree.type) is None:
+                searches = ldap_client.sharded_searches(subtree.type, search)
+            else:
+                searches = [(subtree.type, search)]
+            stats = deewee_client.upsert_ldap_results_many(
+                ldap_client.search_concurrently(
+                    searches, modified_since, max_queued_pages
+                )
+            )
+            removed = None
+            if deewee_client.delete_strategy != DELETE_STRATEGY_NONE:
+                ldap_uuids = ldap_client.search_concurrently(
+                    [(subtree.type, partial(
+                        ldap_client.search_subtree, subtree.base, subtree.filter,
+                        subtree.type, attributes=UUID_ATTRIBUTES
+                    ))],
+                    max_queued_pages=max_queued_pages
+                )
+                removed = deewee_client.reconcile_ldap_uuids(
+                    ldap_uuids, (subtree.type,)
+                ).get(subtree.type, 0)
+    finally:
+        deewee_client.close()
+    return SubtreeResult(stats, removed, dict(metrics.spans), dict(metrics.counters))
+
+
+def run_sources(sources: list, postgresql_params: dict, processes: int = None,
+                executor_class=ProcessPoolExecutor):
+    """Syncs the subtrees of all sources in a pool of worker processes.
+
+    The subtrees are synced in the order of their source, respecting the
+    max_workers of every source. Yields the subtrees with their result as
+    tuples (SyncSource, Subtree, Future) as soon as they are synced. A failed
+    subtree does not stop the others: the Future holds its exception.
+
+    Arguments:
+        processes -- the size of the pool, defaults to the amount of CPUs
+    """
+    pending = {source.name: list(source.subtrees) for source in sources}
+    active = {source.name: 0 for source in sources}
+    running = {}
+    with executor_class(max_workers=processes or os.cpu_count()) as executor:
+
+        def submit():
+            for source in sources:
+                while pending[source.name] and active[source.name] < source.max_workers:
+                    subtree = pending[source.name].pop(0)
+                    future = executor.submit(
+                        sync_subtree, source.ldap_params, postgresql_params, subtree
+                    )
+                    running[future] = (source, subtree)
+                    active[source.name] += 1
+
+        submit()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                source, subtree = running.pop(future)
+                active[source.name] -= 1
+                yield source, subtree, future
+            submit()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmarks the stages of the sync path with synthetic LDAP entries.
+
+The LDAP server is an ldap3 MOCK_SYNC server filled with synthetic orgs and
+people. The upsert strategies are benchmarked against a PostgreSQL database:
+either the one of --dsn, or a temporary one via testing.postgresql (requires
+`initdb`). Without database, only the LDAP and transformation stages run.
+
+Every stage records its duration, throughput and the peak RSS of the process
+so far, e.g.:
+
+    python3 -m benchmarks.bench_sync --orgs 1000 --people 10000
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+import ldap3
+import psycopg2
+
+from app.comm.deewee import (
+    DeeweeClient, UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY
+)
+from app.comm.ldap import (
+    LdapClient, LdapWrapper, LDAP_SUFFIX, LDAP_ORGS_PREFIX, LDAP_PEOPLE_PREFIX,
+    SEARCH_ATTRIBUTES
+)
+from app.serialization import EntityRecord
+
+
+INIT_SQL_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'additional_containers', 'postgresql', 'init.sql'
+)
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of the process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(results: list, stage: str, count: int, function):
+    """Executes the function and records the duration of the stage.
+
+    Returns the return value of the function.
+    """
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    result = {
+        'stage': stage,
+        'count': count,
+        'seconds': round(seconds, 3),
+        'per_second': round(count / seconds) if seconds else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    results.append(result)
+    print(
+        f"{stage:<32} {count:>9} entries {seconds:>9.3f} s "
+        f"{result['per_second'] or 0:>9}/s {result['peak_rss_mb']:>9.1f} MiB peak RSS",
+        flush=True
+    )
+    return value
+
+
+def mock_ldap_client(params: dict) -> LdapClient:
+    """Returns an LdapClient of which the wrapper connects to an ldap3 mock server."""
+    ldap_client = LdapClient(params)
+    ldap_client.ldap_wrapper = LdapWrapper(
+        params, SEARCH_ATTRIBUTES, get_info=ldap3.OFFLINE_SLAPD_2_4,
+        client_strategy=ldap3.MOCK_SYNC
+    )
+    return ldap_client
+
+
+def fill_ldap(ldap_wrapper: LdapWrapper, orgs: int, people: int):
+    """Adds the synthetic orgs and people to the mock server."""
+    strategy = ldap_wrapper.connection.strategy
+    modify_timestamp = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    strategy.add_entry(LDAP_SUFFIX, {'objectClass': 'dcObject', 'dc': 'hetarchief'})
+    for prefix in (LDAP_ORGS_PREFIX, LDAP_PEOPLE_PREFIX):
+        strategy.add_entry(
+            f'{prefix},{LDAP_SUFFIX}',
+            {'objectClass': 'organizationalUnit', 'ou': prefix.split('=')[1]}
+        )
+    for index in range(orgs):
+        strategy.add_entry(f'o=org{index},{LDAP_ORGS_PREFIX},{LDAP_SUFFIX}', {
+            'objectClass': 'organization',
+            'o': f'org{index}',
+            'description': f'Synthetic organization {index}',
+            'telephoneNumber': f'+32 9 {index:07d}',
+            'entryUUID': str(uuid.uuid4()),
+            'modifyTimestamp': modify_timestamp + timedelta(seconds=index),
+        })
+    for index in range(people):
+        mail = f'user{index}@org{index % max(orgs, 1)}.be'
+        strategy.add_entry(f'mail={mail},{LDAP_PEOPLE_PREFIX},{LDAP_SUFFIX}', {
+            'objectClass': 'inetOrgPerson',
+            'mail': mail,
+            'cn': f'User {index}',
+            'sn': f'{index}',
+            'givenName': 'User',
+            'o': f'org{index % max(orgs, 1)}',
+            'entryUUID': str(uuid.uuid4()),
+            'modifyTimestamp': modify_timestamp + timedelta(seconds=index),
+        })
+
+
+def init_database(dsn: dict):
+    """Creates the schema, if needed, and empties the tables."""
+    with open(INIT_SQL_FILE) as file:
+        init_sql = file.read()
+    conn = psycopg2.connect(**dsn)
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute(init_sql)
+    finally:
+        conn.close()
+
+
+def bench_postgresql(results: list, dsn: dict, ldap_results: list, count: int,
+                     batch_size: int):
+    """Benchmarks the upsert strategies and the full rebuild."""
+    init_database(dsn)
+    for upsert_strategy in (UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY):
+        deewee_client = DeeweeClient(
+            dict(dsn, upsert_strategy=upsert_strategy, batch_size=batch_size)
+        )
+        try:
+            deewee_client.truncate_table()
+            measure(
+                results, f'upsert {upsert_strategy} (insert)', count,
+                lambda: deewee_client.upsert_ldap_results_many(ldap_results)
+            )
+            measure(
+                results, f'upsert {upsert_strategy} (unchanged)', count,
+                lambda: deewee_client.upsert_ldap_results_many(ldap_results)
+            )
+        finally:
+            deewee_client.close()
+    deewee_client = DeeweeClient(dict(dsn, batch_size=batch_size))
+    try:
+        measure(
+            results, 'rebuild', count,
+            lambda: deewee_client.rebuild_ldap_results(ldap_results)
+        )
+    finally:
+        deewee_client.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orgs', type=int, default=1000)
+    parser.add_argument('--people', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument(
+        '--dsn', help='libpq connection string of the PostgreSQL database to use'
+    )
+    parser.add_argument(
+        '--output', help='file to which the results are written as JSON'
+    )
+    args = parser.parse_args(args)
+
+    results = []
+    count = args.orgs + args.people
+    ldap_client = mock_ldap_client({'URI': 'mock', 'page_size': args.page_size})
+    measure(
+        results, 'fill mock LDAP', count,
+        lambda: fill_ldap(ldap_client.ldap_wrapper, args.orgs, args.people)
+    )
+
+    def search():
+        return (
+            list(ldap_client.search_orgs()),
+            list(ldap_client.search_people())
+        )
+    orgs, people = measure(results, 'LDAP paged search', count, search)
+    measure(
+        results, 'LDAP concurrent search', count,
+        lambda: [
+            entry for page, _ in ldap_client.search_concurrently({
+                'org': ldap_client.search_orgs,
+                'person': ldap_client.search_people
+            })
+            for entry in page
+        ]
+    )
+
+    deewee_client = DeeweeClient({})
+    measure(
+        results, '_prepare_vars_upsert', count,
+        lambda: [
+            deewee_client._prepare_vars_upsert(entry, type)
+            for entries, type in ((orgs, 'org'), (people, 'person'))
+            for entry in entries
+        ]
+    )
+
+    # The record path of the sync, which builds no ldap3 Entry objects
+    def search_raw():
+        return [
+            (
+                list(ldap_client.ldap_wrapper.search_paged(
+                    f'{prefix},{LDAP_SUFFIX}', f'(!({prefix}))', raw=True
+                )),
+                type
+            )
+            for prefix, type in (
+                (LDAP_ORGS_PREFIX, 'org'), (LDAP_PEOPLE_PREFIX, 'person')
+            )
+        ]
+    responses = measure(results, 'LDAP paged search (raw)', count, search_raw)
+    measure(
+        results, 'EntityRecord.from_response', count,
+        lambda: [
+            EntityRecord.from_response(response, type)
+            for type_responses, type in responses
+            for response in type_responses
+        ]
+    )
+
+    def search_records():
+        return (
+            list(ldap_client.search_orgs(records=True)),
+            list(ldap_client.search_people(records=True))
+        )
+    org_records, person_records = measure(
+        results, 'LDAP paged search (records)', count, search_records
+    )
+    measure(
+        results, 'LDAP concurrent search (records)', count,
+        lambda: [
+            record for page, _ in ldap_client.search_concurrently({
+                'org': partial(ldap_client.search_orgs, records=True),
+                'person': partial(ldap_client.search_people, records=True)
+            })
+            for record in page
+        ]
+    )
+    measure(
+        results, '_prepare_vars_upsert (records)', count,
+        lambda: [
+            deewee_client._prepare_vars_upsert(record, type)
+            for records, type in ((org_records, 'org'), (person_records, 'person'))
+            for record in records
+        ]
+    )
+
+    # The database is written from records, like the sync does
+    ldap_results = [(org_records, 'org'), (person_records, 'person')]
+    if args.dsn:
+        dsn = psycopg2.extensions.parse_dsn(args.dsn)
+        bench_postgresql(results, dsn, ldap_results, count, args.batch_size)
+    else:
+        try:
+            from testing.postgresql import Postgresql
+            postgresql = Postgresql()
+        except (ImportError, RuntimeError) as error:
+            print(f'Skipping the PostgreSQL benchmarks: {error}', flush=True)
+        else:
+            try:
+                bench_postgresql(
+                    results, postgresql.dsn(), ldap_results, count, args.batch_size
+                )
+            finally:
+                postgresql.stop()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
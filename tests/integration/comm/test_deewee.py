@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import pytest
 import psycopg2
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from ldap3 import Server, Connection, MOCK_SYNC, ALL_ATTRIBUTES, OFFLINE_SLAPD_2_4
 from testing.postgresql import PostgresqlFactory
 import os
+from types import SimpleNamespace
 
 from app.comm.deewee import (
-    PostgresqlWrapper, DeeweeClient,
-    COUNT_ENTITIES_SQL, TABLE_NAME
+    PostgresqlWrapper, DeeweeClient, AsyncDeeweeClient,
+    COUNT_ENTITIES_SQL, TABLE_NAME, SYNC_STATE_TABLE_NAME,
+    UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY, UpsertStats, BatchSizer,
+    DELETE_STRATEGY_DELETE, DELETE_STRATEGY_TOMBSTONE, COMMIT_MODE_BATCH
 )
 
 
@@ -97,7 +101,7 @@ class TestDeeweeClient:
         deewee_client.truncate_table()
         return deewee_client
 
-    def _mock_orgs_people(self):
+    def _mock_orgs_people(self, modify_timestamp: datetime = None):
         """Creates and returns some LDAP entries via ldap3 mock functionality"""
         # Create mock server with openLDAP schema
         server = Server('mock_server', get_info=OFFLINE_SLAPD_2_4)
@@ -112,7 +116,7 @@ class TestDeeweeClient:
             {'userPassword': 'Secret123', 'sn': 'admin_sn'}
         )
 
-        now = datetime.now()
+        now = modify_timestamp or datetime.now()
         conn.bind()
         # Create orgs OU
         conn.add('ou=orgs,dc=hetarchief,dc=be', 'organizationalUnit')
@@ -156,6 +160,55 @@ class TestDeeweeClient:
         deewee_client.insert_entity(now)
         assert deewee_client.max_last_modified_timestamp() == now
 
+    def test_max_last_modified_timestamp_per_type(self, deewee_client):
+        now = datetime.now()
+        deewee_client.insert_entity(now - timedelta(days=1))
+        orgs, people = self._mock_orgs_people(now)
+        deewee_client.upsert_ldap_results_many([(orgs, 'org')])
+        assert deewee_client.max_last_modified_timestamp() == now
+
+    @pytest.mark.parametrize('upsert_strategy', [UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY])
+    def test_watermarks(self, deewee_client, upsert_strategy):
+        deewee_client.upsert_strategy = upsert_strategy
+        now = datetime.now()
+        assert deewee_client.watermarks(('org', 'person')) == {'org': None, 'person': None}
+        orgs, people = self._mock_orgs_people(now)
+        deewee_client.upsert_ldap_results_many([(orgs, 'org')])
+        assert deewee_client.watermarks(('org', 'person')) == {'org': now, 'person': None}
+        # The watermark does not move backwards
+        orgs, people = self._mock_orgs_people(now - timedelta(days=1))
+        deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+        assert deewee_client.watermarks(('org', 'person')) == {
+            'org': now, 'person': now - timedelta(days=1)
+        }
+
+    def test_watermarks_fallback(self, deewee_client):
+        now = datetime.now()
+        deewee_client.insert_entity(now)
+        assert deewee_client.watermarks(('org', 'person')) == {'org': None, 'person': now}
+
+    def test_query_content_attributes(self, deewee_client):
+        orgs, people = self._mock_orgs_people()
+        deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+        assert deewee_client.count_where(
+            "content->'attributes' @> %s", ('{"mail": ["test1@test.test"]}',)
+        ) == 1
+        assert deewee_client.count_where(
+            "content #>> '{attributes,o,0}' = %s", ('2',)
+        ) == 1
+
+    def test_content_indexes(self, deewee_client):
+        select_sql = 'SELECT indexname FROM pg_indexes WHERE tablename = %s;'
+        indexes = {
+            row[0] for row in deewee_client.postgresql_wrapper.execute(
+                select_sql, (TABLE_NAME,)
+            )
+        }
+        assert {
+            'entities_attributes_idx', 'entities_mail_idx', 'entities_o_idx',
+            'entities_type_last_modified_timestamp_idx'
+        } <= indexes
+
     def test_upsert_ldap_results_many(self, deewee_client):
         orgs, people = self._mock_orgs_people()
         assert deewee_client.count() == 0
@@ -163,7 +216,250 @@ class TestDeeweeClient:
         assert deewee_client.count_type('org') == 2
         assert deewee_client.count_type('person') == 2
 
+    @pytest.mark.parametrize('upsert_strategy', [UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY])
+    def test_upsert_ldap_results_many_batches(self, deewee_client, upsert_strategy):
+        orgs, people = self._mock_orgs_people()
+        deewee_client.batch_sizer = BatchSizer(1, 1, 1)
+        deewee_client.upsert_strategy = upsert_strategy
+        stats = deewee_client.upsert_ldap_results_many(
+            [(iter(orgs), 'org'), (iter(people), 'person')]
+        )
+        assert stats == UpsertStats(inserted=4, updated=0, unchanged=0)
+        assert deewee_client.count_type('org') == 2
+        assert deewee_client.count_type('person') == 2
+
+        # Upserting the same entries again should not write any rows
+        stats = deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+        assert stats == UpsertStats(inserted=0, updated=0, unchanged=4)
+        assert deewee_client.count() == 4
+
+    @pytest.mark.parametrize('upsert_strategy', [UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY])
+    def test_upsert_commit_batches(self, deewee_client, upsert_strategy):
+        orgs, people = self._mock_orgs_people()
+        deewee_client.batch_sizer = BatchSizer(1)
+        deewee_client.upsert_strategy = upsert_strategy
+        deewee_client.commit_mode = COMMIT_MODE_BATCH
+
+        def failing_people():
+            yield from people[:1]
+            raise psycopg2.OperationalError('failover')
+        with pytest.raises(psycopg2.OperationalError):
+            deewee_client.upsert_ldap_results_many(
+                [(orgs, 'org'), (failing_people(), 'person')]
+            )
+        # The committed batches are kept, the watermarks are not saved yet
+        select_sync_state_sql = f'SELECT count(*) FROM {SYNC_STATE_TABLE_NAME};'
+        assert deewee_client.count_type('org') == 2
+        assert deewee_client.count_type('person') == 1
+        assert deewee_client.postgresql_wrapper.execute(select_sync_state_sql) == [(0,)]
+
+        stats = deewee_client.upsert_ldap_results_many(
+            [(orgs, 'org'), (people, 'person')]
+        )
+        assert stats == UpsertStats(inserted=1, updated=0, unchanged=3)
+        assert deewee_client.postgresql_wrapper.execute(select_sync_state_sql) == [(2,)]
+
+    @pytest.mark.parametrize('upsert_strategy', [UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY])
+    def test_upsert_changed_content(self, deewee_client, upsert_strategy):
+        deewee_client.upsert_strategy = upsert_strategy
+        orgs, people = self._mock_orgs_people()
+        deewee_client.upsert_ldap_results_many([(orgs, 'org')])
+        # The same orgs, but with another content
+        changed_orgs = [
+            SimpleNamespace(
+                entryUUID=org.entryUUID, modifyTimestamp=org.modifyTimestamp,
+                entry_dn=org.entry_dn, entry_attributes_as_dict=org.entry_attributes_as_dict
+            )
+            for org in orgs
+        ]
+        changed_orgs[0].entry_attributes_as_dict = {'changed': [True]}
+        stats = deewee_client.upsert_ldap_results_many([(changed_orgs, 'org')])
+        assert stats == UpsertStats(inserted=0, updated=1, unchanged=1)
+
+    def test_upsert_strategies_same_rows(self):
+        """Both strategies should store the same values, also on a non-UTC server"""
+        params = self.postgresql.dsn()
+        params['options'] = '-c timezone=America/New_York'
+        deewee_client = DeeweeClient(params)
+        orgs, people = self._mock_orgs_people(
+            datetime(2020, 2, 2, 12, tzinfo=timezone(timedelta(hours=2)))
+        )
+        select_sql = f'''SELECT ldap_uuid, type, content::text, last_modified_timestamp
+            FROM {TABLE_NAME} ORDER BY ldap_uuid;'''
+        rows = {}
+        for upsert_strategy in [UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY]:
+            deewee_client.truncate_table()
+            deewee_client.upsert_strategy = upsert_strategy
+            deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+            rows[upsert_strategy] = deewee_client.postgresql_wrapper.execute(select_sql)
+        deewee_client.truncate_table()
+        deewee_client.close()
+        assert len(rows[UPSERT_STRATEGY_VALUES]) == 4
+        assert rows[UPSERT_STRATEGY_VALUES] == rows[UPSERT_STRATEGY_COPY]
+
+    def test_upsert_async_same_rows(self):
+        """The asyncio engine should store the same values as the copy strategy"""
+        deewee_client = AsyncDeeweeClient(self.postgresql.dsn())
+        deewee_client.upsert_strategy = UPSERT_STRATEGY_COPY
+        orgs, people = self._mock_orgs_people(
+            datetime(2020, 2, 2, 12, tzinfo=timezone(timedelta(hours=2)))
+        )
+        select_sql = f'''SELECT ldap_uuid, type, content::text, last_modified_timestamp
+            FROM {TABLE_NAME} ORDER BY ldap_uuid;'''
+
+        async def pages():
+            yield orgs, 'org'
+            yield people, 'person'
+
+        async def upsert_async():
+            try:
+                return await deewee_client.upsert_ldap_results_many_async(pages())
+            finally:
+                await deewee_client.close_async()
+
+        deewee_client.truncate_table()
+        deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+        rows = deewee_client.postgresql_wrapper.execute(select_sql)
+        watermarks = deewee_client.watermarks(('org', 'person'))
+        deewee_client.truncate_table()
+        stats = asyncio.run(upsert_async())
+        assert stats == UpsertStats(inserted=4, updated=0, unchanged=0)
+        assert deewee_client.postgresql_wrapper.execute(select_sql) == rows
+        # The watermarks are converted to the column like the psycopg2 ones
+        assert watermarks['org'] is not None
+        assert deewee_client.watermarks(('org', 'person')) == watermarks
+        deewee_client.truncate_table()
+        deewee_client.close()
+
+    @pytest.mark.parametrize('upsert_strategy', [UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY])
+    def test_upsert_duplicate_entries(self, deewee_client, upsert_strategy):
+        orgs, people = self._mock_orgs_people()
+        deewee_client.upsert_strategy = upsert_strategy
+        stats = deewee_client.upsert_ldap_results_many(
+            [(orgs, 'org'), (orgs, 'org'), (people, 'person')]
+        )
+        assert stats.total == 4
+        assert deewee_client.count() == 4
+
+    def test_last_modified_index(self, deewee_client):
+        orgs, people = self._mock_orgs_people()
+        deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+        index = deewee_client.last_modified_index(
+            {'org': None, 'person': datetime.now() + timedelta(days=1)}
+        )
+        assert set(index['org']) == {str(org.entryUUID) for org in orgs}
+        # The timestamps are time zone aware, like those of LDAP
+        for org in orgs:
+            assert index['org'][str(org.entryUUID)] == org.modifyTimestamp.value
+        # Only the rows after the watermark are loaded
+        assert index['person'] == {}
+
+    def test_content_hashes(self, deewee_client):
+        orgs, people = self._mock_orgs_people()
+        deewee_client.upsert_ldap_results_many([(orgs, 'org')])
+        deewee_client.delete_strategy = DELETE_STRATEGY_TOMBSTONE
+        deewee_client.remove_ldap_uuids([str(orgs[1].entryUUID)])
+        ldap_uuids = [str(org.entryUUID) for org in orgs] + [str(uuid.uuid4())]
+        hashes = deewee_client.content_hashes(ldap_uuids)
+        assert hashes == {
+            ldap_uuids[0]: deewee_client._prepare_vars_upsert(orgs[0], 'org')[3],
+            ldap_uuids[1]: None,
+        }
+        # Tombstoned rows are not live
+        assert deewee_client.live_ldap_uuids('org') == [ldap_uuids[0]]
+
     def insert_count(self, deewee_client):
         assert deewee_client.count() == 0
         deewee_client.insert_entity()
         assert deewee_client.count() == 1
+
+    def test_reconcile_ldap_uuids_delete(self, deewee_client):
+        orgs, people = self._mock_orgs_people()
+        deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+        deewee_client.insert_entity()
+        deewee_client.delete_strategy = DELETE_STRATEGY_DELETE
+        # The second org got deleted in LDAP
+        removed = deewee_client.reconcile_ldap_uuids([(orgs[:1], 'org')], ('org',))
+        assert removed == {'org': 1}
+        assert deewee_client.count_type('org') == 1
+        # Only the reconciled types are affected
+        assert deewee_client.count_type('person') == 3
+
+    def test_reconcile_ldap_uuids_tombstone(self, deewee_client):
+        orgs, people = self._mock_orgs_people()
+        deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+        deewee_client.delete_strategy = DELETE_STRATEGY_TOMBSTONE
+        # The people are all gone from LDAP
+        removed = deewee_client.reconcile_ldap_uuids(
+            [(orgs[:1], 'org')], ('org', 'person')
+        )
+        assert removed == {'org': 1, 'person': 2}
+        assert deewee_client.count_where('deleted_timestamp IS NOT NULL') == 3
+        # Tombstoned rows are not tombstoned again
+        removed = deewee_client.reconcile_ldap_uuids([(orgs[:1], 'org')], ('org',))
+        assert removed == {}
+        # A reappearing LDAP entry is restored, even if its content is unchanged
+        stats = deewee_client.upsert_ldap_results_many([(orgs, 'org')])
+        assert stats == UpsertStats(inserted=0, updated=1, unchanged=1)
+        assert deewee_client.count_where('deleted_timestamp IS NOT NULL') == 2
+
+    @pytest.mark.parametrize('delete_strategy', [
+        DELETE_STRATEGY_DELETE, DELETE_STRATEGY_TOMBSTONE
+    ])
+    def test_remove_ldap_uuids(self, deewee_client, delete_strategy):
+        orgs, people = self._mock_orgs_people()
+        deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+        deewee_client.delete_strategy = delete_strategy
+        removed = deewee_client.remove_ldap_uuids(
+            [str(orgs[0].entryUUID), str(uuid.uuid4())]
+        )
+        assert removed == 1
+        assert deewee_client.count_where(
+            'ldap_uuid = %s AND deleted_timestamp IS NULL', (str(orgs[0].entryUUID),)
+        ) == 0
+        assert deewee_client.count_where('deleted_timestamp IS NULL') == 3
+
+    @pytest.mark.parametrize('upsert_strategy', [UPSERT_STRATEGY_VALUES, UPSERT_STRATEGY_COPY])
+    def test_rebuild_ldap_results(self, deewee_client, upsert_strategy):
+        deewee_client.upsert_strategy = upsert_strategy
+        orgs, people = self._mock_orgs_people()
+        deewee_client.upsert_ldap_results_many([(orgs, 'org'), (people, 'person')])
+        select_indexes_sql = 'SELECT indexname FROM pg_indexes WHERE tablename = %s;'
+        indexes = deewee_client.postgresql_wrapper.execute(
+            select_indexes_sql, (TABLE_NAME,)
+        )
+        deewee_client.postgresql_wrapper.execute(
+            f"GRANT SELECT ON {TABLE_NAME} TO PUBLIC;"
+            f"COMMENT ON TABLE {TABLE_NAME} IS 'LDAP entries';"
+        )
+        select_privileges_sql = '''SELECT relacl::text, obj_description(oid, 'pg_class')
+FROM pg_class WHERE relname = %s;'''
+        privileges = deewee_client.postgresql_wrapper.execute(
+            select_privileges_sql, (TABLE_NAME,)
+        )
+
+        # The second org got deleted in LDAP
+        count = deewee_client.rebuild_ldap_results(
+            [(orgs[:1] + orgs[:1], 'org'), (people, 'person')]
+        )
+        assert count == 3
+        assert deewee_client.count_type('org') == 1
+        assert deewee_client.count_type('person') == 2
+        # The indexes and constraints are recreated with their names
+        assert sorted(deewee_client.postgresql_wrapper.execute(
+            select_indexes_sql, (TABLE_NAME,)
+        )) == sorted(indexes)
+        persistence_sql = 'SELECT relpersistence FROM pg_class WHERE relname = %s;'
+        assert deewee_client.postgresql_wrapper.execute(
+            persistence_sql, (TABLE_NAME,)
+        ) == [('p',)]
+        # The privileges and the comment are kept
+        assert deewee_client.postgresql_wrapper.execute(
+            select_privileges_sql, (TABLE_NAME,)
+        ) == privileges
+
+        # Upserts (ON CONFLICT) and the serial column keep working
+        stats = deewee_client.upsert_ldap_results_many([(orgs, 'org')])
+        assert stats == UpsertStats(inserted=1, updated=0, unchanged=1)
+        deewee_client.insert_entity()
+        assert deewee_client.count() == 5
@@ -14,8 +14,11 @@ from app.comm.ldap import (
     LdapClient,
     SEARCH_ATTRIBUTES,
     LDAP_PEOPLE_PREFIX,
-    LDAP_ORGS_PREFIX
+    LDAP_ORGS_PREFIX,
+    SHARD_ATTRIBUTES
 )
+from app.serialization import EntityRecord
+from app.comm.deewee import DeeweeClient
 
 
 LDAP_SUFFIX = 'dc=hetarchief,dc=be'
@@ -47,6 +50,10 @@ class LdapClientMock(LdapClient):
 
     def __init__(self, params: dict):
         self.ldap_wrapper = LdapWrapperMock(params, SEARCH_ATTRIBUTES)
+        self.search_attributes = LdapClient._search_attributes(params)
+        self.suffix = params.get('suffix', LDAP_SUFFIX)
+        self.shards = params.get('shards', 1)
+        self.shard_attributes = SHARD_ATTRIBUTES
 
 
 class TestLdapWrapperMock:
@@ -60,6 +67,14 @@ class TestLdapWrapperMock:
         search_result = ldap_wrapper.search(LDAP_ORGS)
         assert search_result is not None
 
+    def test_search_paged(self, ldap_wrapper):
+        for i in range(3):
+            ldap_wrapper.add(f'o=paged{i},{LDAP_ORGS}', 'organization', {'o': f'paged{i}'})
+        search_result = list(ldap_wrapper.search_paged(LDAP_ORGS, page_size=2))
+        assert len(search_result) == len(ldap_wrapper.search(LDAP_ORGS))
+        for i in range(3):
+            ldap_wrapper.delete(f'o=paged{i},{LDAP_ORGS}')
+
     def test_search_invalid_search(self, ldap_wrapper):
         with pytest.raises(ldap3.core.exceptions.LDAPInvalidDnError) as ldap_error:
             ldap_wrapper.search('invalid')
@@ -70,6 +85,15 @@ class TestLdapWrapperMock:
             ldap_wrapper.add('dn')
         assert ldap_error.value.args[0] is not None
 
+    def test_session(self, ldap_wrapper):
+        dn = f'o=test2,{LDAP_ORGS}'
+        with ldap_wrapper.session():
+            assert ldap_wrapper.add(dn, 'organization', {'o': 'test2'})
+            assert any(entry.entry_dn == dn for entry in ldap_wrapper.search(LDAP_ORGS))
+            assert ldap_wrapper.delete(dn)
+            assert ldap_wrapper.connection.bound
+        assert not ldap_wrapper.connection.bound
+
     def test_add_delete(self, ldap_wrapper):
         dn = f'o=test1,{LDAP_ORGS}'
         add_result = ldap_wrapper.add(dn, 'organization', {'o': 'test1'})
@@ -99,7 +123,11 @@ class TestLdapClientMock:
     def setup_class(cls):
         """ Create two orgs and two people"""
         cls.ldap_client = LdapClientMock(ldap_config_dict)
-        ldap_wrapper = cls.ldap_client.ldap_wrapper
+        with cls.ldap_client.session():
+            cls._add_orgs_people(cls.ldap_client.ldap_wrapper)
+
+    @staticmethod
+    def _add_orgs_people(ldap_wrapper):
         ldap_wrapper.add(
             DN_ORG1,
             'organization',
@@ -138,7 +166,7 @@ class TestLdapClientMock:
         return ldap_entry.modifyTimestamp.value
 
     def test_search_orgs(self):
-        ldap_orgs = self.ldap_client.search_orgs()
+        ldap_orgs = list(self.ldap_client.search_orgs())
         assert len(ldap_orgs) == 2
         assert any(ldap_entry.entry_dn == DN_ORG2 for ldap_entry in ldap_orgs)
 
@@ -146,16 +174,66 @@ class TestLdapClientMock:
         max_timestamp = last_modified_entry.modifyTimestamp.value
         # Timestamp greater than last modified should result in no results
         search_timestamp = max_timestamp + timedelta(microseconds=1)
-        assert len(self.ldap_client.search_orgs(search_timestamp)) == 0
+        assert len(list(self.ldap_client.search_orgs(search_timestamp))) == 0
 
         # Timestamp lesser than last modified should result in DN_ORG2
         search_timestamp = max_timestamp - timedelta(microseconds=1)
-        ldap_orgs_filtered = self.ldap_client.search_orgs(search_timestamp)
+        ldap_orgs_filtered = list(self.ldap_client.search_orgs(search_timestamp))
         assert len(ldap_orgs_filtered) == 1
         assert ldap_orgs_filtered[0].entry_dn == DN_ORG2
 
+    def test_search_orgs_records(self):
+        ldap_orgs = list(self.ldap_client.search_orgs())
+        records = list(self.ldap_client.search_orgs(records=True))
+        assert all(isinstance(record, EntityRecord) for record in records)
+        # The records hold the same values as the ldap3 Entry objects. The mock
+        # server does not generate entryUUIDs, so these are not compared.
+        deewee_client = DeeweeClient.__new__(DeeweeClient)
+        assert sorted(
+            deewee_client._prepare_vars_upsert(record, 'org')[1:] for record in records
+        ) == sorted(
+            deewee_client._prepare_vars_upsert(entry, 'org')[1:] for entry in ldap_orgs
+        )
+
+    def test_search_concurrently(self):
+        searches = {
+            'org': self.ldap_client.search_orgs,
+            'person': self.ldap_client.search_people
+        }
+        results = list(self.ldap_client.search_concurrently(searches))
+        dns = {
+            type: {ldap_entry.entry_dn for page, page_type in results
+                   if page_type == type for ldap_entry in page}
+            for type in searches
+        }
+        assert dns == {'org': {DN_ORG1, DN_ORG2}, 'person': {DN_PERSON1, DN_PERSON2}}
+
+    @pytest.mark.parametrize('shards', [2, 5])
+    def test_search_sharded(self, shards):
+        ldap_client = LdapClientMock(dict(ldap_config_dict, shards=shards))
+        ldap_client.ldap_wrapper = self.ldap_client.ldap_wrapper
+        searches = (
+            ldap_client.sharded_searches('org', ldap_client.search_orgs)
+            + ldap_client.sharded_searches('person', ldap_client.search_people)
+        )
+        assert len(searches) == 2 * (shards + 1)
+        results = list(ldap_client.search_concurrently(searches))
+        # Every entry is found by exactly one shard
+        dns = sorted(ldap_entry.entry_dn for page, _ in results for ldap_entry in page)
+        assert dns == sorted([DN_ORG1, DN_ORG2, DN_PERSON1, DN_PERSON2])
+
+    def test_search_orgs_attributes(self):
+        ldap_client = LdapClientMock(
+            dict(ldap_config_dict, attributes={'org': ['o']})
+        )
+        ldap_client.ldap_wrapper = self.ldap_client.ldap_wrapper
+        ldap_orgs = list(ldap_client.search_orgs())
+        assert len(ldap_orgs) == 2
+        assert set(ldap_orgs[0].entry_attributes) <= {'o', 'modifyTimestamp', 'entryUUID'}
+        assert 'o' in ldap_orgs[0].entry_attributes
+
     def test_search_people(self):
-        ldap_people = self.ldap_client.search_people()
+        ldap_people = list(self.ldap_client.search_people())
 
         assert len(ldap_people) == 2
         assert any(ldap_entry.entry_dn == DN_PERSON2 for ldap_entry in ldap_people)
@@ -164,10 +242,10 @@ class TestLdapClientMock:
         max_timestamp = last_modified_entry.modifyTimestamp.value
         # Timestamp greater than last modified should result in no results
         search_timestamp = max_timestamp + timedelta(microseconds=1)
-        assert len(self.ldap_client.search_people(search_timestamp)) == 0
+        assert len(list(self.ldap_client.search_people(search_timestamp))) == 0
 
         # Timestamp lesser than last modified should result in DN_PERSON2
         search_timestamp = max_timestamp - timedelta(microseconds=1)
-        ldap_people_filtered = self.ldap_client.search_people(search_timestamp)
+        ldap_people_filtered = list(self.ldap_client.search_people(search_timestamp))
         assert len(ldap_people_filtered) == 1
         assert ldap_people_filtered[0].entry_dn == DN_PERSON2
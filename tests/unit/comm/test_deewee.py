@@ -1,21 +1,69 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import pytest
+import psycopg2
 import uuid
-from unittest.mock import patch
-import json
+from unittest.mock import patch, MagicMock
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from ldap3.core.exceptions import LDAPExceptionError
+from psycopg2.sql import SQL, Identifier
 
 from viaa.configuration import ConfigParser
 
+from app.serialization import EntityRecord, serialize_entry
 from app.comm.deewee import (
     PostgresqlWrapper,
     DeeweeClient,
+    AsyncDeeweeClient,
     COUNT_ENTITIES_SQL,
     UPSERT_ENTITIES_SQL,
-    MAX_LAST_MODIFIED_TIMESTAMP_SQL
+    UPSERT_ENTITIES_VALUES_SQL,
+    CREATE_STAGING_TABLE_SQL,
+    COPY_STAGING_SQL,
+    MERGE_STAGING_SQL,
+    MAX_LAST_MODIFIED_TIMESTAMP_SQL,
+    MAX_LAST_MODIFIED_TIMESTAMP_TYPE_SQL,
+    SELECT_SYNC_STATE_SQL,
+    SELECT_COOKIE_SQL,
+    UPSERT_COOKIE_SQL,
+    SYNC_STATE_COOKIE_TYPE,
+    SELECT_LAST_MODIFIED_TYPE_SQL,
+    SELECT_LAST_MODIFIED_SINCE_SQL,
+    SELECT_SNAPSHOT_SQL,
+    SELECT_CONTENT_HASHES_SQL,
+    SELECT_LIVE_UUIDS_TYPE_SQL,
+    UPSERT_SYNC_STATE_SQL,
+    UPSERT_SYNC_STATE_ASYNC_SQL,
+    STAGING_TABLE_NAME,
+    STAGING_COLUMNS,
+    DELETE_SYNC_STATE_SQL,
+    CREATE_REBUILD_TABLE_SQL,
+    INSERT_REBUILD_SQL,
+    SET_LOGGED_REBUILD_SQL,
+    SELECT_CONSTRAINTS_SQL,
+    SELECT_INDEXES_SQL,
+    SELECT_SERIAL_SEQUENCE_SQL,
+    SELECT_TRIGGERS_SQL,
+    SELECT_GRANTS_SQL,
+    SELECT_OWNER_COMMENT_SQL,
+    CREATE_LDAP_UUIDS_TABLE_SQL,
+    COPY_LDAP_UUIDS_SQL,
+    DELETE_ORPHANS_SQL,
+    TOMBSTONE_ORPHANS_SQL,
+    DELETE_ENTITIES_SQL,
+    TOMBSTONE_ENTITIES_SQL,
+    DELETE_STRATEGY_DELETE,
+    DELETE_STRATEGY_TOMBSTONE,
+    HEALTH_CHECK_SQL,
+    UPSERT_STRATEGY_COPY,
+    COMMIT_MODE_BATCH,
+    UpsertStats,
+    BatchSizer,
+    content_hash
 )
 
 
@@ -28,17 +76,70 @@ class TestPostgresqlWrapper:
 
     @patch('psycopg2.connect')
     def test_execute(self, mock_connect, postgresql_wrapper):
-        connect = mock_connect.return_value.__enter__.return_value
+        connect = mock_connect.return_value
         connect.cursor.return_value.__enter__.return_value.fetchall.return_value = 5
         result = postgresql_wrapper.execute(COUNT_ENTITIES_SQL)
         assert result == 5
 
+    @patch('psycopg2.connect')
+    def test_execute_reuses_connection(self, mock_connect, postgresql_wrapper):
+        connect = mock_connect.return_value
+        connect.closed = 0
+        postgresql_wrapper.execute(COUNT_ENTITIES_SQL)
+        postgresql_wrapper.execute(COUNT_ENTITIES_SQL)
+        assert mock_connect.call_count == 1
+        cursor = connect.cursor.return_value.__enter__.return_value
+        # The reused connection is health checked first
+        assert [c[0][0] for c in cursor.execute.call_args_list] == [
+            COUNT_ENTITIES_SQL, HEALTH_CHECK_SQL, COUNT_ENTITIES_SQL
+        ]
+
+    @patch('psycopg2.connect')
+    def test_execute_reconnects_broken_connection(self, mock_connect, postgresql_wrapper):
+        broken, new = MagicMock(closed=0), MagicMock(closed=0)
+        mock_connect.side_effect = [broken, new]
+        postgresql_wrapper.execute(COUNT_ENTITIES_SQL)
+        # Simulate a server restart
+        broken.cursor.return_value.__enter__.return_value.execute.side_effect = (
+            psycopg2.OperationalError
+        )
+        postgresql_wrapper.execute(COUNT_ENTITIES_SQL)
+        assert mock_connect.call_count == 2
+        assert broken.close.call_count == 1
+        new_cursor = new.cursor.return_value.__enter__.return_value
+        assert new_cursor.execute.call_args[0][0] == COUNT_ENTITIES_SQL
+
+    @patch('psycopg2.connect')
+    def test_getconn_all_idle_connections_broken(self, mock_connect):
+        broken_1, broken_2, new = [MagicMock(closed=0) for _ in range(3)]
+        mock_connect.side_effect = [broken_1, broken_2, new]
+        postgresql_wrapper = PostgresqlWrapper({}, pool_min_size=2, pool_size=2)
+        # Lend both idle connections and return them
+        conns = [postgresql_wrapper._getconn(), postgresql_wrapper._getconn()]
+        for conn in conns:
+            postgresql_wrapper._putconn(conn)
+        # Simulate a server restart
+        for broken in (broken_1, broken_2):
+            broken.cursor.return_value.__enter__.return_value.execute.side_effect = (
+                psycopg2.OperationalError
+            )
+        assert postgresql_wrapper._getconn() is new
+        assert broken_1.close.call_count == 1
+        assert broken_2.close.call_count == 1
+
+    @patch('psycopg2.connect')
+    def test_close(self, mock_connect, postgresql_wrapper):
+        postgresql_wrapper.execute(COUNT_ENTITIES_SQL)
+        postgresql_wrapper.close()
+        assert postgresql_wrapper.pool is None
+        assert mock_connect.return_value.close.call_count == 1
+
     @patch('psycopg2.connect')
     def test_execute_insert(self, mock_connect, postgresql_wrapper):
         key = str(uuid.uuid4())
-        mock_connect.cursor.return_value.description = None
+        mock_connect.return_value.cursor.return_value.description = None
         postgresql_wrapper.execute(UPSERT_ENTITIES_SQL, [key])
-        connect = mock_connect.return_value.__enter__.return_value
+        connect = mock_connect.return_value
         cursor = connect.cursor.return_value.__enter__.return_value
         assert cursor.execute.call_count == 1
         assert cursor.execute.call_args[0][0] == UPSERT_ENTITIES_SQL
@@ -48,12 +149,117 @@ class TestPostgresqlWrapper:
     def test_executemany(self, mock_connect, postgresql_wrapper):
         values = [(str(uuid.uuid4()),), (str(uuid.uuid4()),)]
         postgresql_wrapper.executemany(UPSERT_ENTITIES_SQL, values)
-        connect = mock_connect.return_value.__enter__.return_value
+        connect = mock_connect.return_value
         cursor = connect.cursor.return_value.__enter__.return_value
         assert cursor.executemany.call_count == 1
         assert cursor.executemany.call_args[0][0] == UPSERT_ENTITIES_SQL
         assert cursor.executemany.call_args[0][1] == values
 
+    @patch('psycopg2.extras.execute_values')
+    @patch('psycopg2.connect')
+    def test_execute_values_batches(self, mock_connect, mock_execute_values,
+                                    postgresql_wrapper):
+        batches = [[(str(uuid.uuid4()),), (str(uuid.uuid4()),)], [(str(uuid.uuid4()),)]]
+        mock_execute_values.return_value = [(True, 1)]
+        count, rows = postgresql_wrapper.execute_values_batches(
+            UPSERT_ENTITIES_VALUES_SQL, iter(batches), 50, True
+        )
+        connect = mock_connect.return_value
+        cursor = connect.cursor.return_value.__enter__.return_value
+        assert mock_connect.call_count == 1
+        assert mock_execute_values.call_count == 2
+        assert mock_execute_values.call_args_list[0][0] == (
+            cursor, UPSERT_ENTITIES_VALUES_SQL, batches[0]
+        )
+        assert mock_execute_values.call_args_list[1][0][2] == batches[1]
+        assert mock_execute_values.call_args[1] == {'page_size': 50, 'fetch': True}
+        assert count == 3
+        assert rows == [(True, 1), (True, 1)]
+
+    @patch('psycopg2.extras.execute_values')
+    @patch('psycopg2.connect')
+    def test_execute_values_batches_finalize(self, mock_connect, mock_execute_values,
+                                             postgresql_wrapper):
+        finalize = MagicMock()
+        postgresql_wrapper.execute_values_batches(
+            UPSERT_ENTITIES_VALUES_SQL, iter([]), finalize=finalize
+        )
+        cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+        assert finalize.call_args[0] == (cursor,)
+
+    @patch('psycopg2.extras.execute_values')
+    @patch('psycopg2.connect')
+    def test_execute_values_batches_observe(self, mock_connect, mock_execute_values,
+                                            postgresql_wrapper):
+        observe = MagicMock()
+        postgresql_wrapper.execute_values_batches(
+            UPSERT_ENTITIES_VALUES_SQL, iter([[(1,)], [(2,)]]), observe=observe
+        )
+        # Called with the duration of every batch
+        assert observe.call_count == 2
+        assert all(call[0][0] >= 0 for call in observe.call_args_list)
+
+    @patch('psycopg2.connect')
+    def test_copy_merge_batches(self, mock_connect, postgresql_wrapper):
+        key = str(uuid.uuid4())
+        batches = [[(key, 'org', '{"a": "b, c"}', None)], [(key, 'org', '{}', None)]]
+        connect = mock_connect.return_value
+        cursor = connect.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [(True, 1)]
+        count, rows = postgresql_wrapper.copy_merge_batches(
+            CREATE_STAGING_TABLE_SQL, COPY_STAGING_SQL, MERGE_STAGING_SQL, iter(batches)
+        )
+        assert mock_connect.call_count == 1
+        assert cursor.execute.call_count == 2
+        assert cursor.execute.call_args_list[0][0][0] == CREATE_STAGING_TABLE_SQL
+        assert cursor.execute.call_args_list[1][0][0] == MERGE_STAGING_SQL
+        assert cursor.copy_expert.call_count == 2
+        assert cursor.copy_expert.call_args[0][0] == COPY_STAGING_SQL
+        assert count == 2
+        assert rows == [(True, 1)]
+
+    @patch('psycopg2.connect')
+    def test_copy_merge_batches_finalize(self, mock_connect, postgresql_wrapper):
+        finalize = MagicMock()
+        postgresql_wrapper.copy_merge_batches(
+            CREATE_STAGING_TABLE_SQL, COPY_STAGING_SQL, MERGE_STAGING_SQL, iter([]),
+            finalize=finalize
+        )
+        cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+        assert finalize.call_args[0] == (cursor,)
+
+    @patch('app.comm.deewee.time.sleep')
+    def test_commit_batches(self, sleep_mock, postgresql_wrapper):
+        execute = MagicMock(
+            side_effect=[(1, ['row1']), psycopg2.OperationalError, (2, ['row2'])]
+        )
+        batches = [[(1,)], [(2,), (3,)]]
+        count, rows = postgresql_wrapper.commit_batches(
+            execute, iter(batches), retries=3, backoff=2
+        )
+        assert (count, rows) == (3, ['row1', 'row2'])
+        # Every batch is executed on its own, the failed batch is retried
+        assert [call[0][0] for call in execute.call_args_list] == [
+            [batches[0]], [batches[1]], [batches[1]]
+        ]
+        assert sleep_mock.call_args[0][0] == 2
+
+    @patch('app.comm.deewee.time.sleep')
+    def test_commit_batches_exponential_backoff(self, sleep_mock, postgresql_wrapper):
+        execute = MagicMock(side_effect=psycopg2.InterfaceError)
+        with pytest.raises(psycopg2.InterfaceError):
+            postgresql_wrapper.commit_batches(execute, [[(1,)]], retries=3, backoff=1)
+        assert execute.call_count == 4
+        assert [call[0][0] for call in sleep_mock.call_args_list] == [1, 2, 4]
+
+    @patch('app.comm.deewee.time.sleep')
+    def test_commit_batches_no_retry(self, sleep_mock, postgresql_wrapper):
+        execute = MagicMock(side_effect=psycopg2.IntegrityError)
+        with pytest.raises(psycopg2.IntegrityError):
+            postgresql_wrapper.commit_batches(execute, [[(1,)]])
+        assert execute.call_count == 1
+        assert sleep_mock.call_count == 0
+
 
 @dataclass
 class ModifyTimestampMock:
@@ -69,9 +275,108 @@ class LdapEntryMock:
     entryUUID: uuid.UUID = uuid.uuid4()
     modifyTimestamp: ModifyTimestampMock = ModifyTimestampMock()
     atttributes: dict = field(default_factory=dict)
+    entry_dn: str = 'dn'
+
+    @property
+    def entry_attributes_as_dict(self) -> dict:
+        return self.atttributes
+
+
+class AsyncConnectionMock:
+    """Mock class of an asyncpg connection, which records the statements"""
+
+    def __init__(self, rows: list = None):
+        self.statements = []
+        self.copied = []
+        self.rows = rows or []
+        self.committed = False
+        self.rolled_back = False
+
+    async def execute(self, query: str):
+        self.statements.append(query)
+
+    async def fetch(self, query: str) -> list:
+        self.statements.append(query)
+        return self.rows
 
-    def entry_to_json(self) -> str:
-        return json.dumps(self.atttributes)
+    async def executemany(self, query: str, args: list):
+        self.statements.append((query, args))
+
+    async def copy_records_to_table(self, table_name: str, records: list,
+                                    columns: tuple):
+        assert (table_name, columns) == (STAGING_TABLE_NAME, STAGING_COLUMNS)
+        self.copied.append(records)
+
+    def transaction(self):
+        return self
+
+    async def start(self):
+        pass
+
+    async def commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        self.rolled_back = True
+
+
+class AsyncPoolMock:
+    """Mock class of an asyncpg pool, which lends the one connection"""
+
+    def __init__(self, conn: AsyncConnectionMock):
+        self.conn = conn
+        self.closed = False
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self) -> AsyncConnectionMock:
+        return self.conn
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+
+async def async_pages(pages: list, error: Exception = None):
+    for page in pages:
+        yield page
+    if error is not None:
+        raise error
+
+
+class TestBatchSizer:
+
+    def test_fixed(self):
+        sizer = BatchSizer(100)
+        sizer.update(0)
+        sizer.update(10)
+        assert sizer.size == 100
+
+    def test_additive_increase(self):
+        sizer = BatchSizer(100, 100, 250, target_seconds=1)
+        sizer.update(0.5)
+        assert sizer.size == 200
+        sizer.update(1)
+        assert sizer.size == 250
+
+    def test_multiplicative_decrease(self):
+        sizer = BatchSizer(1000, 300, 1000, target_seconds=1)
+        sizer.update(1.5)
+        assert sizer.size == 500
+        sizer.update(1.5)
+        assert sizer.size == 300
+
+    def test_clamps_size(self):
+        assert BatchSizer(10, 100, 200).size == 100
+        assert BatchSizer(1000, 100, 200).size == 200
+
+    @pytest.mark.parametrize('min_size, max_size', [(0, 10), (20, 10)])
+    def test_invalid_range(self, min_size, max_size):
+        with pytest.raises(ValueError):
+            BatchSizer(10, min_size, max_size)
 
 
 class TestDeeweeClient:
@@ -88,29 +393,422 @@ class TestDeeweeClient:
         assert value == (
             str(ldap_result.entryUUID),
             'org',
-            ldap_result.entry_to_json(),
+            serialize_entry('dn', {'dn': 'dn'}),
+            content_hash(serialize_entry('dn', {'dn': 'dn'})),
             ldap_result.modifyTimestamp.value
         )
 
+    def test_prepare_vars_upsert_record(self, deewee_client):
+        dt = datetime(2020, 2, 2)
+        record = EntityRecord('uuid', 'org', serialize_entry('dn', {'o': ['o']}), dt)
+        value = deewee_client._prepare_vars_upsert(record, 'org')
+        assert value == (
+            'uuid', 'org', record.content, content_hash(record.content), dt
+        )
+
+    def test_content_hash(self):
+        assert content_hash('{"a": 1}') == content_hash('{"a": 1}')
+        assert content_hash('{"a": 1}') != content_hash('{"a": 2}')
+        assert len(content_hash('{}')) == 32
+
     def test_upsert_ldap_results_many(self, deewee_client):
         psql_wrapper_mock = deewee_client.postgresql_wrapper
 
         # Create 2 Mock LDAP results
-        ldap_result_1 = LdapEntryMock()
+        ldap_result_1 = LdapEntryMock(uuid.uuid4())
         ldap_result_1.atttributes['dn'] = 'dn1'
-        ldap_result_2 = LdapEntryMock()
+        ldap_result_2 = LdapEntryMock(uuid.uuid4())
         ldap_result_2.atttributes['dn'] = 'dn2'
         # Prepare to pass
         ldap_results = [([ldap_result_1], 'org'), ([ldap_result_2], 'person')]
-        deewee_client.upsert_ldap_results_many(ldap_results)
+        psql_wrapper_mock.execute_values_batches.return_value = (2, [(True, 1)])
+        stats = deewee_client.upsert_ldap_results_many(ldap_results)
+        assert stats == UpsertStats(inserted=1, updated=0, unchanged=1)
 
         # The transformed mock LDAP result as tuple
         val1 = deewee_client._prepare_vars_upsert(ldap_result_1, 'org')
         val2 = deewee_client._prepare_vars_upsert(ldap_result_2, 'person')
 
-        assert psql_wrapper_mock.executemany.call_count == 1
-        assert psql_wrapper_mock.executemany.call_args[0][0] == UPSERT_ENTITIES_SQL
-        assert psql_wrapper_mock.executemany.call_args[0][1] == [val1, val2]
+        execute_values_batches_mock = psql_wrapper_mock.execute_values_batches
+        assert execute_values_batches_mock.call_count == 1
+        assert execute_values_batches_mock.call_args[0][0] == UPSERT_ENTITIES_VALUES_SQL
+        assert list(execute_values_batches_mock.call_args[0][1]) == [[val1, val2]]
+        assert execute_values_batches_mock.call_args[0][2] == deewee_client.page_size
+        assert execute_values_batches_mock.call_args[0][3] is True
+
+    def test_upsert_ldap_results_many_copy(self, deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        deewee_client.upsert_strategy = UPSERT_STRATEGY_COPY
+        ldap_result = LdapEntryMock()
+        psql_wrapper_mock.copy_merge_batches.return_value = (3, [(True, 1), (False, 1)])
+        stats = deewee_client.upsert_ldap_results_many([([ldap_result], 'org')])
+        assert stats == UpsertStats(inserted=1, updated=1, unchanged=1)
+        assert stats.total == 3
+
+        val = deewee_client._prepare_vars_upsert(ldap_result, 'org')
+        copy_merge_batches_mock = psql_wrapper_mock.copy_merge_batches
+        assert copy_merge_batches_mock.call_count == 1
+        assert copy_merge_batches_mock.call_args[0][:3] == (
+            CREATE_STAGING_TABLE_SQL, COPY_STAGING_SQL, MERGE_STAGING_SQL
+        )
+        assert list(copy_merge_batches_mock.call_args[0][3]) == [[val]]
+        assert psql_wrapper_mock.execute_values_batches.call_count == 0
+
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    def test_unknown_upsert_strategy(self, postgresql_wrapper_mock):
+        with pytest.raises(ValueError):
+            DeeweeClient({'upsert_strategy': 'unknown'})
+
+    def test_upsert_ldap_results_many_commit_batches(self, deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        deewee_client.commit_mode = COMMIT_MODE_BATCH
+        ldap_result = LdapEntryMock(uuid.uuid4())
+        committed = []
+
+        def commit_batches(execute, vars_batches, retries, backoff):
+            committed.append((execute, list(vars_batches)))
+            return 1, [(True, 1)]
+        psql_wrapper_mock.commit_batches.side_effect = commit_batches
+        stats = deewee_client.upsert_ldap_results_many([([ldap_result], 'org')])
+        assert stats == UpsertStats(inserted=1, updated=0, unchanged=0)
+
+        # The watermarks are committed after the batches
+        (execute, batches), (save_execute, watermarks) = committed
+        assert batches == [[deewee_client._prepare_vars_upsert(ldap_result, 'org')]]
+        assert execute.func == psql_wrapper_mock.execute_values_batches
+        assert execute.args == (UPSERT_ENTITIES_VALUES_SQL,)
+        assert save_execute.args == (UPSERT_SYNC_STATE_SQL,)
+        assert watermarks == [[('org', ldap_result.modifyTimestamp.value)]]
+        assert psql_wrapper_mock.execute_values_batches.call_count == 0
+
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    def test_unknown_commit_mode(self, postgresql_wrapper_mock):
+        with pytest.raises(ValueError):
+            DeeweeClient({'commit_mode': 'unknown'})
+
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    def test_unknown_delete_strategy(self, postgresql_wrapper_mock):
+        with pytest.raises(ValueError):
+            DeeweeClient({'delete_strategy': 'unknown'})
+
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    def test_options_not_passed_to_connection(self, postgresql_wrapper_mock):
+        DeeweeClient(
+            {'host': 'host', 'batch_size': 5, 'page_size': 5, 'upsert_strategy': 'copy',
+             'pool_min_size': 1, 'pool_size': 2, 'delete_strategy': 'tombstone',
+             'commit_mode': 'batch', 'retries': 5, 'retry_backoff': 0.5}
+        )
+        assert postgresql_wrapper_mock.call_args[0] == ({'host': 'host'}, 1, 2)
+
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    def test_batch_sizer_options(self, postgresql_wrapper_mock):
+        deewee_client = DeeweeClient(
+            {'batch_size': 500, 'min_batch_size': 100, 'max_batch_size': 5000,
+             'target_batch_seconds': 0.5, 'max_batch_bytes': 1024,
+             'max_queued_pages': 8}
+        )
+        assert deewee_client.batch_sizer == BatchSizer(500, 100, 5000, 0.5, 1024)
+        assert deewee_client.max_queued_pages == 8
+        assert postgresql_wrapper_mock.call_args[0][0] == {}
+
+    def test_batch_vars_upsert(self, deewee_client):
+        deewee_client.batch_sizer = BatchSizer(2, 2, 2)
+        ldap_results = [
+            (iter([LdapEntryMock(uuid.uuid4()), LdapEntryMock(uuid.uuid4())]), 'org'),
+            (iter([LdapEntryMock(uuid.uuid4())]), 'person')
+        ]
+        batches = list(deewee_client._batch_vars_upsert(ldap_results))
+        assert [len(batch) for batch in batches] == [2, 1]
+        assert [vars[1] for vars in batches[0]] == ['org', 'org']
+        assert batches[1][0][1] == 'person'
+
+    def test_batch_vars_upsert_max_bytes(self, deewee_client):
+        entries = [LdapEntryMock(uuid.uuid4()) for _ in range(3)]
+        content_bytes = len(deewee_client._prepare_vars_upsert(entries[0], 'org')[2])
+        # The second entry reaches the maximum amount of bytes
+        deewee_client.batch_sizer.max_bytes = 2 * content_bytes
+        batches = list(deewee_client._batch_vars_upsert([(entries, 'org')]))
+        assert [len(batch) for batch in batches] == [2, 1]
+
+    def test_batch_vars_upsert_adapts(self, deewee_client):
+        deewee_client.batch_sizer = BatchSizer(1, 1, 4)
+        entries = [LdapEntryMock(uuid.uuid4()) for _ in range(6)]
+        sizes = []
+        for batch in deewee_client._batch_vars_upsert([(entries, 'org')]):
+            sizes.append(len(batch))
+            # The batches are fast enough to grow
+            deewee_client.batch_sizer.update(0)
+        assert sizes == [1, 2, 3]
+
+    def test_batch_vars_upsert_deduplicates(self, deewee_client):
+        entry_1 = LdapEntryMock(entryUUID=uuid.uuid4())
+        entry_2 = LdapEntryMock(entryUUID=uuid.uuid4())
+        entry_1_moved = LdapEntryMock(entryUUID=entry_1.entryUUID)
+        entry_1_moved.atttributes['dn'] = 'moved'
+        ldap_results = [([entry_1, entry_2, entry_1_moved], 'org')]
+        batches = list(deewee_client._batch_vars_upsert(ldap_results))
+        assert batches == [[
+            deewee_client._prepare_vars_upsert(entry_2, 'org'),
+            deewee_client._prepare_vars_upsert(entry_1_moved, 'org')
+        ]]
+
+    @pytest.mark.parametrize('delete_strategy, orphans_sql', [
+        (DELETE_STRATEGY_DELETE, DELETE_ORPHANS_SQL),
+        (DELETE_STRATEGY_TOMBSTONE, TOMBSTONE_ORPHANS_SQL)
+    ])
+    def test_reconcile_ldap_uuids(self, deewee_client, delete_strategy, orphans_sql):
+        deewee_client.delete_strategy = delete_strategy
+        deewee_client.batch_size = 2
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        # Consume the batches like the wrapper does
+        psql_wrapper_mock.copy_merge_batches.side_effect = (
+            lambda create_sql, copy_sql, merge_sql, vars_batches, merge_vars: (
+                len([vars for batch in vars_batches for vars in batch]), [('org', 1)]
+            )
+        )
+        orgs = [LdapEntryMock(uuid.uuid4()) for _ in range(3)]
+        # The searches yield no pages for a type without LDAP entries
+        removed = deewee_client.reconcile_ldap_uuids(
+            [(orgs, 'org')], ('org', 'person')
+        )
+        assert removed == {'org': 1}
+
+        copy_merge_batches_mock = psql_wrapper_mock.copy_merge_batches
+        assert copy_merge_batches_mock.call_count == 1
+        assert copy_merge_batches_mock.call_args[0][:3] == (
+            CREATE_LDAP_UUIDS_TABLE_SQL, COPY_LDAP_UUIDS_SQL, orphans_sql
+        )
+        # Also the types without LDAP entries are reconciled
+        assert copy_merge_batches_mock.call_args[0][4] == (['org', 'person'],)
+
+    @pytest.mark.parametrize('delete_strategy, remove_sql', [
+        (DELETE_STRATEGY_DELETE, DELETE_ENTITIES_SQL),
+        (DELETE_STRATEGY_TOMBSTONE, TOMBSTONE_ENTITIES_SQL)
+    ])
+    def test_remove_ldap_uuids(self, deewee_client, delete_strategy, remove_sql):
+        deewee_client.delete_strategy = delete_strategy
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        psql_wrapper_mock.execute.return_value = [('org',)]
+        assert deewee_client.remove_ldap_uuids(['uuid1', 'uuid2']) == 1
+        assert psql_wrapper_mock.execute.call_args[0] == (remove_sql, (['uuid1', 'uuid2'],))
+
+    def test_batch_vars_ldap_uuids(self, deewee_client):
+        deewee_client.batch_size = 2
+        orgs = [LdapEntryMock(uuid.uuid4()) for _ in range(3)]
+        batches = list(deewee_client._batch_vars_ldap_uuids([(orgs, 'org')]))
+        assert batches == [
+            [(str(orgs[0].entryUUID), 'org'), (str(orgs[1].entryUUID), 'org')],
+            [(str(orgs[2].entryUUID), 'org')]
+        ]
+
+    def test_batch_vars_upsert_watermarks(self, deewee_client):
+        dt = datetime(2020, 2, 2)
+        orgs = [
+            LdapEntryMock(uuid.uuid4(), ModifyTimestampMock(dt)),
+            LdapEntryMock(uuid.uuid4(), ModifyTimestampMock(dt - timedelta(days=1)))
+        ]
+        person = LdapEntryMock(uuid.uuid4(), ModifyTimestampMock(dt + timedelta(days=1)))
+        watermarks = {}
+        list(deewee_client._batch_vars_upsert(
+            [(orgs, 'org'), ([person], 'person')], watermarks
+        ))
+        assert watermarks == {'org': dt, 'person': dt + timedelta(days=1)}
+
+    @patch('psycopg2.extras.execute_values')
+    def test_upsert_ldap_results_many_saves_watermarks(self, mock_execute_values,
+                                                       deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        ldap_result = LdapEntryMock(uuid.uuid4())
+
+        def execute_values_batches(query, vars_batches, page_size, fetch, finalize,
+                                   observe):
+            count = len([vars for batch in vars_batches for vars in batch])
+            finalize('cursor')
+            return count, []
+        psql_wrapper_mock.execute_values_batches.side_effect = execute_values_batches
+        deewee_client.upsert_ldap_results_many([([ldap_result], 'org')])
+        assert mock_execute_values.call_args[0] == (
+            'cursor', UPSERT_SYNC_STATE_SQL, [('org', ldap_result.modifyTimestamp.value)]
+        )
+
+    @patch('psycopg2.extras.execute_values')
+    def test_rebuild_ldap_results(self, mock_execute_values, deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        ldap_result = LdapEntryMock(uuid.uuid4())
+
+        def copy_merge_batches(create_sql, copy_sql, merge_sql, vars_batches, finalize,
+                               observe):
+            count = len([vars for batch in vars_batches for vars in batch])
+            finalize(cursor)
+            return count, [(count,)]
+        psql_wrapper_mock.copy_merge_batches.side_effect = copy_merge_batches
+        cursor = MagicMock()
+        cursor.fetchall.return_value = []
+        cursor.fetchone.side_effect = [('postgres', None), (None,)]
+        assert deewee_client.rebuild_ldap_results([([ldap_result], 'org')]) == 1
+
+        assert psql_wrapper_mock.copy_merge_batches.call_args[0][:3] == (
+            CREATE_REBUILD_TABLE_SQL, COPY_STAGING_SQL, INSERT_REBUILD_SQL
+        )
+        # The old watermarks are replaced
+        assert cursor.execute.call_args[0] == (DELETE_SYNC_STATE_SQL, (['org'],))
+        assert mock_execute_values.call_args[0] == (
+            cursor, UPSERT_SYNC_STATE_SQL, [('org', ldap_result.modifyTimestamp.value)]
+        )
+
+    def test_swap_rebuild_table(self, deewee_client):
+        cursor = MagicMock()
+        cursor.fetchall.side_effect = [
+            [('entities_pkey', 'PRIMARY KEY (id)')],
+            [(
+                'entities_o_idx',
+                'CREATE INDEX entities_o_idx ON public.entities '
+                "USING btree (((content #>> '{attributes,o,0}'::text[])))"
+            )],
+            [(
+                'entities_audit',
+                'CREATE TRIGGER entities_audit AFTER UPDATE ON public.entities '
+                'FOR EACH ROW EXECUTE FUNCTION audit()'
+            )],
+            [('reader', 'SELECT', False), (None, 'SELECT', False)],
+        ]
+        cursor.fetchone.side_effect = [
+            ('owner', 'LDAP entries'), ('public.entities_id_seq',)
+        ]
+        deewee_client._swap_rebuild_table(cursor)
+
+        statements = [call[0][0] for call in cursor.execute.call_args_list]
+        assert statements[:6] == [
+            SET_LOGGED_REBUILD_SQL, SELECT_CONSTRAINTS_SQL, SELECT_INDEXES_SQL,
+            SELECT_TRIGGERS_SQL, SELECT_GRANTS_SQL, SELECT_OWNER_COMMENT_SQL
+        ]
+        rebuild_table = Identifier('entities_rebuild')
+        assert statements[6] == (
+            SQL('ALTER TABLE {} ADD CONSTRAINT {} ').format(
+                rebuild_table, Identifier('entities_pkey_rebuild')
+            ) + SQL('PRIMARY KEY (id)')
+        )
+        assert statements[7] == (
+            SQL('CREATE INDEX {} ON {} USING ').format(
+                Identifier('entities_o_idx_rebuild'), rebuild_table
+            ) + SQL("btree (((content #>> '{attributes,o,0}'::text[])))")
+        )
+        assert statements[8] == (
+            SQL('CREATE TRIGGER entities_audit AFTER UPDATE')
+            + SQL(' ON {} ').format(rebuild_table)
+            + SQL('FOR EACH ROW EXECUTE FUNCTION audit()')
+        )
+        # The privileges, comment and owner of the table are copied
+        assert statements[9:12] == [
+            SQL('GRANT {} ON {} TO {}{}').format(
+                SQL('SELECT'), rebuild_table, Identifier('reader'), SQL('')
+            ),
+            SQL('GRANT {} ON {} TO {}{}').format(
+                SQL('SELECT'), rebuild_table, SQL('PUBLIC'), SQL('')
+            ),
+            SQL('COMMENT ON TABLE {} IS %s').format(rebuild_table),
+        ]
+        assert cursor.execute.call_args_list[11][0][1] == ('LDAP entries',)
+        assert statements[12] == SQL('ALTER TABLE {} OWNER TO {}').format(
+            rebuild_table, Identifier('owner')
+        )
+        assert statements[13] == SELECT_SERIAL_SEQUENCE_SQL
+        # The constraints and indexes get their names back after the swap
+        assert statements[-2] == SQL(
+            'ALTER TABLE {} RENAME CONSTRAINT {} TO {}'
+        ).format(
+            Identifier('entities'), Identifier('entities_pkey_rebuild'),
+            Identifier('entities_pkey')
+        )
+        assert statements[-1] == SQL('ALTER INDEX {} RENAME TO {}').format(
+            Identifier('entities_o_idx_rebuild'), Identifier('entities_o_idx')
+        )
+
+    def test_watermarks(self, deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        dt = datetime.now()
+        psql_wrapper_mock.execute.side_effect = [[('org', dt)], [[None]]]
+        assert deewee_client.watermarks(('org', 'person')) == {'org': dt, 'person': None}
+        assert psql_wrapper_mock.execute.call_args_list[0][0] == (
+            SELECT_SYNC_STATE_SQL, (['org', 'person'],)
+        )
+        # Falls back to the rows of the type without sync state
+        assert psql_wrapper_mock.execute.call_args_list[1][0] == (
+            MAX_LAST_MODIFIED_TIMESTAMP_TYPE_SQL, ('person',)
+        )
+
+    def test_cookie(self, deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        psql_wrapper_mock.execute.side_effect = [[(memoryview(b'cookie'),)], [], None]
+        assert deewee_client.cookie() == b'cookie'
+        assert psql_wrapper_mock.execute.call_args[0] == (
+            SELECT_COOKIE_SQL, (SYNC_STATE_COOKIE_TYPE,)
+        )
+        assert deewee_client.cookie() is None
+
+        deewee_client.save_cookie(b'new')
+        assert psql_wrapper_mock.execute.call_args[0] == (
+            UPSERT_COOKIE_SQL, (SYNC_STATE_COOKIE_TYPE, b'new')
+        )
+
+    def test_last_modified_index(self, deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        dt = datetime.now()
+        psql_wrapper_mock.execute.side_effect = [[('uuid1', dt)], [('uuid2', dt)]]
+        index = deewee_client.last_modified_index({'org': None, 'person': dt})
+        assert index == {'org': {'uuid1': dt}, 'person': {'uuid2': dt}}
+        # All rows of a type without watermark, else the rows after it
+        assert psql_wrapper_mock.execute.call_args_list[0][0] == (
+            SELECT_LAST_MODIFIED_TYPE_SQL, ('org',)
+        )
+        assert psql_wrapper_mock.execute.call_args_list[1][0] == (
+            SELECT_LAST_MODIFIED_SINCE_SQL, ('person', dt)
+        )
+
+    def test_content_hashes(self, deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        psql_wrapper_mock.execute.return_value = [('uuid1', 'hash'), ('uuid2', None)]
+        assert deewee_client.content_hashes(['uuid1', 'uuid2', 'uuid3']) == {
+            'uuid1': 'hash', 'uuid2': None
+        }
+        assert psql_wrapper_mock.execute.call_args[0] == (
+            SELECT_CONTENT_HASHES_SQL, (['uuid1', 'uuid2', 'uuid3'],)
+        )
+
+    def test_live_ldap_uuids(self, deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        psql_wrapper_mock.execute.return_value = [('uuid1',), ('uuid2',)]
+        assert deewee_client.live_ldap_uuids('org') == ['uuid1', 'uuid2']
+        assert psql_wrapper_mock.execute.call_args[0] == (
+            SELECT_LIVE_UUIDS_TYPE_SQL, ('org',)
+        )
+
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    def test_table(self, postgresql_wrapper_mock):
+        deewee_client = DeeweeClient({'table': 'vendors'})
+        assert deewee_client._sql(SELECT_SYNC_STATE_SQL) == (
+            SELECT_SYNC_STATE_SQL.replace('sync_state', 'vendors_sync_state')
+        )
+        # The derived tables are renamed along
+        assert 'vendors_staging' in deewee_client._sql(MERGE_STAGING_SQL)
+        assert 'entities' not in deewee_client._sql(MERGE_STAGING_SQL)
+
+        deewee_client.live_ldap_uuids('org')
+        assert postgresql_wrapper_mock.return_value.execute.call_args[0] == (
+            SELECT_LIVE_UUIDS_TYPE_SQL.replace('entities', 'vendors'), ('org',)
+        )
+
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    def test_table_invalid(self, postgresql_wrapper_mock):
+        with pytest.raises(ValueError):
+            DeeweeClient({'table': 'vendors; DROP TABLE entities'})
+
+    def test_snapshot_rows(self, deewee_client):
+        psql_wrapper_mock = deewee_client.postgresql_wrapper
+        rows = [('uuid', 'org', content_hash('{}'), datetime.now())]
+        psql_wrapper_mock.execute.return_value = rows
+        assert deewee_client.snapshot_rows() == rows
+        assert psql_wrapper_mock.execute.call_args[0][0] == SELECT_SNAPSHOT_SQL
 
     def test_max_last_modified_timestamp(self, deewee_client):
         psql_wrapper_mock = deewee_client.postgresql_wrapper
@@ -126,3 +824,68 @@ class TestDeeweeClient:
         value = deewee_client.count()
         assert psql_wrapper_mock.execute.call_args[0][0] == COUNT_ENTITIES_SQL
         assert value == 5
+
+
+class TestAsyncDeeweeClient:
+
+    @pytest.fixture
+    @patch('app.comm.deewee.asyncpg')
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    def deewee_client(self, postgresql_wrapper_mock, asyncpg_mock):
+        return AsyncDeeweeClient({})
+
+    @patch('app.comm.deewee.asyncpg', None)
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    def test_requires_asyncpg(self, postgresql_wrapper_mock):
+        with pytest.raises(ImportError):
+            AsyncDeeweeClient({})
+
+    def test_upsert_ldap_results_many_async(self, deewee_client):
+        conn = AsyncConnectionMock([(True, 1), (False, 1)])
+        deewee_client.async_pool = AsyncPoolMock(conn)
+        deewee_client.batch_sizer = BatchSizer(1)
+        org = LdapEntryMock(uuid.uuid4())
+        person = LdapEntryMock(uuid.uuid4())
+        person_2 = LdapEntryMock(uuid.uuid4())
+        stats = asyncio.run(
+            deewee_client.upsert_ldap_results_many_async(
+                async_pages([([org], 'org'), ([person, person_2], 'person')])
+            )
+        )
+        assert stats == UpsertStats(inserted=1, updated=1, unchanged=1)
+
+        # Every batch is COPYed into the staging table
+        assert conn.copied == [
+            [deewee_client._prepare_vars_upsert(org, 'org')],
+            [deewee_client._prepare_vars_upsert(person, 'person')],
+            [deewee_client._prepare_vars_upsert(person_2, 'person')]
+        ]
+        watermark = org.modifyTimestamp.value
+        assert conn.statements == [
+            CREATE_STAGING_TABLE_SQL,
+            MERGE_STAGING_SQL,
+            (UPSERT_SYNC_STATE_ASYNC_SQL, [('org', watermark), ('person', watermark)])
+        ]
+        assert conn.committed
+
+    def test_upsert_ldap_results_many_async_error(self, deewee_client):
+        conn = AsyncConnectionMock()
+        deewee_client.async_pool = AsyncPoolMock(conn)
+        pages = async_pages(
+            [([LdapEntryMock(uuid.uuid4())], 'org')], LDAPExceptionError('dropped')
+        )
+        with pytest.raises(LDAPExceptionError):
+            asyncio.run(
+                deewee_client.upsert_ldap_results_many_async(pages)
+            )
+        assert conn.rolled_back
+        assert not conn.committed
+        assert MERGE_STAGING_SQL not in conn.statements
+
+    def test_close_async(self, deewee_client):
+        pool = AsyncPoolMock(AsyncConnectionMock())
+        deewee_client.async_pool = pool
+        asyncio.run(deewee_client.close_async())
+        assert pool.closed
+        assert deewee_client.async_pool is None
+        assert deewee_client.postgresql_wrapper.close.call_count == 1
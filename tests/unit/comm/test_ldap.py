@@ -1,14 +1,42 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import ldap3
 import pytest
-from unittest.mock import patch
-from datetime import datetime
+import threading
+import uuid
+from unittest.mock import patch, MagicMock
+from datetime import datetime, timedelta, timezone
 
 from viaa.configuration import ConfigParser
 
-from app.comm.ldap import LdapWrapper, LdapClient
+from ldap3.core.exceptions import LDAPSocketReceiveError
 
+from app.comm.ldap import (
+    LdapWrapper, LdapClient, AsyncLdapClient, LdapChange, PAGED_RESULTS_CONTROL,
+    SEARCH_ATTRIBUTES, SHARD_CHARACTERS, CHANGE_TYPE_DELETE, SYNC_REQUEST_CONTROL,
+    SYNC_STATE_CONTROL, SYNC_DONE_CONTROL, SYNC_INFO_MESSAGE, SYNC_REFRESH_REQUIRED,
+    SyncReplSearch, LdapWatchError, LdapSyncRefreshRequired
+)
+from app.metrics import metrics
+from app.serialization import EntityRecord, serialize_entry
+
+
+def sync_entry(dn: str, state: int, entry_uuid: uuid.UUID, cookie: bytes = None,
+               attributes: dict = None) -> dict:
+    """Returns a search result entry event with a sync state control"""
+    value = b'\x0a\x01' + bytes([state]) + b'\x04\x10' + entry_uuid.bytes
+    if cookie:
+        value += b'\x04' + bytes([len(cookie)]) + cookie
+    return {
+        'type': 'searchResEntry',
+        'dn': dn,
+        'attributes': attributes or {},
+        'controls': {
+            SYNC_STATE_CONTROL: {'value': b'\x30' + bytes([len(value)]) + value},
+        },
+    }
 
 class TestLdapWrapper:
 
@@ -26,6 +54,232 @@ class TestLdapWrapper:
         assert mock.search.call_count == 1
         assert result.return_value == 'entry'
 
+    def test_search_paged(self, ldap_wrapper):
+        cookies = [b'cookie', b'']
+        mock = ldap_wrapper.connection
+        mock.entries = ['entry']
+
+        def search(*args, **kwargs):
+            cookie = cookies.pop(0)
+            mock.result = {'controls': {PAGED_RESULTS_CONTROL: {'value': {'cookie': cookie}}}}
+        mock.search.side_effect = search
+
+        result = list(ldap_wrapper.search_paged('orgs', page_size=1))
+        assert mock.search.call_count == 2
+        assert mock.search.call_args_list[0][0][0] == 'orgs'
+        assert mock.search.call_args_list[0][1]['paged_size'] == 1
+        assert mock.search.call_args_list[0][1]['paged_cookie'] is None
+        assert mock.search.call_args_list[1][1]['paged_cookie'] == b'cookie'
+        assert result == ['entry', 'entry']
+        assert mock.bind.call_count == 1
+        assert mock.unbind.call_count == 1
+
+    def test_search_paged_raw(self, ldap_wrapper):
+        mock = ldap_wrapper.connection
+        response = {'type': 'searchResEntry', 'dn': 'o=org', 'attributes': {}}
+        mock.response = [response, {'type': 'searchResRef', 'uri': ['ldap://']}]
+        mock.result = {'controls': {}}
+
+        result = list(ldap_wrapper.search_paged('orgs', raw=True))
+        assert result == [response]
+
+    def test_session(self, ldap_wrapper):
+        mock = ldap_wrapper.connection
+        mock.closed = False
+        mock.bound = True
+        mock.result = {}
+        with ldap_wrapper.session():
+            ldap_wrapper.search('orgs')
+            with ldap_wrapper.session():
+                ldap_wrapper.add('dn')
+            list(ldap_wrapper.search_paged('orgs'))
+            ldap_wrapper.delete('dn')
+            assert mock.unbind.call_count == 0
+        assert mock.bind.call_count == 1
+        assert mock.unbind.call_count == 1
+
+    def test_session_rebind(self, ldap_wrapper):
+        mock = ldap_wrapper.connection
+        mock.closed = False
+        mock.bound = True
+        mock.search.side_effect = [LDAPSocketReceiveError('dropped'), True]
+        with ldap_wrapper.session():
+            ldap_wrapper.search('orgs')
+        assert mock.search.call_count == 2
+        assert mock.bind.call_count == 2
+
+    def test_session_no_retry_add(self, ldap_wrapper):
+        mock = ldap_wrapper.connection
+        mock.closed = False
+        mock.bound = True
+        mock.add.side_effect = LDAPSocketReceiveError('dropped')
+        with ldap_wrapper.session():
+            with pytest.raises(LDAPSocketReceiveError):
+                ldap_wrapper.add('dn')
+        assert mock.add.call_count == 1
+        # The connection is bound again for the next operations
+        assert mock.bind.call_count == 2
+
+    def test_search_paged_malformed_cookie(self, ldap_wrapper):
+        mock = ldap_wrapper.connection
+        mock.entries = ['entry']
+        result = list(ldap_wrapper.search_paged('orgs'))
+        assert mock.search.call_count == 1
+        assert result == ['entry']
+
+    def test_connection_per_thread(self, ldap_wrapper):
+        connections = []
+        with patch('ldap3.Connection') as mock_connection:
+            thread = threading.Thread(
+                target=lambda: connections.append(ldap_wrapper.connection)
+            )
+            thread.start()
+            thread.join()
+        assert connections == [mock_connection.return_value]
+        assert ldap_wrapper.connection is not connections[0]
+
+    @patch('ldap3.Connection')
+    def test_schema_read_on_first_bind_only(self, mock_connection):
+        ldap_wrapper = LdapWrapper({'URI': 'ldap://localhost'})
+        server = mock_connection.call_args[0][0]
+        assert server.get_info == ldap3.SCHEMA
+        mock = ldap_wrapper.connection
+        mock.server = server
+        ldap_wrapper.search('orgs')
+        assert mock.bind.call_args[1] == {'read_server_info': True}
+        # Simulate the schema having been read
+        server._schema_info = 'schema'
+        ldap_wrapper.search('orgs')
+        assert mock.bind.call_args[1] == {'read_server_info': False}
+
+    @patch('ldap3.Connection')
+    def test_no_schema(self, mock_connection):
+        ldap_wrapper = LdapWrapper({'URI': 'ldap://localhost', 'get_info': ldap3.NONE})
+        mock = ldap_wrapper.connection
+        mock.server = mock_connection.call_args[0][0]
+        ldap_wrapper.search('orgs')
+        assert mock.bind.call_args[1] == {'read_server_info': False}
+
+    @patch('ldap3.Connection')
+    def test_schema_cache(self, mock_connection, tmp_path):
+        schema_cache = str(tmp_path / 'ldap')
+        params = {'URI': 'ldap://localhost', 'schema_cache': schema_cache}
+        ldap_wrapper = LdapWrapper(params)
+        # Simulate reading the info from the server on bind
+        server = mock_connection.call_args[0][0]
+        ldap_wrapper.connection.server = server
+        offline = ldap3.Server('offline', get_info=ldap3.OFFLINE_SLAPD_2_4)
+
+        def bind(read_server_info):
+            server._dsa_info, server._schema_info = offline.info, offline.schema
+        ldap_wrapper.connection.bind.side_effect = bind
+        ldap_wrapper.search('orgs')
+        assert (tmp_path / 'ldap.schema.json').exists()
+
+        # A new wrapper loads the cache and does not read the info anymore
+        ldap_wrapper = LdapWrapper(params)
+        server = mock_connection.call_args[0][0]
+        assert server.schema is not None
+        ldap_wrapper.connection.server = server
+        ldap_wrapper.search('orgs')
+        assert ldap_wrapper.connection.bind.call_args[1] == {'read_server_info': False}
+
+    def test_sync_search(self, ldap_wrapper):
+        with patch('ldap3.Connection') as mock_connection:
+            search = ldap_wrapper.sync_search(
+                'dc=be', attributes=['o'], cookie=b'cookie', timeout=1
+            )
+        assert mock_connection.call_args[1] == {'client_strategy': ldap3.ASYNC_STREAM}
+        connection = mock_connection.return_value
+        assert connection.bind.call_count == 1
+        # The search is started right away
+        persistent_search = connection.extend.standard.persistent_search
+        assert persistent_search.call_count == 1
+        assert persistent_search.call_args[0] == ('dc=be', '(objectClass=*)')
+        assert persistent_search.call_args[1]['attributes'] == ['o']
+        # Only the sync request control is sent, no psearch control
+        assert persistent_search.call_args[1]['changes_only'] is False
+        control = persistent_search.call_args[1]['controls'][0]
+        assert str(control['controlType']) == SYNC_REQUEST_CONTROL
+        assert bool(control['criticality']) is True
+        # refreshAndPersist with the cookie
+        assert bytes(control['controlValue']) == b'\x30\x0b\x0a\x01\x03\x04\x06cookie'
+        assert search.cookie == b'cookie'
+
+        # The search is stopped, also if it has not been iterated
+        search.close()
+        assert persistent_search.return_value.stop.call_count == 1
+        search.close()
+        assert persistent_search.return_value.stop.call_count == 1
+
+    @staticmethod
+    def sync_search(events: list, cookie: bytes = None) -> SyncReplSearch:
+        search = MagicMock()
+        search.next.side_effect = events
+        connection = MagicMock(closed=False, listening=True)
+        return SyncReplSearch(connection, search, 1, cookie)
+
+    def test_sync_search_events(self):
+        added, deleted, present = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        search = self.sync_search([
+            sync_entry('o=added', 1, added, b'1', {'o': ['added']}),
+            None,
+            sync_entry('o=deleted', 3, deleted),
+            sync_entry('o=present', 0, present, b'2'),
+            {
+                'type': 'intermediateResponse', 'responseName': SYNC_INFO_MESSAGE,
+                # syncIdSet with refreshDeletes
+                'responseValue': (
+                    b'\xa3\x17\x01\x01\xff\x31\x12\x04\x10' + deleted.bytes
+                ),
+            },
+            {
+                'type': 'intermediateResponse', 'responseName': SYNC_INFO_MESSAGE,
+                # refreshPresent with a cookie
+                'responseValue': b'\xa2\x03\x04\x013',
+            },
+            {
+                'type': 'searchResDone', 'result': 0, 'description': 'success',
+                'controls': {SYNC_DONE_CONTROL: {'value': b'\x30\x03\x04\x014'}},
+            },
+        ])
+        events = iter(search)
+        event = next(events)
+        assert event['changeType'] == 'add'
+        assert event['attributes'] == {'o': ['added'], 'entryUUID': str(added)}
+        # The cookie is that of the yielded events
+        assert search.cookie == b'1'
+        assert next(events) is None
+        event = next(events)
+        assert event['changeType'] == CHANGE_TYPE_DELETE
+        assert event['attributes'] == {'entryUUID': str(deleted)}
+        # The present entry is skipped, the deleted entryUUID has no DN
+        event = next(events)
+        assert event['dn'] is None
+        assert event['attributes'] == {'entryUUID': str(deleted)}
+        assert search.cookie == b'2'
+        # The end of the search is raised
+        with pytest.raises(LdapWatchError):
+            next(events)
+        assert search.cookie == b'4'
+
+    def test_sync_search_refresh_required(self):
+        search = self.sync_search([{
+            'type': 'searchResDone', 'result': SYNC_REFRESH_REQUIRED,
+            'description': 'e-syncRefreshRequired',
+        }])
+        with pytest.raises(LdapSyncRefreshRequired):
+            list(search)
+
+    def test_sync_search_connection_lost(self):
+        search = self.sync_search([None, None])
+        events = iter(search)
+        assert next(events) is None
+        # The receiver thread stopped listening
+        search.connection.listening = False
+        with pytest.raises(LdapWatchError):
+            next(events)
+
     def test_add(self, ldap_wrapper):
         ldap_wrapper.connection.add.return_value = True
         result = ldap_wrapper.add('dn')
@@ -67,6 +321,194 @@ class TestLdapClient:
         assert _search_mock.call_args[0][1] == '(!(ou=people))'
         assert _search_mock.call_args[0][2] == dt
 
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_session(self, ldap_wrapper_mock):
+        ldap_client = LdapClient({})
+        assert ldap_client.session() == ldap_wrapper_mock.return_value.session.return_value
+
+    @patch('app.comm.ldap.LdapWrapper')
+    @patch.object(LdapClient, '_search', return_value=None)
+    def test_search_attributes(self, _search_mock, ldap_wrapper):
+        ldap_client = LdapClient({'attributes': {'org': ['o', 'entryUUID']}})
+        ldap_client.search_orgs()
+        assert _search_mock.call_args[0][3] == ['o', 'entryUUID', 'modifyTimestamp']
+        ldap_client.search_people()
+        assert _search_mock.call_args[0][3] == SEARCH_ATTRIBUTES
+
+    @patch('app.comm.ldap.LdapWrapper')
+    @patch.object(LdapClient, '_search', return_value=None)
+    def test_search_uuids(self, _search_mock, ldap_wrapper):
+        ldap_client = LdapClient({})
+        ldap_client.search_orgs_uuids()
+        assert _search_mock.call_args[0][0] == 'ou=orgs'
+        assert _search_mock.call_args[0][3] == ['entryUUID']
+        ldap_client.search_people_uuids()
+        assert _search_mock.call_args[0][0] == 'ou=people'
+        assert _search_mock.call_args[0][3] == ['entryUUID']
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_watch(self, ldap_wrapper_mock):
+        events = [
+            {'type': 'searchResEntry', 'dn': 'o=1,ou=orgs,dc=hetarchief,dc=be',
+             'changeType': 'add', 'attributes': {'o': '1'}},
+            None,
+            {'type': 'searchResEntry', 'dn': 'ou=people,dc=hetarchief,dc=be',
+             'changeType': 'modify', 'attributes': {}},
+            {'type': 'searchResEntry', 'dn': 'mail=a,OU=people,dc=hetarchief,dc=be',
+             'changeType': 'delete', 'attributes': {'mail': ['a']}},
+            {'type': 'searchResEntry', 'dn': None,
+             'changeType': 'delete', 'attributes': {'entryUUID': 'uuid'}},
+        ]
+        sync_search = ldap_wrapper_mock.return_value.sync_search
+        sync_search.return_value = MagicMock(cookie=b'cookie')
+        sync_search.return_value.__iter__.return_value = iter(events)
+        ldap_client = LdapClient({'attributes': {'org': ['o']}})
+        subscription = ldap_client.watch(timeout=1, cookie=b'cookie')
+        # The subscription is started right away
+        assert sync_search.call_args[0] == ('dc=hetarchief,dc=be',)
+        assert sync_search.call_args[1] == {
+            'attributes': ['o', 'modifyTimestamp', 'entryUUID', '*'],
+            'cookie': b'cookie',
+            'timeout': 1,
+        }
+        assert subscription.cookie == b'cookie'
+        changes = list(subscription)
+        assert len(changes) == 4
+        assert changes[0][0].entry_dn == 'o=1,ou=orgs,dc=hetarchief,dc=be'
+        assert changes[0][1] == 'org'
+        assert changes[1] is None
+        # The OU itself is skipped
+        assert changes[2][0].change_type == 'delete'
+        assert changes[2][1] == 'person'
+        # A deletion without DN has no type
+        assert changes[3][0].entryUUID == 'uuid'
+        assert changes[3][1] is None
+        subscription.close()
+        assert sync_search.return_value.close.call_count == 1
+
+    def test_ldap_change(self):
+        timestamp = datetime.now()
+        change = LdapChange({
+            'dn': 'o=1,ou=orgs,dc=hetarchief,dc=be',
+            'changeType': 'modify',
+            'attributes': {'o': ['1'], 'entryuuid': 'uuid', 'modifyTimestamp': timestamp}
+        })
+        assert change.change_type == 'modify'
+        assert change.entry_dn == 'o=1,ou=orgs,dc=hetarchief,dc=be'
+        assert change.entry_attributes_as_dict == {
+            'o': ['1'], 'entryuuid': ['uuid'], 'modifyTimestamp': [timestamp]
+        }
+        assert change.entryUUID == 'uuid'
+        assert change.modifyTimestamp.value == timestamp
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_shard_filters(self, ldap_wrapper_mock):
+        ldap_client = LdapClient({'shards': 2, 'shard_attributes': {'person': 'uid'}})
+        filters = ldap_client.shard_filters('person')
+        first = ''.join(f'(uid={character}*)' for character in 'abcdefghijklmnopqr')
+        second = ''.join(f'(uid={character}*)' for character in 'stuvwxyz0123456789')
+        remainder = ''.join(
+            f'(!(uid={character}*))' for character in SHARD_CHARACTERS
+        )
+        assert filters == [f'(|{first})', f'(|{second})', f'(&{remainder})']
+        assert ldap_client.shard_filters('org')[0].startswith('(|(o=a*)')
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_shard_filters_disabled(self, ldap_wrapper_mock):
+        ldap_client = LdapClient({})
+        assert ldap_client.shard_filters('person') == ['']
+
+    @patch('app.comm.ldap.LdapWrapper')
+    @patch.object(LdapClient, '_search', return_value=None)
+    def test_sharded_searches(self, _search_mock, ldap_wrapper_mock):
+        ldap_client = LdapClient({'shards': 3})
+        searches = ldap_client.sharded_searches('org', ldap_client.search_orgs)
+        assert len(searches) == 4
+        type, search = searches[-1]
+        assert type == 'org'
+        search(None)
+        assert _search_mock.call_args[0][1] == (
+            '(!(ou=orgs))' + ldap_client.shard_filters('org')[-1]
+        )
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_search_concurrently(self, ldap_wrapper_mock):
+        ldap_wrapper_mock.return_value.page_size = 2
+        ldap_client = LdapClient({})
+        dt = datetime.now()
+        searches = {
+            'org': MagicMock(return_value=iter(['org1', 'org2', 'org3'])),
+            'person': MagicMock(return_value=iter(['person1']))
+        }
+        results = list(ldap_client.search_concurrently(searches, dt))
+        assert sorted(results, key=lambda result: (result[1], len(result[0]))) == [
+            (['org3'], 'org'),
+            (['org1', 'org2'], 'org'),
+            (['person1'], 'person')
+        ]
+        assert searches['org'].call_args[0][0] == dt
+        assert ldap_wrapper_mock.return_value.session.call_count == 2
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_search_concurrently_modified_at_per_type(self, ldap_wrapper_mock):
+        ldap_wrapper_mock.return_value.page_size = 2
+        ldap_client = LdapClient({})
+        dt = datetime.now()
+        searches = {
+            'org': MagicMock(return_value=iter(['org1'])),
+            'person': MagicMock(return_value=iter(['person1']))
+        }
+        list(ldap_client.search_concurrently(searches, {'org': dt, 'person': None}))
+        assert searches['org'].call_args[0][0] == dt
+        assert searches['person'].call_args[0][0] is None
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_search_concurrently_error(self, ldap_wrapper_mock):
+        ldap_wrapper_mock.return_value.page_size = 2
+        ldap_client = LdapClient({})
+        searches = {
+            'org': MagicMock(return_value=iter(['org1'])),
+            'person': MagicMock(side_effect=LDAPSocketReceiveError('dropped'))
+        }
+        with pytest.raises(LDAPSocketReceiveError):
+            list(ldap_client.search_concurrently(searches))
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_search_concurrently_async(self, ldap_wrapper_mock):
+        ldap_wrapper_mock.return_value.page_size = 2
+        ldap_client = AsyncLdapClient({})
+        searches = {'org': MagicMock(return_value=iter(['org1', 'org2', 'org3']))}
+
+        async def collect():
+            return [
+                page async for page in ldap_client.search_concurrently_async(searches)
+            ]
+        results = asyncio.run(collect())
+        assert results == [(['org1', 'org2'], 'org'), (['org3'], 'org')]
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_search_concurrently_async_stops_searches(self, ldap_wrapper_mock):
+        ldap_client = AsyncLdapClient({})
+        closed = threading.Event()
+
+        def pages(*args):
+            try:
+                yield (['org1'], 'org')
+                yield (['org2'], 'org')
+            finally:
+                closed.set()
+
+        async def first():
+            pages = ldap_client.search_concurrently_async({})
+            page = await pages.__anext__()
+            await pages.aclose()
+            return page
+        with patch.object(LdapClient, 'search_concurrently', side_effect=pages):
+            page = asyncio.run(first())
+        assert page == (['org1'], 'org')
+        # Closing after the first page stops the searches
+        assert closed.is_set()
+
     @patch('app.comm.ldap.LdapWrapper')
     def test_search(self, ldap_wrapper_mock):
         prefix = 'prefix'
@@ -74,9 +516,73 @@ class TestLdapClient:
         dt = datetime(2020, 2, 2)
         ldap_client = LdapClient({})
         ldap_client._search(prefix, partial_filter, dt)
-        assert ldap_wrapper_mock.return_value.search.call_count == 1
+        search_mock = ldap_wrapper_mock.return_value.search_paged
+        assert search_mock.call_count == 1
 
         expected_search = f'{prefix},dc=hetarchief,dc=be'
         expected_filter = f'(&(objectClass=*){partial_filter}(!(modifyTimestamp<=20200202000000Z)))'
-        assert ldap_wrapper_mock.return_value.search.call_args[0][0] == expected_search
-        assert ldap_wrapper_mock.return_value.search.call_args[0][1] == expected_filter
+        assert search_mock.call_args[0][0] == expected_search
+        assert search_mock.call_args[0][1] == expected_filter
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_search_suffix(self, ldap_wrapper_mock):
+        ldap_client = LdapClient({'suffix': 'dc=example,dc=org'})
+        ldap_client.search_orgs()
+        search_mock = ldap_wrapper_mock.return_value.search_paged
+        assert search_mock.call_args[0][0] == 'ou=orgs,dc=example,dc=org'
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_search_subtree(self, ldap_wrapper_mock):
+        ldap_client = LdapClient({'shards': 2})
+        # Types without shard attribute are not sharded
+        assert ldap_client.shard_filters('vendor') == ['']
+        ldap_client.search_subtree(
+            'ou=vendors,dc=example,dc=org', '(objectClass=organization)', 'vendor',
+            shard_filter='(o=a*)'
+        )
+        search_mock = ldap_wrapper_mock.return_value.search_paged
+        assert search_mock.call_args[0] == (
+            'ou=vendors,dc=example,dc=org',
+            '(&(objectClass=*)(objectClass=organization)(o=a*))'
+        )
+        assert search_mock.call_args[1] == {'attributes': SEARCH_ATTRIBUTES}
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_search_records(self, ldap_wrapper_mock):
+        search_mock = ldap_wrapper_mock.return_value.search_paged
+        search_mock.return_value = iter([{
+            'dn': 'o=org',
+            'attributes': {'o': 'org', 'entryUUID': 'uuid'},
+        }])
+        ldap_client = LdapClient({})
+        metrics.reset()
+        records = list(ldap_client.search_orgs(records=True))
+        assert search_mock.call_args[1]['raw'] is True
+        content = serialize_entry('o=org', {'o': ['org'], 'entryUUID': ['uuid']})
+        assert records == [EntityRecord('uuid', 'org', content, None)]
+        # Building the records is timed per type
+        assert metrics.spans[('transform', (('type', 'org'),))][1] == 1
+
+    @patch('app.comm.ldap.LdapWrapper')
+    def test_search_records_skips_unchanged(self, ldap_wrapper_mock):
+        dt = datetime(2020, 2, 2, tzinfo=timezone.utc)
+        search_mock = ldap_wrapper_mock.return_value.search_paged
+        search_mock.return_value = iter([
+            {'dn': f'o={uuid}', 'attributes': {
+                'entryUUID': uuid, 'modifyTimestamp': modify_timestamp
+            }}
+            for uuid, modify_timestamp in (
+                ('unchanged', dt), ('changed', dt), ('new', dt)
+            )
+        ])
+        # The stored timestamps are read in the time zone of the session
+        cet = timezone(timedelta(hours=1))
+        last_modified = {
+            'unchanged': datetime(2020, 2, 2, 1, tzinfo=cet),
+            'changed': datetime(2020, 2, 2, tzinfo=cet),
+        }
+        ldap_client = LdapClient({})
+        records = list(
+            ldap_client.search_people(records=True, last_modified=last_modified)
+        )
+        assert [record.ldap_uuid for record in records] == ['changed', 'new']
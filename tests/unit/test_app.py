@@ -2,73 +2,505 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+from concurrent.futures import Future
 from unittest.mock import patch
 from datetime import datetime
+from types import SimpleNamespace
 from ldap3.core.exceptions import LDAPExceptionError
 from psycopg2 import OperationalError as PSQLError
 
-from app.app import App
-from app.comm.deewee import DeeweeClient
-from app.comm.ldap import LdapClient
+from app.app import App, AsyncApp
+from app.comm.deewee import (
+    DeeweeClient, UpsertStats, DELETE_STRATEGY_NONE, DELETE_STRATEGY_DELETE,
+    content_hash
+)
+from app.comm.ldap import LdapClient, LdapSyncRefreshRequired, LdapWatchError
+from app.metrics import Metrics
+from app.serialization import EntityRecord
+from app.snapshot import Snapshot
+from app.sources import Subtree, SubtreeResult, SyncSource
+
+
+class Subscription:
+    """A subscription that yields the changes and sets the cookie of each"""
+
+    def __init__(self, changes: list, end=KeyboardInterrupt):
+        self.changes = changes
+        self.end = end
+        self.cookie = b'0'
+        self.closed = False
+
+    def __iter__(self):
+        for change, cookie in self.changes:
+            self.cookie = cookie
+            yield change
+        raise self.end
+
+    def close(self):
+        self.closed = True
 
 
 class TestApp:
 
     @patch.object(App, '_sync', return_value=None)
     @patch.object(
-        DeeweeClient, 'max_last_modified_timestamp', return_value=None
+        DeeweeClient, 'watermarks', return_value={'org': None, 'person': None}
     )
-    def test_main_full(self, max_last_modified_timestamp_mock, sync_mock):
+    def test_main_full(self, watermarks_mock, sync_mock):
         app = App()
         app.main()
 
         assert sync_mock.call_count == 1
-        assert max_last_modified_timestamp_mock.call_count == 1
+        assert watermarks_mock.call_count == 1
+        assert watermarks_mock.call_args[0][0] == ('org', 'person')
 
         call_arg = sync_mock.call_args[0][0]
-        assert call_arg is None
+        assert call_arg == {'org': None, 'person': None}
 
     @patch.object(App, '_sync', return_value=None)
     @patch.object(
-        DeeweeClient, 'max_last_modified_timestamp', return_value=datetime.now()
+        DeeweeClient, 'watermarks',
+        return_value={'org': datetime.now(), 'person': None}
     )
-    def test_main_diff(self, max_last_modified_timestamp_mock, sync_mock):
+    def test_main_diff(self, watermarks_mock, sync_mock):
         app = App()
         app.main()
 
         assert sync_mock.call_count == 1
-        assert max_last_modified_timestamp_mock.call_count == 1
+        assert watermarks_mock.call_count == 1
 
+        # Every type is synced since its own watermark
         call_arg = sync_mock.call_args[0][0]
-        assert type(call_arg) == datetime
+        assert type(call_arg['org']) == datetime
+        assert call_arg['person'] is None
 
+    @patch.object(LdapClient, 'session')
     @patch.object(LdapClient, 'search_orgs', return_value=['org1'])
     @patch.object(LdapClient, 'search_people', return_value=['person1'])
-    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=None)
-    def test_sync(self, upsert_ldap_results_many_mock, search_people_mock, search_orgs_mock):
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats())
+    def test_sync(self, upsert_ldap_results_many_mock, search_people_mock,
+                  search_orgs_mock, session_mock):
         app = App()
         app._sync()
 
+        assert upsert_ldap_results_many_mock.call_count == 1
+        # The searches are executed while the results are consumed
+        ldap_results = list(upsert_ldap_results_many_mock.call_args[0][0])
+
         assert search_orgs_mock.call_count == 1
         assert search_people_mock.call_count == 1
-        assert upsert_ldap_results_many_mock.call_count == 1
+        # Every concurrent search binds once in its own session
+        assert session_mock.call_count == 2
 
         assert search_orgs_mock.call_args[0][0] is None
         assert search_people_mock.call_args[0][0] is None
-        assert upsert_ldap_results_many_mock.call_args[0][0] == [
+        assert sorted(ldap_results, key=lambda result: result[1]) == [
             (['org1'], 'org'),
             (['person1'], 'person')
         ]
 
-    @patch.object(DeeweeClient, 'max_last_modified_timestamp', side_effect=PSQLError)
+    @patch.object(LdapClient, 'session')
+    @patch.object(LdapClient, 'search_orgs', return_value=['org1'])
+    @patch.object(LdapClient, 'search_people', return_value=['person1'])
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats())
+    def test_sync_sharded(self, upsert_ldap_results_many_mock, search_people_mock,
+                          search_orgs_mock, session_mock):
+        app = App()
+        app.ldap_client.shards = 2
+        app._sync({'org': None, 'person': datetime.now()})
+        list(upsert_ldap_results_many_mock.call_args[0][0])
+
+        # Only the full sync of the orgs is split into shards (+ the remainder)
+        assert search_orgs_mock.call_count == 3
+        assert search_people_mock.call_count == 1
+        shard_filters = {
+            call[1]['shard_filter'] for call in search_orgs_mock.call_args_list
+        }
+        assert shard_filters == set(app.ldap_client.shard_filters('org'))
+
+    @patch.object(LdapClient, 'session')
+    @patch.object(LdapClient, 'search_orgs', return_value=['org1'])
+    @patch.object(LdapClient, 'search_people', return_value=['person1'])
+    @patch.object(DeeweeClient, 'last_modified_index')
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats())
+    def test_sync_dirty_check(self, upsert_ldap_results_many_mock,
+                              last_modified_index_mock, search_people_mock,
+                              search_orgs_mock, session_mock):
+        dt = datetime.now()
+        last_modified_index_mock.return_value = {'org': {'uuid': dt}, 'person': {}}
+        app = App()
+        app.deewee_client.dirty_check = True
+        app._sync({'org': dt})
+        list(upsert_ldap_results_many_mock.call_args[0][0])
+
+        assert last_modified_index_mock.call_args[0][0] == {'org': dt, 'person': None}
+        assert search_orgs_mock.call_args[1]['last_modified'] == {'uuid': dt}
+        assert search_people_mock.call_args[1]['last_modified'] == {}
+
+    @patch.object(DeeweeClient, 'last_modified_index')
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats())
+    def test_sync_no_dirty_check(self, upsert_ldap_results_many_mock,
+                                 last_modified_index_mock):
+        app = App()
+        app._sync()
+
+        assert last_modified_index_mock.call_count == 0
+
+    @patch.object(LdapClient, 'session')
+    @patch.object(LdapClient, 'search_orgs_uuids', return_value=['org1'])
+    @patch.object(LdapClient, 'search_people_uuids', return_value=['person1'])
+    @patch.object(DeeweeClient, 'reconcile_ldap_uuids', return_value={'org': 1})
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats())
+    def test_sync_reconcile(self, upsert_ldap_results_many_mock,
+                            reconcile_ldap_uuids_mock, search_people_uuids_mock,
+                            search_orgs_uuids_mock, session_mock):
+        app = App()
+        app.deewee_client.delete_strategy = DELETE_STRATEGY_DELETE
+        app._sync()
+
+        assert reconcile_ldap_uuids_mock.call_count == 1
+        ldap_uuids = list(reconcile_ldap_uuids_mock.call_args[0][0])
+        assert sorted(ldap_uuids, key=lambda result: result[1]) == [
+            (['org1'], 'org'),
+            (['person1'], 'person')
+        ]
+        assert reconcile_ldap_uuids_mock.call_args[0][1] == ('org', 'person')
+
+    @patch.object(DeeweeClient, 'reconcile_ldap_uuids')
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats())
+    def test_sync_no_reconcile(self, upsert_ldap_results_many_mock,
+                               reconcile_ldap_uuids_mock):
+        app = App()
+        app.deewee_client.delete_strategy = DELETE_STRATEGY_NONE
+        app._sync()
+
+        assert reconcile_ldap_uuids_mock.call_count == 0
+
+    @patch.object(LdapClient, 'session')
+    @patch.object(LdapClient, 'search_people', return_value=[])
+    @patch.object(LdapClient, 'search_orgs')
+    @patch.object(DeeweeClient, 'snapshot_rows')
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many')
+    def test_sync_snapshot(self, upsert_ldap_results_many_mock, snapshot_rows_mock,
+                           search_orgs_mock, search_people_mock, session_mock,
+                           tmp_path):
+        unchanged = EntityRecord('uuid1', 'org', '{}', None)
+        changed = EntityRecord('uuid2', 'org', '{"o": 1}', None)
+        snapshot_rows_mock.return_value = [
+            ('uuid1', 'org', content_hash('{}'), None),
+            ('uuid2', 'org', content_hash('{}'), None),
+        ]
+        search_orgs_mock.return_value = [unchanged, changed]
+        upserted = []
+
+        def upsert(ldap_results):
+            upserted.extend((page, type) for page, type in ldap_results if page)
+            return UpsertStats()
+        upsert_ldap_results_many_mock.side_effect = upsert
+        app = App()
+        app.snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+        app._sync({'org': None, 'person': None})
+
+        # The snapshot is seeded once and only the changed entries are upserted
+        assert snapshot_rows_mock.call_count == 1
+        assert upserted == [([changed], 'org')]
+        # The upserted entries are saved into the snapshot
+        assert app.snapshot.changed([unchanged, changed], 'org', []) == []
+
+    @patch.object(LdapClient, 'session')
+    @patch.object(LdapClient, 'search_orgs_uuids')
+    @patch.object(LdapClient, 'search_people_uuids', return_value=[])
+    @patch.object(DeeweeClient, 'reconcile_ldap_uuids')
+    @patch.object(DeeweeClient, 'remove_ldap_uuids', return_value=1)
+    def test_reconcile_snapshot(self, remove_ldap_uuids_mock,
+                                reconcile_ldap_uuids_mock, search_people_uuids_mock,
+                                search_orgs_uuids_mock, session_mock, tmp_path):
+        search_orgs_uuids_mock.return_value = [SimpleNamespace(entryUUID='uuid1')]
+        app = App()
+        app.snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+        app.snapshot.seed([('uuid1', 'org', None, None), ('uuid2', 'org', None, None)])
+        app._reconcile()
+
+        # The deletes are diffed locally, only those are sent to the database
+        assert reconcile_ldap_uuids_mock.call_count == 0
+        assert remove_ldap_uuids_mock.call_args[0][0] == ['uuid2']
+        assert app.snapshot.deleted('org', ['uuid1']) == []
+
+    @patch.object(LdapClient, 'session')
+    @patch.object(LdapClient, 'search_orgs')
+    @patch.object(LdapClient, 'search_people', return_value=[])
+    @patch.object(LdapClient, 'search_orgs_uuids')
+    @patch.object(LdapClient, 'search_people_uuids', return_value=[])
+    @patch.object(DeeweeClient, 'live_ldap_uuids')
+    @patch.object(DeeweeClient, 'content_hashes')
+    @patch.object(
+        DeeweeClient, 'watermarks', return_value={'org': None, 'person': None}
+    )
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many')
+    @patch.object(DeeweeClient, 'close')
+    def test_plan(self, close_mock, upsert_ldap_results_many_mock, watermarks_mock,
+                  content_hashes_mock, live_ldap_uuids_mock,
+                  search_people_uuids_mock, search_orgs_uuids_mock,
+                  search_people_mock, search_orgs_mock, session_mock, capsys):
+        search_orgs_mock.return_value = [
+            EntityRecord('uuid1', 'org', '{}', None),
+            EntityRecord('uuid2', 'org', '{}', None),
+        ]
+        content_hashes_mock.return_value = {'uuid1': content_hash('{}')}
+        search_orgs_uuids_mock.return_value = [
+            SimpleNamespace(entryUUID='uuid1'), SimpleNamespace(entryUUID='uuid2')
+        ]
+        live_ldap_uuids_mock.side_effect = lambda type: {
+            'org': ['uuid0', 'uuid1'], 'person': ['uuid3']
+        }[type]
+        app = App()
+        app.deewee_client.delete_strategy = DELETE_STRATEGY_DELETE
+        plan = app.plan()
+
+        assert content_hashes_mock.call_args[0][0] == ['uuid1', 'uuid2']
+        assert plan.counts('org').new == 1
+        assert plan.counts('org').unchanged == 1
+        assert plan.counts('org').deleted == 1
+        assert plan.counts('person').deleted == 1
+        # Nothing is written
+        assert upsert_ldap_results_many_mock.call_count == 0
+        assert close_mock.call_count == 1
+        assert capsys.readouterr().out == plan.format() + '\n'
+
+    @patch('app.app.parse_sources')
+    @patch('app.app.run_sources')
+    @patch.object(DeeweeClient, 'close')
+    def test_sync_sources(self, close_mock, run_sources_mock, parse_sources_mock):
+        source = SyncSource('a', {})
+        subtrees = [Subtree('org', 'dc=a'), Subtree('person', 'dc=a')]
+        synced, failed = Future(), Future()
+        synced.set_result(SubtreeResult(
+            UpsertStats(1), counters={('entries', (('type', 'org'),)): 1}
+        ))
+        failed.set_exception(PSQLError('failed'))
+        run_sources_mock.return_value = [
+            (source, subtrees[0], synced), (source, subtrees[1], failed)
+        ]
+        app = App()
+        with patch('app.app.metrics', Metrics()) as metrics_mock:
+            # The other subtrees are synced before the failure is raised
+            with pytest.raises(PSQLError):
+                app.sync_sources()
+            assert metrics_mock.as_dict()['counters'] == {
+                'entries{source="a",table="entities",type="org"}': 1
+            }
+        assert close_mock.call_count == 1
+
+    def test_micro_batches(self):
+        app = App()
+        app.watch_batch_size = 2
+        app.watch_flush_interval = 60
+        changes = ['change1', None, 'change2', 'change3', None]
+        assert list(app._micro_batches(changes)) == [
+            ['change1', 'change2'], ['change3']
+        ]
+
+    @patch('app.app.time.monotonic', side_effect=[0, 0, 2])
+    def test_micro_batches_flush_interval(self, monotonic_mock):
+        app = App()
+        app.watch_batch_size = 100
+        app.watch_flush_interval = 1
+        changes = ['change1', None, None]
+        assert list(app._micro_batches(changes)) == [['change1']]
+
+    @patch.object(DeeweeClient, 'remove_ldap_uuids', return_value=1)
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats())
+    def test_apply_changes(self, upsert_ldap_results_many_mock, remove_ldap_uuids_mock):
+        app = App()
+        app.deewee_client.delete_strategy = DELETE_STRATEGY_DELETE
+        added = SimpleNamespace(change_type='add', entryUUID='uuid1')
+        modified = SimpleNamespace(change_type='modify', entryUUID='uuid2')
+        deleted = SimpleNamespace(change_type='delete', entryUUID='uuid3')
+        app._apply_changes([(added, 'org'), (modified, 'person'), (deleted, 'person')])
+
+        assert upsert_ldap_results_many_mock.call_args[0][0] == [
+            ([added], 'org'), ([modified], 'person')
+        ]
+        assert remove_ldap_uuids_mock.call_args[0][0] == ['uuid3']
+
+    @patch.object(DeeweeClient, 'remove_ldap_uuids')
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats())
+    def test_apply_changes_keep_deleted(self, upsert_ldap_results_many_mock,
+                                        remove_ldap_uuids_mock):
+        app = App()
+        app.deewee_client.delete_strategy = DELETE_STRATEGY_NONE
+        deleted = SimpleNamespace(change_type='delete', entryUUID='uuid3')
+        app._apply_changes([(deleted, 'person')])
+
+        assert remove_ldap_uuids_mock.call_count == 0
+
+    @patch.object(DeeweeClient, 'close')
+    @patch.object(DeeweeClient, 'save_cookie')
+    @patch.object(DeeweeClient, 'cookie', return_value=b'0')
+    @patch.object(App, '_apply_changes')
+    @patch.object(App, '_sync')
+    @patch.object(
+        DeeweeClient, 'watermarks', return_value={'org': None, 'person': None}
+    )
+    @patch.object(LdapClient, 'watch')
+    def test_watch(self, watch_mock, watermarks_mock, sync_mock,
+                   apply_changes_mock, cookie_mock, save_cookie_mock, close_mock):
+        subscription = Subscription([('change1', b'1'), ('change2', b'2')])
+        watch_mock.return_value = subscription
+        app = App()
+        app.watch_batch_size = 1
+        app.watch()
+
+        # The subscription resumes from the saved cookie
+        assert watch_mock.call_args[0][1] == b'0'
+        # Catch up with the changes since the last sync
+        assert sync_mock.call_count == 1
+        assert sync_mock.call_args[0][0] == {'org': None, 'person': None}
+        assert [
+            call[0][0] for call in apply_changes_mock.call_args_list
+        ] == [['change1'], ['change2']]
+        # The cookie is saved after every applied batch
+        assert [
+            call[0][0] for call in save_cookie_mock.call_args_list
+        ] == [b'1', b'2']
+        assert subscription.closed
+        assert close_mock.call_count == 1
+
+    @patch.object(DeeweeClient, 'close')
+    @patch.object(DeeweeClient, 'cookie', return_value=None)
+    @patch.object(App, '_sync', side_effect=LDAPExceptionError)
+    @patch.object(
+        DeeweeClient, 'watermarks', return_value={'org': None, 'person': None}
+    )
+    @patch.object(LdapClient, 'watch')
+    def test_watch_catch_up_error(self, watch_mock, *args):
+        subscription = Subscription([])
+        watch_mock.return_value = subscription
+        app = App()
+        with pytest.raises(LDAPExceptionError):
+            app.watch()
+
+        # The subscription is stopped, although it was never iterated
+        assert subscription.closed
+
+    @patch.object(DeeweeClient, 'close')
+    @patch.object(DeeweeClient, 'save_cookie')
+    @patch.object(DeeweeClient, 'cookie', side_effect=[b'0', None])
+    @patch.object(App, '_apply_changes')
+    @patch.object(App, '_sync')
+    @patch.object(
+        DeeweeClient, 'watermarks', return_value={'org': None, 'person': None}
+    )
+    @patch.object(LdapClient, 'watch')
+    def test_watch_refresh_required(self, watch_mock, watermarks_mock, sync_mock,
+                                    apply_changes_mock, cookie_mock,
+                                    save_cookie_mock, close_mock):
+        subscriptions = [
+            Subscription([], LdapSyncRefreshRequired),
+            Subscription([], LdapWatchError),
+        ]
+        watch_mock.side_effect = subscriptions
+        app = App()
+        with pytest.raises(LdapWatchError):
+            app.watch()
+
+        # The cookie is dropped and the subscription is started over
+        assert save_cookie_mock.call_args_list[0][0] == (None,)
+        assert watch_mock.call_args_list[1][0][1] is None
+        assert sync_mock.call_count == 2
+        assert all(subscription.closed for subscription in subscriptions)
+
+    @patch.object(DeeweeClient, 'close')
+    @patch.object(DeeweeClient, 'rebuild_ldap_results', return_value=4)
+    @patch.object(LdapClient, 'search_concurrently', return_value=iter([]))
+    def test_rebuild(self, search_concurrently_mock, rebuild_ldap_results_mock,
+                     close_mock):
+        app = App()
+        app.ldap_client.shards = 2
+        app.rebuild()
+
+        # All entries are searched, in shards
+        searches = search_concurrently_mock.call_args[0][0]
+        assert [type for type, _ in searches] == ['org'] * 3 + ['person'] * 3
+        assert rebuild_ldap_results_mock.call_args[0][0] == (
+            search_concurrently_mock.return_value
+        )
+        assert close_mock.call_count == 1
+
+    @patch.object(DeeweeClient, 'watermarks', side_effect=PSQLError)
     def test_main_psql_error(self, should_do_full_sync_mock):
         app = App()
         with pytest.raises(PSQLError):
             app.main()
 
     @patch.object(App, '_sync', side_effect=LDAPExceptionError)
-    @patch.object(DeeweeClient, 'max_last_modified_timestamp', return_value=None)
+    @patch.object(
+        DeeweeClient, 'watermarks', return_value={'org': None, 'person': None}
+    )
     def test_main_ldap_error(self, should_do_full_sync_mock, sync_mock):
         app = App()
         with pytest.raises(LDAPExceptionError):
             app.main()
+
+    @patch.object(Metrics, 'push')
+    @patch.object(Metrics, 'write_textfile')
+    @patch.object(App, '_sync', return_value=None)
+    @patch.object(
+        DeeweeClient, 'watermarks', return_value={'org': None, 'person': None}
+    )
+    def test_main_export_metrics(self, watermarks_mock, sync_mock,
+                                 write_textfile_mock, push_mock):
+        app = App()
+        app.metrics_params = {
+            'textfile': '/tmp/ldap2deewee.prom',
+            'pushgateway': 'http://pushgateway:9091'
+        }
+        app.main()
+
+        assert write_textfile_mock.call_args[0][0] == '/tmp/ldap2deewee.prom'
+        assert push_mock.call_args[0] == ('http://pushgateway:9091', 'ldap2deewee')
+
+    @patch.object(Metrics, 'push', side_effect=OSError)
+    @patch.object(App, '_sync', return_value=None)
+    @patch.object(
+        DeeweeClient, 'watermarks', return_value={'org': None, 'person': None}
+    )
+    def test_main_export_metrics_error(self, watermarks_mock, sync_mock, push_mock):
+        app = App()
+        app.metrics_params = {'pushgateway': 'http://pushgateway:9091'}
+        # Failing to export the metrics does not fail the sync
+        app.main()
+
+        assert push_mock.call_count == 1
+
+    @patch('app.comm.deewee.asyncpg')
+    @patch.object(
+        LdapClient, 'search_concurrently',
+        return_value=(page for page in [(['org1'], 'org')])
+    )
+    @patch.object(
+        DeeweeClient, 'watermarks', return_value={'org': datetime.now(), 'person': None}
+    )
+    def test_async_main(self, watermarks_mock, search_concurrently_mock, asyncpg_mock):
+        app = AsyncApp()
+        upserted = []
+        closed = []
+
+        async def upsert_ldap_results_many_async(ldap_results):
+            upserted.extend([page async for page in ldap_results])
+            return UpsertStats(inserted=1)
+
+        async def close_async():
+            closed.append(True)
+        app.deewee_client.upsert_ldap_results_many_async = (
+            upsert_ldap_results_many_async
+        )
+        app.deewee_client.close_async = close_async
+        app.main()
+
+        assert upserted == [(['org1'], 'org')]
+        assert closed == [True]
+        # Every type is searched since its own watermark
+        searches, modified_since, _ = search_concurrently_mock.call_args[0]
+        assert modified_since == watermarks_mock.return_value
+        assert [type for type, _ in searches] == ['org', 'person']
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+from unittest.mock import patch
+
+from app import metrics as metrics_module
+from app.metrics import Metrics
+
+
+class TestMetrics:
+
+    @pytest.fixture
+    def metrics(self):
+        return Metrics()
+
+    def test_span(self, metrics):
+        with patch.object(metrics_module.time, 'perf_counter', side_effect=[1, 3.5]):
+            with metrics.span('ldap_search', base='ou=orgs'):
+                pass
+        metrics.add_span('ldap_search', 0.5, base='ou=orgs')
+
+        assert metrics.as_dict()['spans'] == {
+            'ldap_search{base="ou=orgs"}': {'seconds': 3.0, 'count': 2}
+        }
+
+    def test_span_exception(self, metrics):
+        with pytest.raises(ValueError):
+            with metrics.span('transform'):
+                raise ValueError
+
+        assert metrics.as_dict()['spans']['transform']['count'] == 1
+
+    def test_increment(self, metrics):
+        metrics.increment('entries', type='org')
+        metrics.increment('entries', 2, type='org')
+        metrics.increment('entries', type='person')
+        metrics.increment('batches')
+
+        assert metrics.as_dict()['counters'] == {
+            'batches': 1,
+            'entries{type="org"}': 3,
+            'entries{type="person"}': 1,
+        }
+
+    def test_reset(self, metrics):
+        metrics.increment('batches')
+        metrics.add_span('transform', 1)
+        metrics.reset()
+
+        assert metrics.as_dict() == {'spans': {}, 'counters': {}}
+
+    def test_merge(self, metrics):
+        other = Metrics()
+        other.add_span('sync', 2)
+        other.increment('entries', 3, type='org')
+        metrics.increment('entries', 1, type='org', source='a')
+        metrics.merge(other.spans, other.counters, source='a')
+        metrics.merge(other.spans, other.counters, source='b')
+
+        assert metrics.as_dict() == {
+            'spans': {
+                'sync{source="a"}': {'seconds': 2, 'count': 1},
+                'sync{source="b"}': {'seconds': 2, 'count': 1},
+            },
+            'counters': {
+                'entries{source="a",type="org"}': 4,
+                'entries{source="b",type="org"}': 3,
+            },
+        }
+
+    def test_to_prometheus(self, metrics):
+        metrics.add_span('ldap_search', 1.5, base='ou="orgs"')
+        metrics.increment('entries', 2, type='org')
+        metrics.increment('batches')
+
+        assert metrics.to_prometheus() == (
+            '# TYPE ldap2deewee_span_seconds_total counter\n'
+            'ldap2deewee_span_seconds_total'
+            '{span="ldap_search",base="ou=\\"orgs\\""} 1.5\n'
+            '# TYPE ldap2deewee_span_count_total counter\n'
+            'ldap2deewee_span_count_total'
+            '{span="ldap_search",base="ou=\\"orgs\\""} 1\n'
+            '# TYPE ldap2deewee_batches_total counter\n'
+            'ldap2deewee_batches_total 1\n'
+            '# TYPE ldap2deewee_entries_total counter\n'
+            'ldap2deewee_entries_total{type="org"} 2\n'
+        )
+
+    def test_write_textfile(self, metrics, tmp_path):
+        metrics.increment('batches')
+        path = tmp_path / 'ldap2deewee.prom'
+        metrics.write_textfile(str(path))
+
+        assert path.read_text() == metrics.to_prometheus()
+        # The temporary file has been renamed
+        assert list(tmp_path.iterdir()) == [path]
+
+    @patch.object(metrics_module.urllib.request, 'urlopen')
+    def test_push(self, urlopen_mock, metrics):
+        metrics.increment('batches')
+        metrics.push('http://pushgateway:9091/', 'sync')
+
+        request = urlopen_mock.call_args[0][0]
+        assert request.full_url == 'http://pushgateway:9091/metrics/job/sync'
+        assert request.get_method() == 'PUT'
+        assert request.data == metrics.to_prometheus().encode('utf-8')
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from app.comm.deewee import content_hash
+from app.plan import SyncPlan, PlanCounts, ESTIMATED_ROW_OVERHEAD_BYTES
+from app.serialization import EntityRecord
+
+
+def record(ldap_uuid: str, content: str = '{}') -> EntityRecord:
+    return EntityRecord(ldap_uuid, 'org', content, None)
+
+
+class TestSyncPlan:
+
+    def test_add(self):
+        plan = SyncPlan()
+        records = [
+            record('new'),
+            record('changed', '{"o": 1}'),
+            record('unchanged'),
+            record('tombstoned'),
+        ]
+        hashes = {
+            'changed': content_hash('{}'),
+            'unchanged': content_hash('{}'),
+            'tombstoned': None,
+        }
+        plan.add(records, 'org', hashes)
+
+        assert plan.counts('org') == PlanCounts(
+            new=1,
+            changed=2,
+            unchanged=1,
+            estimated_bytes=len('{}{"o": 1}{}') + 3 * ESTIMATED_ROW_OVERHEAD_BYTES
+        )
+
+    def test_total(self):
+        plan = SyncPlan()
+        plan.add([record('new')], 'org', {})
+        plan.add([record('new')], 'person', {})
+        plan.counts('person').deleted = 2
+
+        total = plan.total()
+        assert total.new == 2
+        assert total.deleted == 2
+        assert total.estimated_bytes == 2 * (2 + ESTIMATED_ROW_OVERHEAD_BYTES)
+
+    def test_format(self):
+        plan = SyncPlan()
+        plan.add([record('new')], 'org', {})
+
+        assert plan.format().splitlines() == [
+            'type   new  changed  unchanged  deleted  estimated_bytes',
+            'org      1        0          0        -              102',
+            'total    1        0          0        -              102',
+        ]
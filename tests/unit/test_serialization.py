@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from app import serialization
+from app.serialization import EntityRecord, serialize_entry
+
+
+ATTRIBUTES = {
+    'o': ['meemoo'],
+    'mail': ['test@meemoo.be', 'tést@meemoo.be'],
+    'modifyTimestamp': datetime(2020, 2, 2, 12, 30, tzinfo=timezone.utc),
+    'jpegPhoto': [b'\xff\xd8'],
+    'telephoneNumber': [1111],
+}
+
+
+class TestSerialization:
+
+    def test_serialize_entry_json(self):
+        with patch.object(serialization, 'orjson', None):
+            content = serialize_entry('o=meemoo', ATTRIBUTES)
+        assert content == (
+            '{"attributes":{"jpegPhoto":[{"encoded":"/9g=","encoding":"base64"}],'
+            '"mail":["test@meemoo.be","tést@meemoo.be"],'
+            '"modifyTimestamp":"2020-02-02 12:30:00+00:00",'
+            '"o":["meemoo"],"telephoneNumber":[1111]},"dn":"o=meemoo"}'
+        )
+
+    def test_serialize_entry_stable(self):
+        reversed_attributes = dict(reversed(list(ATTRIBUTES.items())))
+        assert serialize_entry('o=meemoo', ATTRIBUTES) == serialize_entry(
+            'o=meemoo', reversed_attributes
+        )
+
+    def test_serialize_entry_orjson(self):
+        pytest.importorskip('orjson')
+        assert serialize_entry('o=meemoo', ATTRIBUTES) == serialize_entry(
+            'o=meemoo', ATTRIBUTES, use_orjson=False
+        )
+
+    def test_serialize_entry_same_content_as_ldap3(self):
+        content = json.loads(serialize_entry('o=meemoo', {'o': ['meemoo']}))
+        assert content == {'attributes': {'o': ['meemoo']}, 'dn': 'o=meemoo'}
+
+
+class TestEntityRecord:
+
+    def test_from_response(self):
+        dt = datetime(2020, 2, 2, 12, 30, tzinfo=timezone.utc)
+        response = {
+            'dn': 'o=meemoo',
+            'attributes': {
+                'o': 'meemoo',
+                'mail': ['test@meemoo.be'],
+                'entryuuid': ['uuid'],
+                'modifyTimestamp': dt,
+                'entryDN': 'o=meemoo',
+            },
+        }
+        record = EntityRecord.from_response(response, 'org')
+        assert record.ldap_uuid == 'uuid'
+        assert record.type == 'org'
+        assert record.last_modified_timestamp == dt
+        # The values are lists and entryDN is left out, like in an ldap3 Entry
+        assert record.content == serialize_entry('o=meemoo', {
+            'o': ['meemoo'],
+            'mail': ['test@meemoo.be'],
+            'entryuuid': ['uuid'],
+            'modifyTimestamp': [dt],
+        })
+
+    def test_from_response_without_schema(self):
+        response = {
+            'dn': 'o=meemoo',
+            'attributes': {'modifyTimestamp': ['20200202123000Z']},
+        }
+        record = EntityRecord.from_response(response, 'org')
+        assert record.ldap_uuid is None
+        assert record.last_modified_timestamp == datetime(
+            2020, 2, 2, 12, 30, tzinfo=timezone.utc
+        )
+
+    def test_identify(self):
+        response = {
+            'dn': 'o=meemoo',
+            'attributes': {'entryUUID': 'uuid', 'modifyTimestamp': '20200202123000Z'},
+        }
+        assert EntityRecord.identify(response) == (
+            'uuid', datetime(2020, 2, 2, 12, 30, tzinfo=timezone.utc)
+        )
+
+    def test_slots(self):
+        record = EntityRecord('uuid', 'org', '{}', None)
+        assert not hasattr(record, '__dict__')
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+from datetime import datetime
+
+from app.comm.deewee import content_hash
+from app.metrics import metrics
+from app.serialization import EntityRecord
+from app.snapshot import Snapshot, anti_merge_join, MAX_VARIABLES
+
+
+def record(ldap_uuid: str, content: str = '{}') -> EntityRecord:
+    return EntityRecord(ldap_uuid, 'org', content, datetime(2020, 2, 2))
+
+
+class TestSnapshot:
+
+    @pytest.fixture
+    def snapshot(self, tmp_path):
+        snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+        yield snapshot
+        snapshot.close()
+
+    def test_seed(self, snapshot, tmp_path):
+        assert not snapshot.seeded
+        snapshot.seed([('uuid1', 'org', content_hash('{}'), datetime(2020, 2, 2))])
+        assert snapshot.seeded
+        snapshot.close()
+
+        # The snapshot is kept on disk
+        snapshot = Snapshot(snapshot.path)
+        assert snapshot.seeded
+        assert snapshot.changed([record('uuid1')], 'org', []) == []
+
+    def test_changed(self, snapshot):
+        snapshot.seed([
+            ('unchanged', 'org', content_hash('{}'), None),
+            ('changed', 'org', content_hash('{}'), None),
+        ])
+        metrics.reset()
+        rows = []
+        records = [record('unchanged'), record('changed', '{"o": 1}'), record('new')]
+
+        changed = snapshot.changed(records, 'org', rows)
+        assert [r.ldap_uuid for r in changed] == ['changed', 'new']
+        assert [row[:3] for row in rows] == [
+            ('changed', 'org', content_hash('{"o": 1}')),
+            ('new', 'org', content_hash('{}')),
+        ]
+        assert metrics.as_dict()['counters'] == {'entries_skipped{type="org"}': 1}
+
+        # The changes are only known to the snapshot once they are saved
+        assert len(snapshot.changed(records, 'org', [])) == 2
+        snapshot.save(rows)
+        assert snapshot.changed(records, 'org', []) == []
+
+    def test_changed_many(self, snapshot):
+        records = [record(f'uuid{index}') for index in range(MAX_VARIABLES + 1)]
+        rows = []
+        snapshot.changed(records, 'org', rows)
+        snapshot.save(rows)
+        assert snapshot.changed(records, 'org', []) == []
+
+    def test_deleted(self, snapshot):
+        snapshot.seed([
+            ('a', 'org', None, None),
+            ('b', 'org', None, None),
+            ('c', 'org', None, None),
+            ('d', 'person', None, None),
+        ])
+        assert snapshot.deleted('org', ['c', 'x', 'a']) == ['b']
+        assert snapshot.deleted('person', []) == ['d']
+
+        snapshot.remove(['b'])
+        assert snapshot.deleted('org', ['c', 'a']) == []
+
+    def test_anti_merge_join(self):
+        assert anti_merge_join(['a', 'b', 'd', 'f'], ['b', 'c', 'd', 'e']) == ['a', 'f']
+        assert anti_merge_join([], ['a']) == []
+        assert anti_merge_join(['a'], []) == ['a']
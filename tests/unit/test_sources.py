@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest.mock import patch
+
+from app.comm.deewee import DeeweeClient, UpsertStats, DELETE_STRATEGY_DELETE
+from app.comm.ldap import LdapClient, UUID_ATTRIBUTES
+from app.sources import (
+    Subtree, SyncSource, parse_sources, run_sources, sync_subtree
+)
+
+
+class TestSources:
+
+    def test_parse_sources(self):
+        sources = parse_sources(
+            {'sources': [{
+                'name': 'a',
+                'max_workers': 2,
+                'ldap': {'URI': 'ldap://a'},
+                'subtrees': [
+                    {'type': 'org', 'base': 'ou=orgs,dc=a', 'filter': '(o=*)'},
+                    {'type': 'org', 'base': 'ou=orgs,dc=a', 'table': 'orgs_a'},
+                ],
+            }]},
+            {'URI': 'ldap://default', 'bind': 'cn=root', 'schema_cache': '/tmp/default'}
+        )
+        # The schema cache of the default server is not inherited
+        assert sources == [SyncSource(
+            'a',
+            {'URI': 'ldap://a', 'bind': 'cn=root'},
+            2,
+            [
+                Subtree('org', 'ou=orgs,dc=a', '(o=*)', 'entities'),
+                Subtree('org', 'ou=orgs,dc=a', '', 'orgs_a'),
+            ]
+        )]
+        assert parse_sources({}, {}) == []
+
+        sources = parse_sources(
+            {'sources': [{'name': 'a', 'ldap': {'schema_cache': '/tmp/a'}}]},
+            {'schema_cache': '/tmp/default'}
+        )
+        assert sources[0].ldap_params == {'schema_cache': '/tmp/a'}
+
+    @pytest.mark.parametrize('sources', [
+        # The same type of a table is synced from two subtrees
+        [
+            {'name': 'a', 'subtrees': [{'type': 'org', 'base': 'dc=a'}]},
+            {'name': 'b', 'subtrees': [{'type': 'org', 'base': 'dc=b'}]},
+        ],
+        [{'name': 'a'}, {'name': 'a'}],
+        [{'subtrees': []}],
+        [{'name': 'a', 'max_workers': 0}],
+        [{'name': 'a', 'subtrees': [{'type': 'org'}]}],
+        [{'name': 'a', 'subtrees': [{'type': 'org', 'base': 'dc=a', 'x': 1}]}],
+    ])
+    def test_parse_sources_invalid(self, sources):
+        with pytest.raises(ValueError):
+            parse_sources({'sources': sources}, {})
+
+    @patch('app.comm.ldap.LdapWrapper')
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    @patch.object(DeeweeClient, 'close')
+    @patch.object(DeeweeClient, 'reconcile_ldap_uuids', return_value={'org': 2})
+    @patch.object(DeeweeClient, 'watermarks', return_value={'org': None})
+    @patch.object(LdapClient, 'search_concurrently', return_value=iter([]))
+    def test_sync_subtree(self, search_concurrently_mock, watermarks_mock,
+                          reconcile_mock, close_mock, *args):
+        subtree = Subtree('org', 'ou=orgs,dc=a', '(o=*)', 'orgs_a')
+        with patch.object(
+            DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats(1)
+        ) as upsert_mock:
+            result = sync_subtree(
+                {'shards': 2},
+                {'delete_strategy': DELETE_STRATEGY_DELETE},
+                subtree
+            )
+        assert upsert_mock.call_args[0][0] is search_concurrently_mock.return_value
+        assert result.stats == UpsertStats(1)
+        assert result.removed == 2
+        assert list(result.spans) == [('sync', ())]
+        assert close_mock.call_count == 1
+
+        # A full sync is sharded
+        searches, modified_since, _ = search_concurrently_mock.call_args_list[0][0]
+        assert len(searches) == 3
+        assert modified_since == {'org': None}
+        type, search = searches[0]
+        assert type == 'org'
+        assert search.args == (subtree.base, subtree.filter, 'org')
+        assert search.keywords['records'] is True
+
+        # The deletes are reconciled from the entryUUIDs of the subtree
+        searches = search_concurrently_mock.call_args_list[1][0][0]
+        assert searches[0][1].keywords == {'attributes': UUID_ATTRIBUTES}
+        assert reconcile_mock.call_args[0][1] == ('org',)
+
+    @patch('app.comm.ldap.LdapWrapper')
+    @patch('app.comm.deewee.PostgresqlWrapper')
+    @patch.object(DeeweeClient, 'upsert_ldap_results_many', return_value=UpsertStats())
+    @patch.object(DeeweeClient, 'watermarks', return_value={'org': datetime.now()})
+    @patch.object(LdapClient, 'search_concurrently', return_value=iter([]))
+    def test_sync_subtree_diff(self, search_concurrently_mock, *args):
+        result = sync_subtree({'shards': 2}, {}, Subtree('org', 'dc=a'))
+        # The sync since the watermark is not sharded
+        assert len(search_concurrently_mock.call_args[0][0]) == 1
+        assert result.removed is None
+
+    def test_run_sources(self):
+        lock = threading.Lock()
+        running = {'a': 0, 'b': 0}
+        most_running = {'a': 0, 'b': 0}
+
+        def sync_subtree(ldap_params, postgresql_params, subtree):
+            source = ldap_params['name']
+            with lock:
+                running[source] += 1
+                most_running[source] = max(most_running[source], running[source])
+            time.sleep(0.05)
+            with lock:
+                running[source] -= 1
+            if subtree.type == 'fail':
+                raise ValueError(subtree.base)
+            return subtree.base
+
+        sources = [
+            SyncSource('a', {'name': 'a'}, 2, [
+                Subtree(type, f'dc=a{index}')
+                for index, type in enumerate(('org', 'person', 'fail', 'vendor'))
+            ]),
+            SyncSource('b', {'name': 'b'}, 1, [
+                Subtree(type, f'dc=b{index}')
+                for index, type in enumerate(('org', 'person'))
+            ]),
+        ]
+        with patch('app.sources.sync_subtree', sync_subtree):
+            results = list(run_sources(sources, {}, 8, ThreadPoolExecutor))
+
+        # The concurrency of every source is limited by its max_workers
+        assert most_running == {'a': 2, 'b': 1}
+        assert len(results) == 6
+        for source, subtree, future in results:
+            if subtree.type == 'fail':
+                assert isinstance(future.exception(), ValueError)
+            else:
+                assert future.result() == subtree.base